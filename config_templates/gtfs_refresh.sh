@@ -2,9 +2,55 @@
 #
 # downloads the latest static gtfs file
 # then makes OBA build a bundle using that file
+# (unless the bundle was already built from the same file)
+#
+# the bundle is built in a new folder and {bundle_current} is switched
+# to it once it is built, so OBA keeps using the old bundle until the restart
+#
+# each build is measured by bundle_stats.py, which writes a record of it
+# to {bundle_stats_dir}
 
 wget -O {gtfs_dl_file} {gtfs_static_url} -o {gtfs_dl_logfile}
-cd {federation_builder_folder} && java -classpath .:target/* org.onebusaway.transit_data_federation.bundle.FederatedTransitDataBundleCreatorMain {gtfs_dl_file} {bundle_dir}
+
+new_digest=$(sha256sum {gtfs_dl_file} | cut -d ' ' -f 1)
+if test -f {bundle_current}/{bundle_digest_file_name} && test "$new_digest" = "$(cat {bundle_current}/{bundle_digest_file_name})"
+then
+  echo "GTFS unchanged since the current bundle was built, skipping bundle build and restart."
+  exit 0
+fi
+
+mkdir -p {bundle_builds_dir}
+version=$(date +%Y%m%d%H%M%S)
+while test -e {bundle_builds_dir}/$version
+do
+  sleep 1
+  version=$(date +%Y%m%d%H%M%S)
+done
+staging_dir={bundle_builds_dir}/$version
+mkdir $staging_dir
+mkdir -p {bundle_stats_dir}
+
+if ! (cd {federation_builder_folder} && python {script_folder}/bundle_stats.py run {bundle_stats_dir}/$version.json $staging_dir {gtfs_dl_file} -- java -classpath .:target/* org.onebusaway.transit_data_federation.bundle.FederatedTransitDataBundleCreatorMain {gtfs_dl_file} $staging_dir) || ! test -f $staging_dir/TransitGraph.obj || ! test -f $staging_dir/CalendarServiceData.obj
+then
+  echo "Bundle build failed, keeping the current bundle."
+  rm -rf $staging_dir
+  echo -e "Subject: Error Building OBA Bundle\nFrom: {from_mailer}\nTo: {cron_email}\n\nThe bundle build failed, OBA is still using the previous bundle." | sendmail -t
+  exit 1
+fi
+echo $new_digest > $staging_dir/{bundle_digest_file_name}
+
+# switch to the new bundle in one step
+ln -sfn builds/$version {bundle_dir}/current.tmp && mv -T {bundle_dir}/current.tmp {bundle_current}
+
+# keep the newest {bundles_to_keep} bundles for rollback
+ls -1 {bundle_builds_dir} | sort -r | tail -n +$(({bundles_to_keep}+1)) | while read old_version
+do
+  if test "$old_version" != "$version"
+  then
+    rm -rf {bundle_builds_dir}/$old_version
+  fi
+done
+
 i=0
 
 while netstat -tulpn 2> /dev/null | grep java
@@ -0,0 +1,3 @@
+#!/bin/sh
+# Rendered by the deployer from the size of the instance, see tomcat_tuning.py.
+CATALINA_OPTS="{java_options}"
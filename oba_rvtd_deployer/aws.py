@@ -7,17 +7,54 @@ import sys
 import time
 
 import boto.ec2
-from fabric.api import env, run, sudo, cd, put
+from fabric.api import run, sudo, put
 from fabric.context_managers import settings
-from fabric.contrib.files import exists
-from fabric.exceptions import NetworkError
 
 from oba_rvtd_deployer import REPORTS_DIR, CONFIG_TEMPLATE_DIR
+from oba_rvtd_deployer.batch import CommandBatch
 from oba_rvtd_deployer.config import get_aws_config, get_oba_config
+from oba_rvtd_deployer.connections import connect
 from oba_rvtd_deployer.fab_crontab import crontab_update
+from oba_rvtd_deployer.provision import Step, download_filename, provision
+from oba_rvtd_deployer.tomcat_tuning import (DEFAULT_BUNDLE_SIZE_MB,
+                                             get_api_requests_per_second,
+                                             get_instance_resources,
+                                             size_tomcat)
 from oba_rvtd_deployer.util import FabLogger, write_template, unix_path_join
 
 
+MONITORING_URL = 'http://aws-cloudwatch.s3.amazonaws.com/downloads/CloudWatchMonitoringScripts-1.2.1.zip'
+MAVEN_URL = 'http://mirror.symnds.com/software/Apache/maven/maven-3/3.3.3/binaries/apache-maven-3.3.3-bin.tar.gz'
+TOMCAT_URL = 'http://mirror.cc.columbia.edu/pub/software/apache/tomcat/tomcat-7/v7.0.65/bin/apache-tomcat-7.0.65.tar.gz'
+XWIKI_URL = 'http://download.forge.ow2.org/xwiki/xwiki-enterprise-jetty-hsqldb-7.3.zip'
+
+# the steps of `AwsFab.install_all`, see the provision module
+PROVISION_STEPS = [Step('pg', 
+                        packages=['postgresql', 'postgresql-server'],
+                        configure='configure_pg',
+                        params='pg_params'),
+                   Step('timezone', configure='configure_timezone', params='timezone_params'),
+                   Step('ipv6', configure='configure_ipv6'),
+                   Step('monitoring',
+                        packages=['perl-DateTime', 'perl-Sys-Syslog', 'perl-LWP-Protocol-https'],
+                        downloads=[MONITORING_URL],
+                        configure='configure_custom_monitoring',
+                        params='monitoring_cron_settings'),
+                   Step('git', packages=['git']),
+                   Step('jdk', packages=['java-1.7.0-openjdk', 'java-1.7.0-openjdk-devel']),
+                   Step('maven', 
+                        requires=['jdk'], 
+                        downloads=[MAVEN_URL], 
+                        configure='configure_maven'),
+                   Step('tomcat', downloads=[TOMCAT_URL], configure='configure_tomcat', version=2),
+                   Step('tomcat_tuning', 
+                        requires=['tomcat'], 
+                        configure='configure_tomcat_tuning', 
+                        params='tomcat_tuning_params', 
+                        probe='bundle_size_command'),
+                   Step('xwiki', downloads=[XWIKI_URL], configure='configure_xwiki')]
+
+
 def get_aws_connection():
     '''Connect to AWS.
     
@@ -85,9 +122,7 @@ def launch_new():
     
     # If we've reached this point, the instance is up and running.
     print('SSH working')
-    aws_system.set_timezone()
-    aws_system.turn_off_ipv6()
-    aws_system.install_pg()
+    aws_system.provision(['timezone', 'ipv6', 'pg'])
     aws_system.update_system()
     aws_system.install_all()
     
@@ -99,35 +134,24 @@ class AwsFab:
     aws_conf = get_aws_config()
     oba_conf = get_oba_config()
     user = aws_conf.get('DEFAULT', 'user')
-    config_dir = unix_path_join('/home', user, 'conf')
+    log_name = 'aws_fab'
+    home_dir = unix_path_join('/home', user)
+    config_dir = unix_path_join(home_dir, 'conf')
+    tomcat_manager_password_file = unix_path_join(home_dir, 'tomcat', 'conf', 'manager_password')
+    bundle_current = unix_path_join(home_dir, 'data', 'bundle', 'current')
+    state_dir = unix_path_join(home_dir, '.provisioned')
     
-    def __init__(self, host_name):
+    def __init__(self, host_name, log_filename=None):
         '''Constructor for Class.  Sets up fabric environment.
         
         Args:
             host_name (string): ec2 public dns name
+            log_filename (string, default=None): where to log the output, defaults to 
+                `aws_fab.log` in the reports folder.
         '''
         
-        env.host_string = '{0}@{1}'.format(self.user, host_name)
-        env.key_filename = [self.aws_conf.get('DEFAULT', 'key_filename')]
-        sys.stdout = FabLogger(os.path.join(REPORTS_DIR, 'aws_fab.log'))
-        
-        max_retries = 6
-        num_retries = 0
-        
-        retry = True
-        while retry:
-            try:
-                # SSH into the box here.
-                self.test_cmd()
-                retry = False
-            except NetworkError as e:
-                print(e)
-                if num_retries > max_retries:
-                    raise Exception('Maximum Number of SSH Retries Hit.  Did EC2 instance get configured with ssh correctly?')
-                num_retries += 1 
-                print('SSH failed (the system may still be starting up), waiting 10 seconds...')
-                time.sleep(10)
+        sys.stdout = FabLogger(log_filename or os.path.join(REPORTS_DIR, self.log_name + '.log'))
+        connect(self.user, host_name, self.aws_conf, self.test_cmd)
         
     def test_cmd(self):
         '''A test command to see if everything is running ok.
@@ -143,66 +167,103 @@ class AwsFab:
         
     def turn_off_ipv6(self):
         '''Edits the networking settings to turn off ipv6.
+        '''
+        
+        self.provision(['ipv6'])
+        
+    def configure_ipv6(self):
+        '''Edits the networking settings to turn off ipv6.
         
         Credit to CDSU user on http://blog.acsystem.sk/linux/rhel-6-centos-6-disabling-ipv6-in-system
         '''
         
         # unfortunately, this requires sudo access
         with settings(warn_only=True):
-            sudo('echo "net.ipv6.conf.default.disable_ipv6=1" >> /etc/sysctl.conf')
-            sudo('echo "net.ipv6.conf.all.disable_ipv6 = 1" >> /etc/sysctl.conf')
+            sudo('grep -q "^net.ipv6.conf.default.disable_ipv6" /etc/sysctl.conf || ' +
+                 'echo "net.ipv6.conf.default.disable_ipv6=1" >> /etc/sysctl.conf')
+            sudo('grep -q "^net.ipv6.conf.all.disable_ipv6" /etc/sysctl.conf || ' +
+                 'echo "net.ipv6.conf.all.disable_ipv6 = 1" >> /etc/sysctl.conf')
             sudo('sysctl -p')
     
     def install_all(self, exclude_pg=True):
         '''Method to install all stuff on machine (except OneBusAway).
         
+        The packages and downloads of all the steps are fetched at the same time,
+        see `PROVISION_STEPS`.
+        
         Args:
             exclude_pg (bool, default=True): skips installation of pg.  Typically this is done right after instance startup.
         '''
         
         # self.install_helpers()
-        if not exclude_pg:
-            self.install_pg()
-        self.set_timezone()
-        self.install_custom_monitoring()
-        self.install_git()
-        self.install_jdk()
-        self.install_maven()
-        self.install_tomcat()
-        self.install_xwiki()
+        step_names = [step.name for step in PROVISION_STEPS]
+        if exclude_pg:
+            step_names.remove('pg')
+        self.provision(step_names)
+        
+    def provision(self, step_names, force=False):
+        '''Runs some of the provisioning steps, skipping the ones already done.
+        
+        Args:
+            step_names (list): names of steps in `PROVISION_STEPS`.
+            force (bool, default=False): run the steps even if they are done.
+        '''
+        
+        provision(self, PROVISION_STEPS, step_names, force)
         
     def set_timezone(self):
         '''Changes the machine's localtime to the desired timezone.
         '''
         
-        with cd('/etc'):
-            sudo('rm -rf localtime')
-            sudo('ln -s {0} localtime'.format(self.aws_conf.get('DEFAULT', 'timezone')))        
+        self.provision(['timezone'])
+        
+    def timezone_params(self):
+        '''Gets the settings the timezone step uses.
+        '''
+        
+        return dict(timezone=self.aws_conf.get('DEFAULT', 'timezone'))
+        
+    def configure_timezone(self):
+        '''Links the configured timezone as the machine's localtime.
+        '''
+        
+        batch = CommandBatch()
+        batch.sudo('rm -rf localtime', cwd='/etc')
+        batch.sudo('ln -s {0} localtime'.format(self.aws_conf.get('DEFAULT', 'timezone')), cwd='/etc')
+        batch.execute()
         
     def install_custom_monitoring(self):
         '''Installs a custom monitoring script to monitor memory and disk utilization.
         '''
         
-        # install helpers
-        sudo('yum -y install perl-DateTime perl-Sys-Syslog perl-LWP-Protocol-https')
+        self.provision(['monitoring'])
+        
+    def configure_custom_monitoring(self):
+        '''Sets up the downloaded monitoring scripts.
+        '''
         
-        # dl scripts
-        run('wget http://aws-cloudwatch.s3.amazonaws.com/downloads/CloudWatchMonitoringScripts-1.2.1.zip')
-        sudo('unzip CloudWatchMonitoringScripts-1.2.1.zip -d /usr/local')
-        run('rm CloudWatchMonitoringScripts-1.2.1.zip')
+        batch = CommandBatch()
+        batch.sudo('unzip -o {0} -d /usr/local'.format(download_filename(MONITORING_URL)))
+        batch.run('rm {0}'.format(download_filename(MONITORING_URL)))
+        batch.execute()
         
         # prepare the monitoring crontab        
         with open(os.path.join(CONFIG_TEMPLATE_DIR, 'monitoring_crontab')) as f:
             cron = f.read()
         
-        cron_settings = dict(aws_access_key_id=self.aws_conf.get('DEFAULT', 'aws_access_key_id'),
-                             aws_secret_key=self.aws_conf.get('DEFAULT', 'aws_secret_access_key'),
-                             cron_email=self.aws_conf.get('DEFAULT', 'cron_email'))  
-        aws_logging_cron = cron.format(**cron_settings)
+        aws_logging_cron = cron.format(**self.monitoring_cron_settings())
             
         # start crontab for aws monitoring
         crontab_update(aws_logging_cron, 'aws_monitoring')
         
+    def monitoring_cron_settings(self):
+        '''Gets the settings of the monitoring crontab.
+        '''
+        
+        return dict(aws_access_key_id=self.aws_conf.get('DEFAULT', 'aws_access_key_id'),
+                    aws_secret_key=self.aws_conf.get('DEFAULT', 'aws_secret_access_key'),
+                    cron_email=self.aws_conf.get('DEFAULT', 'cron_email'))
+        
     def install_helpers(self):
         '''Installs various utilities (typically not included with CentOS).
         '''
@@ -214,27 +275,32 @@ class AwsFab:
         '''Installs git.
         '''
         
-        sudo('yum -y install git')
+        self.provision(['git'])
         
     def install_jdk(self):
         '''Installs jdk devel, so maven is happy.
         '''
         
-        sudo('yum -y install java-1.7.0-openjdk java-1.7.0-openjdk-devel')
+        self.provision(['jdk'])
         
     def install_maven(self):
         '''Downloads and installs maven.
         '''
         
-        # download and extract maven
-        run('wget http://mirror.symnds.com/software/Apache/maven/maven-3/3.3.3/binaries/apache-maven-3.3.3-bin.tar.gz')
-        sudo('tar xzf apache-maven-3.3.3-bin.tar.gz -C /usr/local')
-        run('rm apache-maven-3.3.3-bin.tar.gz')
-        with cd('/usr/local'):
-            sudo('ln -s apache-maven-3.3.3 maven')
+        self.provision(['maven'])
+        
+    def configure_maven(self):
+        '''Extracts the downloaded maven.
+        '''
+        
+        batch = CommandBatch()
+        batch.sudo('tar xzf {0} -C /usr/local'.format(download_filename(MAVEN_URL)))
+        batch.run('rm {0}'.format(download_filename(MAVEN_URL)))
+        batch.sudo('ln -sfn apache-maven-3.3.3 maven', cwd='/usr/local')
         
         # check that mvn command works
-        run('/usr/local/maven/bin/mvn -version')
+        batch.run('/usr/local/maven/bin/mvn -version')
+        batch.execute()
         
     def upload_pg_hba_conf(self, local_method):
         '''Overwrites pg_hba.conf with specified local method.
@@ -243,46 +309,50 @@ class AwsFab:
         remote_data_folder = '/var/lib/pgsql9/data'
         remote_pg_hba_conf = '/var/lib/pgsql9/data/pg_hba.conf'
         
-        sudo('rm -rf {0}'.format(remote_pg_hba_conf))
-        
-        if not exists(self.config_dir):
-            run('mkdir {0}'.format(self.config_dir))
-        
+        # upload to the home folder (it always exists), then move it in one batch
         put(write_template(dict(local_method=local_method), 'pg_hba.conf'),
-            self.config_dir)
+            self.home_dir)
         
-        sudo('mv {0} {1}'.format(unix_path_join(self.config_dir, 'pg_hba.conf'),
-                                 remote_data_folder))
-        
-        sudo('chmod 600 {0}'.format(remote_pg_hba_conf))
-        sudo('chgrp postgres {0}'.format(remote_pg_hba_conf))
-        sudo('chown postgres {0}'.format(remote_pg_hba_conf))
+        batch = CommandBatch()
+        batch.sudo('rm -rf {0}'.format(remote_pg_hba_conf))
+        batch.sudo('mv {0} {1}'.format(unix_path_join(self.home_dir, 'pg_hba.conf'),
+                                       remote_data_folder))
+        batch.sudo('chmod 600 {0}'.format(remote_pg_hba_conf))
+        batch.sudo('chgrp postgres {0}'.format(remote_pg_hba_conf))
+        batch.sudo('chown postgres {0}'.format(remote_pg_hba_conf))
+        batch.execute()
         
     def install_pg(self):
         '''Configures PostgreSQL for immediate use by OneBusAway.
         '''
         
-        # install it
-        sudo('yum -y install postgresql postgresql-server')
+        self.provision(['pg'])
+        
+    def pg_params(self):
+        '''Gets the settings of the OneBusAway database users.
+        '''
+        
+        return dict(pg_username=self.oba_conf.get('DEFAULT', 'pg_username'),
+                    pg_password=self.oba_conf.get('DEFAULT', 'pg_password'),
+                    pg_role=self.oba_conf.get('DEFAULT', 'pg_role'))
         
-        # initialize db
-        sudo('service postgresql initdb')
+    def configure_pg(self):
+        '''Initializes the database (unless it was already) and sets up the OneBusAway users.
+        '''
+        
+        batch = CommandBatch()
+        batch.sudo('service postgresql initdb', unless_exists='/var/lib/pgsql9/data/PG_VERSION')
+        batch.run('mkdir -p {0}'.format(self.config_dir))
+        batch.execute()
         
         # edit pg_hba for db initialization
         self.upload_pg_hba_conf('trust')
         
         # start postgersql server
-        sudo('service postgresql start')
+        sudo('service postgresql restart')
         
         # run init sql
-        db_setup_dict = dict(pg_username=self.oba_conf.get('DEFAULT', 'pg_username'),
-                             pg_password=self.oba_conf.get('DEFAULT', 'pg_password'),
-                             pg_role=self.oba_conf.get('DEFAULT', 'pg_role'))
-        
-        if not exists(self.config_dir):
-            run('mkdir {0}'.format(self.config_dir))
-        
-        put(write_template(db_setup_dict, 'init.sql'), self.config_dir)
+        put(write_template(self.pg_params(), 'init.sql'), self.config_dir)
         
         init_sql_filename = unix_path_join(self.config_dir, 'init.sql')
         sudo('psql -U postgres -f {0}'.format(init_sql_filename))
@@ -305,46 +375,157 @@ class AwsFab:
         so that it can be restarted with cron to refresh gtfs updates.
         '''
         
-        # get tomcat from direct download
-        run('wget http://mirror.cc.columbia.edu/pub/software/apache/tomcat/tomcat-7/v7.0.65/bin/apache-tomcat-7.0.65.tar.gz')
+        self.provision(['tomcat', 'tomcat_tuning'])
         
-        # move to a local area for better organization
-        run('tar xzf apache-tomcat-7.0.65.tar.gz')
-        run('rm -rf apache-tomcat-7.0.65.tar.gz')
-        run('mv apache-tomcat-7.0.65 tomcat')
+    def configure_tomcat(self):
+        '''Extracts the downloaded Tomcat, adds its init.d script and a manager user.
+        '''
+        
+        # upload the logging rotation for catalina.out, the init.d script and the 
+        # manager settings, they are moved into place with the other commands
+        put(write_template(dict(user=self.user), 'tomcat_catalina_out'), self.home_dir)
+        put(write_template(dict(user=self.user), 'tomcat_init.d'), self.home_dir)
+        put(os.path.join(CONFIG_TEMPLATE_DIR, 'tomcat-users.xml'), self.home_dir)
+        put(os.path.join(CONFIG_TEMPLATE_DIR, 'tomcat_manager.xml'), self.home_dir)
+        
+        batch = CommandBatch()
+        
+        # move to a local area for better organization (keeping an existing tomcat 
+        # and its webapps when retrying)
+        batch.run('tar xzf {0} && mv apache-tomcat-7.0.65 tomcat'.format(download_filename(TOMCAT_URL)),
+                  unless_exists='tomcat')
+        batch.run('rm -rf {0}'.format(download_filename(TOMCAT_URL)))
                     
         # add logging rotation for catalina.out
-        put(write_template(dict(user=self.user), 'tomcat_catalina_out'), '/etc/logrotate.d', True)
+        batch.sudo('mv {0} /etc/logrotate.d'.format(unix_path_join(self.home_dir, 'tomcat_catalina_out')))
+        batch.sudo('chown root:root /etc/logrotate.d/tomcat_catalina_out')
         
         # add init.d script
-        put(write_template(dict(user=self.user), 'tomcat_init.d'), '/etc/init.d', True)
-        with cd('/etc/init.d'):
-            sudo('mv tomcat_init.d tomcat')
-            sudo('chmod 755 tomcat')
-            sudo('chown root tomcat')
-            sudo('chgrp root tomcat')
-            sudo('chkconfig --add tomcat')
+        batch.sudo('mv {0} /etc/init.d/tomcat'.format(unix_path_join(self.home_dir, 'tomcat_init.d')))
+        batch.sudo('chmod 755 tomcat', cwd='/etc/init.d')
+        batch.sudo('chown root tomcat', cwd='/etc/init.d')
+        batch.sudo('chgrp root tomcat', cwd='/etc/init.d')
+        batch.sudo('chkconfig --add tomcat', cwd='/etc/init.d')
+        
+        # add a manager user for reloading single webapps, only reachable from the 
+        # server itself.  Its password is generated here and only kept on the server.
+        batch.run('umask 077 && openssl rand -hex 16 > {0}'.format(self.tomcat_manager_password_file))
+        batch.run('sed "s/TOMCAT_MANAGER_PASSWORD/$(cat {0})/" tomcat-users.xml > tomcat/conf/tomcat-users.xml && rm tomcat-users.xml'.format(
+            self.tomcat_manager_password_file))
+        batch.run('chmod 600 tomcat/conf/tomcat-users.xml')
+        batch.run('mkdir -p tomcat/conf/Catalina/localhost && mv tomcat_manager.xml tomcat/conf/Catalina/localhost/manager.xml')
+        batch.execute()
+            
+    def tune_tomcat(self):
+        '''Sizes the JVM and the thread pool of Tomcat for the instance and its bundle.
+        '''
+        
+        self.provision(['tomcat_tuning'])
+        
+    def tomcat_tuning_params(self):
+        '''Gets the settings the tomcat_tuning step uses.
+        '''
+        
+        return dict(instance_type=self.aws_conf.get('DEFAULT', 'instance_type'),
+                    api_requests_per_second=get_api_requests_per_second(self.oba_conf))
+        
+    def bundle_size_command(self):
+        '''Gets a shell command printing the size of the current bundle in MiB.
+        '''
+        
+        return 'du -sm {0}/ 2>/dev/null | cut -f 1'.format(self.bundle_current)
+        
+    def configure_tomcat_tuning(self):
+        '''Renders Tomcat's setenv.sh and server.xml from the size of the instance.
+        
+        The memory and vCPUs of the `instance_type` come from the table in the 
+        tomcat_tuning module, or from the instance itself for types not in it.  
+        The bundle is measured on the instance, it is assumed to be 
+        `DEFAULT_BUNDLE_SIZE_MB` before the first bundle is built.  Tomcat uses the
+        new settings once it is restarted.
+        '''
+        
+        batch = CommandBatch()
+        batch.run(self.bundle_size_command())
+        batch.run("awk '/MemTotal/ {print int($2 / 1024)}' /proc/meminfo")
+        batch.run('nproc')
+        batch.execute()
+        bundle_output, memory_output, vcpus_output = [output.strip() for output in batch.outputs]
+        
+        instance_type = self.aws_conf.get('DEFAULT', 'instance_type')
+        resources = get_instance_resources(instance_type)
+        if resources:
+            memory_mb, vcpus = resources
+        else:
+            print('Unknown instance type {0}, sizing Tomcat for the memory and vCPUs of the instance'.format(
+                instance_type))
+            memory_mb, vcpus = int(memory_output), int(vcpus_output)
+        bundle_size_mb = int(bundle_output) if bundle_output else DEFAULT_BUNDLE_SIZE_MB
+        requests_per_second = get_api_requests_per_second(self.oba_conf)
+        
+        profile = size_tomcat(memory_mb, vcpus, bundle_size_mb, requests_per_second)
+        print('Tomcat sized for {0} MiB, {1} vCPUs, a {2} MiB bundle and {3} api requests/s: '
+              '{4} MiB heap, {5} gc, {6} threads, accept count {7}'.format(memory_mb,
+                                                                           vcpus,
+                                                                           bundle_size_mb,
+                                                                           requests_per_second,
+                                                                           profile['heap_mb'],
+                                                                           profile['gc'],
+                                                                           profile['max_threads'],
+                                                                           profile['accept_count']))
+        for warning in profile['warnings']:
+            print('Warning: ' + warning)
+        
+        # upload and move into place in one batch
+        put(write_template(dict(java_options=' '.join(profile['java_options'])), 
+                           'tomcat_setenv.sh', 
+                           'setenv.sh'), 
+            self.home_dir)
+        put(write_template(profile, 'tomcat_server.xml', 'server.xml'), self.home_dir)
+        batch = CommandBatch()
+        batch.run('chmod 755 setenv.sh && mv setenv.sh tomcat/bin/setenv.sh')
+        batch.run('mv server.xml tomcat/conf/server.xml')
+        batch.execute()
             
     def install_xwiki(self):
         
-        run('wget http://download.forge.ow2.org/xwiki/xwiki-enterprise-jetty-hsqldb-7.3.zip')
+        self.provision(['xwiki'])
+        
+    def configure_xwiki(self):
+        
+        # upload the init.d script, it is moved into place with the other commands
+        put(os.path.join(CONFIG_TEMPLATE_DIR, 'xwiki_init.d'), self.home_dir)
+        
+        batch = CommandBatch()
         
         # move to a local area for better organization
-        sudo('unzip xwiki-enterprise-jetty-hsqldb-7.3.zip -d /usr/local')
-        run('rm xwiki-enterprise-jetty-hsqldb-7.3.zip')
+        batch.sudo('unzip -o {0} -d /usr/local'.format(download_filename(XWIKI_URL)))
+        batch.run('rm {0}'.format(download_filename(XWIKI_URL)))
         
-        with cd('/usr/local'):
-            sudo('ln -s xwiki-enterprise-jetty-hsqldb-7.3 xwiki')
+        batch.sudo('ln -sfn xwiki-enterprise-jetty-hsqldb-7.3 xwiki', cwd='/usr/local')
             
         # add init.d script
-        put(os.path.join(CONFIG_TEMPLATE_DIR, 'xwiki_init.d'), '/etc/init.d', True)
-        with cd('/etc/init.d'):
-            sudo('mv xwiki_init.d xwiki')
-            sudo('chmod 755 xwiki')
-            sudo('chown root xwiki')
-            sudo('chgrp root xwiki')
-            sudo('chkconfig --add xwiki')
+        batch.sudo('mv {0} /etc/init.d/xwiki'.format(unix_path_join(self.home_dir, 'xwiki_init.d')))
+        batch.sudo('chmod 755 xwiki', cwd='/etc/init.d')
+        batch.sudo('chown root xwiki', cwd='/etc/init.d')
+        batch.sudo('chgrp root xwiki', cwd='/etc/init.d')
+        batch.sudo('chkconfig --add xwiki', cwd='/etc/init.d')
+        batch.execute()
+        
+
+def tune_tomcat(instance_dns_name=None):
+    '''Sizes the JVM and the thread pool of Tomcat for the EC2 instance.
+    
+    Args:
+        instance_dns_name (string, default=None): The EC2 instance to tune.
+    '''
+    
+    if not instance_dns_name:
+        instance_dns_name = input('Enter EC2 public dns name: ')
         
+    aws_system = AwsFab(instance_dns_name)
+    aws_system.tune_tomcat()
+    
 
 def tear_down(instance_id=None, conn=None):
     '''Terminates a EC2 instance and deletes all associated volumes.
@@ -0,0 +1,157 @@
+import base64
+try:
+    from pipes import quote
+except ImportError:
+    from shlex import quote
+
+from fabric.api import run, settings
+
+
+START_MARKER = '__batch_start__'
+STATUS_MARKER = '__batch_status__'
+
+
+class CommandBatch:
+    '''Collects the commands of a step to run them on the server as one script.
+
+    Every `run` or `sudo` call costs an ssh round-trip, a batch sends all its
+    commands at once.  The script stops at the first failing command and prints
+    the exit status of each command, so a failure is still reported with the
+    command that caused it.
+
+    Commands added with `background=True` run at the same time as the commands
+    after them, until the next `wait` (or the end of the batch).
+    '''
+
+    def __init__(self):
+        self.commands = []
+        # the output of each command, once the batch is executed
+        self.outputs = []
+        # the number of commands added before each call to `wait`
+        self.waits = set()
+
+    def run(self, command, cwd=None, unless_exists=None, background=False):
+        '''Add a command to run as the login user.
+
+        Args:
+            command (string): the shell command.
+            cwd (string, default=None): the folder to run it in.
+            unless_exists (string, default=None): skip the command if this path exists
+                on the server (instead of checking with `exists` first).
+            background (bool, default=False): don't wait for the command to finish
+                before starting the next one.
+        '''
+
+        self.commands.append((command, False, cwd, unless_exists, background))
+
+    def sudo(self, command, cwd=None, unless_exists=None, background=False):
+        '''Add a command to run as root, see `run`.
+        '''
+
+        self.commands.append((command, True, cwd, unless_exists, background))
+
+    def wait(self):
+        '''Wait for the background commands to finish before running the next command.
+        '''
+
+        self.waits.add(len(self.commands))
+
+    def script(self):
+        '''Get the shell script that runs the commands.
+        '''
+
+        lines = ['set +e',
+                 'batch_dir=$(mktemp -d)',
+                 'trap \'kill $(jobs -p) 2>/dev/null; rm -rf "$batch_dir"\' EXIT']
+        background_commands = []
+
+        def report_status(i):
+            return ['status=$?',
+                    'echo {0} {1} $status'.format(STATUS_MARKER, i),
+                    'if [ $status -ne 0 ]; then exit $status; fi']
+
+        def wait_background():
+            for i in background_commands:
+                # print the output of the command once it is done, with its status
+                lines.extend(['wait $pid_{0}'.format(i),
+                              'status=$?',
+                              'echo {0} {1}'.format(START_MARKER, i),
+                              'cat "$batch_dir/{0}.log"'.format(i),
+                              '(exit $status)'] + report_status(i))
+            del background_commands[:]
+
+        for i, (command, use_sudo, cwd, unless_exists, background) in enumerate(self.commands):
+            if i in self.waits:
+                wait_background()
+            shell_command = command
+            if unless_exists:
+                # checked as the same user, who may be the only one able to see the path
+                shell_command = 'test -e {0} || ({1})'.format(quote(unless_exists), shell_command)
+            if use_sudo:
+                shell_command = 'sudo -n bash -c {0}'.format(quote(shell_command))
+            if cwd:
+                shell_command = 'cd {0} && {1}'.format(quote(cwd), shell_command)
+            # the script itself is read from stdin, a command reading it would
+            # swallow the commands after it
+            if background:
+                lines += ['({0}) < /dev/null > "$batch_dir/{1}.log" 2>&1 &'.format(shell_command, i),
+                          'pid_{0}=$!'.format(i)]
+                background_commands.append(i)
+            else:
+                lines += ['echo {0} {1}'.format(START_MARKER, i),
+                          '({0}) < /dev/null'.format(shell_command)] + report_status(i)
+        wait_background()
+        return '\n'.join(lines) + '\n'
+
+    def execute(self):
+        '''Run the commands on the server in one round-trip.
+
+        Raises:
+            Exception: if a command fails, with the command, its exit status and its output.
+
+        Returns:
+            list: the exit status of each command, their output is kept in `outputs`.
+        '''
+
+        if not self.commands:
+            return []
+
+        encoded = base64.b64encode(self.script().encode('utf-8')).decode('ascii')
+        with settings(warn_only=True):
+            result = run('echo {0} | base64 -d | bash'.format(encoded))
+
+        # background commands report in the order they are waited for
+        statuses = dict()
+        outputs = dict()
+        current = None
+        last = None
+        for line in result.splitlines():
+            parts = line.split()
+            if len(parts) == 2 and parts[0] == START_MARKER:
+                current = int(parts[1])
+                outputs[current] = []
+            elif len(parts) == 3 and parts[0] == STATUS_MARKER:
+                last = int(parts[1])
+                statuses[last] = int(parts[2])
+                current = None
+            elif current is not None:
+                outputs[current].append(line)
+
+        if last is not None and statuses[last] != 0:
+            failed, status = last, statuses[last]
+        elif len(statuses) < len(self.commands):
+            # the script itself was stopped
+            failed = min(i for i in range(len(self.commands)) if i not in statuses)
+            status = result.return_code
+        else:
+            self.outputs = ['\n'.join(outputs.get(i, [])) for i in range(len(self.commands))]
+            return [statuses[i] for i in range(len(self.commands))]
+
+        command, use_sudo, cwd, unless_exists, background = self.commands[failed]
+        raise Exception('Command {0} of {1} failed with exit status {2}: {3}{4}\n{5}'.format(
+            failed + 1,
+            len(self.commands),
+            status,
+            'sudo ' if use_sudo else '',
+            command,
+            '\n'.join(outputs.get(failed, []))))
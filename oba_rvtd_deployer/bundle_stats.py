@@ -0,0 +1,255 @@
+'''Measure OBA bundle builds.
+
+Runs the bundle builder and writes a json record of the run: wall time, peak
+RSS and GC time of the JVM, how long each task of the builder took and the size
+of the bundle.  The builder's output is passed through unchanged.
+
+This module only uses the standard library because it is also uploaded to the
+server and run there:
+
+    python bundle_stats.py run <record file> <bundle dir> <gtfs file> -- java ...
+'''
+
+from datetime import datetime
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+
+# the builder logs the start of each of its tasks
+PHASE_PATTERN = re.compile(r'running task: ?(\S+)', re.IGNORECASE)
+
+# -verbose:gc lines end with ", 0.0123456 secs]", -Xlog:gc lines with " 1.234ms"
+GC_SECS_PATTERN = re.compile(r'([0-9.]+) secs\]\s*$')
+GC_MS_PATTERN = re.compile(r'Pause.* ([0-9.]+)ms\s*$')
+
+# a run is flagged by `compare_records` if it took this many times the median of earlier runs
+BLOW_UP_RATIO = 1.5
+
+
+def java_major_version(java='java'):
+    '''Get the major version of a java command (7 for 1.7.0_80, 11 for 11.0.2).'''
+
+    try:
+        output = subprocess.Popen([java, '-version'],
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.STDOUT).communicate()[0]
+    except OSError:
+        return None
+    match = re.search(r'version "(\d+)(?:\.(\d+))?', output.decode('utf-8', 'replace'))
+    if not match:
+        return None
+    major = int(match.group(1))
+    if major == 1 and match.group(2):
+        return int(match.group(2))
+    return major
+
+
+def gc_log_options(java, gc_log_filename):
+    '''Get the jvm options that write the GC log.'''
+
+    version = java_major_version(java)
+    if version is not None and version >= 9:
+        return ['-Xlog:gc:file={0}'.format(gc_log_filename)]
+    return ['-verbose:gc', '-Xloggc:{0}'.format(gc_log_filename)]
+
+
+def parse_gc_log(gc_log_filename):
+    '''Sum the pauses in a GC log.
+
+    Returns:
+        tuple: (number of collections, seconds spent in them).
+    '''
+
+    count = 0
+    seconds = 0.0
+    if not os.path.exists(gc_log_filename):
+        return count, seconds
+    with open(gc_log_filename) as f:
+        for line in f:
+            match = GC_SECS_PATTERN.search(line)
+            if match:
+                count += 1
+                seconds += float(match.group(1))
+                continue
+            match = GC_MS_PATTERN.search(line)
+            if match:
+                count += 1
+                seconds += float(match.group(1)) / 1000
+    return count, seconds
+
+
+def directory_size(path):
+    '''Get the number of files and bytes in a folder.'''
+
+    num_files = 0
+    num_bytes = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            num_files += 1
+            num_bytes += os.path.getsize(os.path.join(dirpath, filename))
+    return num_files, num_bytes
+
+
+def file_digest(filename):
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def run_build(record_filename, bundle_dir, gtfs_filename, command, cwd=None):
+    '''Run a bundle build command and write the record of the run.
+
+    Args:
+        record_filename (string): where to write the json record.
+        bundle_dir (string): the folder the bundle is built in.
+        gtfs_filename (string): the gtfs file the bundle is built from.
+        command (list): the command, starting with the java executable.
+        cwd (string, default=None): the folder to run the command in.
+
+    Returns:
+        int: the exit code of the command.
+    '''
+
+    gc_log_filename = record_filename + '.gc.log'
+    command = command[:1] + gc_log_options(command[0], gc_log_filename) + command[1:]
+
+    started_at = datetime.now()
+    start = time.time()
+    phases = []
+    output = getattr(sys.stdout, 'buffer', sys.stdout)
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                               cwd=cwd)
+    for line in iter(process.stdout.readline, b''):
+        output.write(line)
+        output.flush()
+        match = PHASE_PATTERN.search(line.decode('utf-8', 'replace'))
+        if match:
+            phases.append(dict(name=match.group(1), start=time.time() - start))
+    process.stdout.close()
+    pid, status, rusage = os.wait4(process.pid, 0)
+    wall_seconds = time.time() - start
+    exit_code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+
+    for phase, next_phase in zip(phases, phases[1:] + [dict(start=wall_seconds)]):
+        phase['seconds'] = round(next_phase['start'] - phase['start'], 3)
+        phase['start'] = round(phase['start'], 3)
+
+    gc_count, gc_seconds = parse_gc_log(gc_log_filename)
+    if os.path.exists(gc_log_filename):
+        os.remove(gc_log_filename)
+    bundle_files, bundle_bytes = directory_size(bundle_dir)
+
+    record = dict(version=os.path.splitext(os.path.basename(record_filename))[0],
+                  started_at=started_at.strftime('%Y-%m-%d %H:%M:%S'),
+                  gtfs_file=gtfs_filename,
+                  gtfs_sha256=file_digest(gtfs_filename) if os.path.exists(gtfs_filename) else None,
+                  gtfs_bytes=os.path.getsize(gtfs_filename) if os.path.exists(gtfs_filename) else None,
+                  exit_code=exit_code,
+                  wall_seconds=round(wall_seconds, 3),
+                  user_seconds=round(rusage.ru_utime, 3),
+                  system_seconds=round(rusage.ru_stime, 3),
+                  max_rss_kb=rusage.ru_maxrss,
+                  gc_count=gc_count,
+                  gc_seconds=round(gc_seconds, 3),
+                  phases=phases,
+                  bundle_files=bundle_files,
+                  bundle_bytes=bundle_bytes)
+    with open(record_filename, 'w') as f:
+        json.dump(record, f, indent=2, sort_keys=True)
+
+    return exit_code
+
+
+def read_records(records_dir):
+    '''Read the records of the builds in a folder, oldest first.'''
+
+    records = []
+    if not os.path.exists(records_dir):
+        return records
+    for filename in sorted(os.listdir(records_dir)):
+        if filename.endswith('.json'):
+            with open(os.path.join(records_dir, filename)) as f:
+                try:
+                    records.append(json.load(f))
+                except ValueError:
+                    continue
+    return records
+
+
+def _median(values):
+    values = sorted(values)
+    if not values:
+        return None
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def compare_records(records, last=10):
+    '''Summarize the last builds, flagging values far above the median of earlier builds.
+
+    Args:
+        records (list): build records, oldest first.
+        last (int, default=10): number of builds to show.
+
+    Returns:
+        list: lines of the comparison.
+    '''
+
+    metrics = [('wall_seconds', 'wall s', 1),
+               ('max_rss_kb', 'rss MB', 1024),
+               ('gc_seconds', 'gc s', 1),
+               ('bundle_bytes', 'bundle MB', 1024 * 1024)]
+    lines = ['{0:<16} {1:<10} {2:>6} {3:>10} {4:>10} {5:>10} {6:>10}'.format(
+        'version', 'gtfs', 'exit', *[label for key, label, scale in metrics])]
+    for i, record in enumerate(records):
+        if i < len(records) - last:
+            continue
+        cells = []
+        for key, label, scale in metrics:
+            value = record.get(key)
+            cell = '-' if value is None else '{0:.1f}'.format(value / float(scale))
+            baseline = _median([r[key] for r in records[:i] if r.get(key) is not None])
+            if value is not None and baseline and value > BLOW_UP_RATIO * baseline:
+                cell += '!'
+            cells.append(cell)
+        lines.append('{0:<16} {1:<10} {2:>6} {3:>10} {4:>10} {5:>10} {6:>10}'.format(
+            record.get('version', ''),
+            (record.get('gtfs_sha256') or '')[:10],
+            record.get('exit_code', ''),
+            *cells))
+
+    if records:
+        # the tasks of the last build compared to the build before it
+        latest = records[-1]
+        previous = records[-2] if len(records) > 1 else dict()
+        previous_phases = dict((p['name'], p['seconds']) for p in previous.get('phases', []))
+        if latest.get('phases'):
+            lines.append('')
+            lines.append('{0:<40} {1:>10} {2:>10}'.format('task (last build)', 'seconds', 'previous'))
+            for phase in latest['phases']:
+                previous_seconds = previous_phases.get(phase['name'])
+                lines.append('{0:<40} {1:>10.1f} {2:>10}'.format(
+                    phase['name'],
+                    phase['seconds'],
+                    '-' if previous_seconds is None else '{0:.1f}'.format(previous_seconds)))
+    return lines
+
+
+def main(args):
+    if len(args) >= 6 and args[0] == 'run' and args[4] == '--':
+        return run_build(args[1], args[2], args[3], args[5:])
+    print(__doc__)
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,534 @@
+from array import array
+from collections import namedtuple
+import csv
+import datetime
+import io
+import math
+import os
+import sys
+import time
+import zipfile
+
+from transitfeed.problems import TYPE_WARNING
+
+from oba_rvtd_deployer.feedvalidator import DateTripsDeparturesList
+
+
+Agency = namedtuple('Agency', ['agency_id', 'agency_name', 'agency_url', 'agency_timezone'])
+
+NO_VALUE = -1
+
+
+def parse_time(value):
+    '''Convert a GTFS time (which can be past 24:00:00) to seconds since midnight.
+
+    Args:
+        value (string): time in H:MM:SS or HH:MM:SS format.
+
+    Returns:
+        int: seconds since midnight, NO_VALUE if blank or None if invalid.
+    '''
+
+    value = value.strip()
+    if not value:
+        return NO_VALUE
+    parts = value.split(':')
+    if len(parts) != 3:
+        return None
+    try:
+        hours, minutes, seconds = [int(p) for p in parts]
+    except ValueError:
+        return None
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def parse_date(value):
+    '''Convert a GTFS date to a date object (None if invalid).'''
+
+    try:
+        return datetime.datetime.strptime(value.strip(), '%Y%m%d').date()
+    except ValueError:
+        return None
+
+
+def zip_tables(zf):
+    '''Map the file name of each table in a GTFS zip to its member name.'''
+
+    return dict((os.path.basename(n), n) for n in zf.namelist())
+
+
+def read_table(zf, member):
+    '''Stream (row number, row, headers) for each row of a csv file in a zip.'''
+
+    f = zf.open(member)
+    if sys.version_info[0] >= 3:
+        f = io.TextIOWrapper(f, encoding='utf-8-sig')
+    reader = csv.reader(f)
+    try:
+        headers = [h.strip() for h in next(reader)]
+    except StopIteration:
+        f.close()
+        return
+    if headers and headers[0].startswith('\xef\xbb\xbf'):
+        headers[0] = headers[0][3:]
+    for row_num, row in enumerate(reader, 2):
+        if not row:
+            continue
+        yield row_num, row, headers
+    f.close()
+
+
+class ColumnarFeed:
+    '''A GTFS feed held in compact columns instead of one object per row.
+
+    Ids are interned and replaced by their index in the column of ids, times are
+    stored as int32 seconds since midnight and coordinates as float32.  It
+    provides the parts of the transitfeed Schedule interface that the html report
+    and CalendarSummary use.
+    '''
+
+    def __init__(self, feed_filename, problems):
+        '''Stream the tables of a GTFS zip into columns.
+
+        Args:
+            feed_filename (string): path to the GTFS zip file.
+            problems (transitfeed.ProblemReporter): reporter of problems found while loading.
+        '''
+
+        self.problems = problems
+        self.agencies = []
+
+        self.stop_ids = []
+        self.stop_names = []
+        self.stop_lat = array('f')
+        self.stop_lon = array('f')
+        self.stop_location_type = array('b')
+        self.stop_index = dict()
+
+        self.route_ids = []
+        self.route_agency_ids = []
+        self.route_index = dict()
+
+        self.trip_ids = []
+        self.trip_route = array('i')
+        self.trip_service = array('i')
+        self.trip_shape = array('i')
+        self.trip_headsign = []
+        self.trip_index = dict()
+        self.trip_runs = None
+
+        self.st_trip = array('i')
+        self.st_stop = array('i')
+        self.st_arrival = array('i')
+        self.st_departure = array('i')
+        self.st_sequence = array('i')
+
+        self.shape_ids = []
+        self.shape_index = dict()
+
+        # service index -> (start date, end date, weekday flags)
+        self.service_ids = []
+        self.service_index = dict()
+        self.service_calendar = dict()
+        # service index -> {date: exception_type}
+        self.service_exceptions = dict()
+        self.feed_start_date = None
+        self.feed_end_date = None
+
+        with zipfile.ZipFile(feed_filename) as zf:
+            self._names = zip_tables(zf)
+            self._zf = zf
+            self._load_agencies()
+            self._load_stops()
+            self._load_routes()
+            self._load_calendar()
+            self._load_calendar_dates()
+            self._load_shapes()
+            self._load_trips()
+            self._load_stop_times()
+            self._load_frequencies()
+            self._load_feed_info()
+            self._zf = None
+
+    def _rows(self, table):
+        '''Stream (row number, dict) for each row of a table, nothing if it's missing.'''
+
+        if table not in self._names:
+            return
+        for row_num, row, headers in read_table(self._zf, self._names[table]):
+            self._context = (table, row_num, row, headers)
+            yield row_num, dict(zip(headers, row))
+
+    def _intern(self, value):
+        if sys.version_info[0] >= 3:
+            return sys.intern(value)
+        return intern(value)
+
+    def _add_id(self, ids, index, value):
+        value = self._intern(value.strip())
+        index[value] = len(ids)
+        ids.append(value)
+        return index[value]
+
+    def _invalid_value(self, column_name, value, reason=None, type=None):
+        kwargs = dict(reason=reason, context=self._context)
+        if type:
+            kwargs['type'] = type
+        self.problems.InvalidValue(column_name, value, **kwargs)
+
+    def _load_agencies(self):
+        for row_num, row in self._rows('agency.txt'):
+            self.agencies.append(Agency(row.get('agency_id', '').strip(),
+                                        row.get('agency_name', ''),
+                                        row.get('agency_url', ''),
+                                        row.get('agency_timezone', '').strip()))
+
+    def _load_stops(self):
+        for row_num, row in self._rows('stops.txt'):
+            self._add_id(self.stop_ids, self.stop_index, row.get('stop_id', ''))
+            self.stop_names.append(self._intern(row.get('stop_name', '')))
+            try:
+                lat = float(row.get('stop_lat', ''))
+                lon = float(row.get('stop_lon', ''))
+            except ValueError:
+                self._invalid_value('stop_lat', row.get('stop_lat', ''))
+                lat, lon = float('nan'), float('nan')
+            self.stop_lat.append(lat)
+            self.stop_lon.append(lon)
+            location_type = row.get('location_type', '').strip()
+            self.stop_location_type.append(1 if location_type == '1' else 0)
+
+    def _load_routes(self):
+        for row_num, row in self._rows('routes.txt'):
+            self._add_id(self.route_ids, self.route_index, row.get('route_id', ''))
+            self.route_agency_ids.append(self._intern(row.get('agency_id', '').strip()))
+
+    def _service_index(self, service_id):
+        service_id = service_id.strip()
+        if service_id not in self.service_index:
+            self._add_id(self.service_ids, self.service_index, service_id)
+        return self.service_index[service_id]
+
+    def _load_calendar(self):
+        days = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+        for row_num, row in self._rows('calendar.txt'):
+            service = self._service_index(row.get('service_id', ''))
+            start_date = parse_date(row.get('start_date', ''))
+            end_date = parse_date(row.get('end_date', ''))
+            if start_date is None or end_date is None:
+                self._invalid_value('start_date', row.get('start_date', ''))
+                continue
+            weekdays = tuple(row.get(d, '').strip() == '1' for d in days)
+            self.service_calendar[service] = (start_date, end_date, weekdays)
+
+    def _load_calendar_dates(self):
+        for row_num, row in self._rows('calendar_dates.txt'):
+            service = self._service_index(row.get('service_id', ''))
+            date = parse_date(row.get('date', ''))
+            exception_type = row.get('exception_type', '').strip()
+            if date is None or exception_type not in ('1', '2'):
+                self._invalid_value('date', row.get('date', ''))
+                continue
+            self.service_exceptions.setdefault(service, dict())[date] = int(exception_type)
+
+    def _load_shapes(self):
+        for row_num, row in self._rows('shapes.txt'):
+            shape_id = row.get('shape_id', '').strip()
+            if shape_id not in self.shape_index:
+                self._add_id(self.shape_ids, self.shape_index, shape_id)
+
+    def _load_trips(self):
+        for row_num, row in self._rows('trips.txt'):
+            self._add_id(self.trip_ids, self.trip_index, row.get('trip_id', ''))
+            route_id = row.get('route_id', '').strip()
+            if route_id not in self.route_index:
+                self.problems.InvalidValue('route_id', route_id, context=self._context)
+            self.trip_route.append(self.route_index.get(route_id, NO_VALUE))
+            self.trip_service.append(self._service_index(row.get('service_id', '')))
+            shape_id = row.get('shape_id', '').strip()
+            self.trip_shape.append(self.shape_index.get(shape_id, NO_VALUE))
+            self.trip_headsign.append(self._intern(row.get('trip_headsign', '')))
+
+    def _load_stop_times(self):
+        for row_num, row in self._rows('stop_times.txt'):
+            trip_id = row.get('trip_id', '').strip()
+            stop_id = row.get('stop_id', '').strip()
+            if trip_id not in self.trip_index:
+                self.problems.InvalidValue('trip_id', trip_id, context=self._context)
+                continue
+            if stop_id not in self.stop_index:
+                self.problems.InvalidValue('stop_id', stop_id, context=self._context)
+                continue
+            arrival = parse_time(row.get('arrival_time', ''))
+            departure = parse_time(row.get('departure_time', ''))
+            if arrival is None:
+                self._invalid_value('arrival_time', row.get('arrival_time', ''))
+                arrival = NO_VALUE
+            if departure is None:
+                self._invalid_value('departure_time', row.get('departure_time', ''))
+                departure = NO_VALUE
+            try:
+                sequence = int(row.get('stop_sequence', ''))
+            except ValueError:
+                self._invalid_value('stop_sequence', row.get('stop_sequence', ''))
+                continue
+            self.st_trip.append(self.trip_index[trip_id])
+            self.st_stop.append(self.stop_index[stop_id])
+            self.st_arrival.append(arrival)
+            self.st_departure.append(departure)
+            self.st_sequence.append(sequence)
+
+    def _load_frequencies(self):
+        # number of runs of each trip, only kept if the feed has frequencies
+        for row_num, row in self._rows('frequencies.txt'):
+            if self.trip_runs is None:
+                self.trip_runs = array('i', [0] * len(self.trip_ids))
+            trip = self.trip_index.get(row.get('trip_id', '').strip())
+            start = parse_time(row.get('start_time', ''))
+            end = parse_time(row.get('end_time', ''))
+            try:
+                headway = int(row.get('headway_secs', ''))
+            except ValueError:
+                headway = 0
+            if trip is None or start in (None, NO_VALUE) or end in (None, NO_VALUE) or headway <= 0:
+                self._invalid_value('headway_secs', row.get('headway_secs', ''))
+                continue
+            if end > start:
+                self.trip_runs[trip] += int(math.ceil((end - start) / float(headway)))
+
+    def _load_feed_info(self):
+        for row_num, row in self._rows('feed_info.txt'):
+            self.feed_start_date = row.get('feed_start_date', '').strip() or None
+            self.feed_end_date = row.get('feed_end_date', '').strip() or None
+
+    def get_trip_runs(self, trip):
+        '''The number of times a trip runs on a day it is active.'''
+
+        if self.trip_runs is None or self.trip_runs[trip] == 0:
+            return 1
+        return self.trip_runs[trip]
+
+    def stop_time_counts(self):
+        '''Count the stop times of each trip.
+
+        Returns:
+            array: number of stop times, indexed like trip_ids.
+        '''
+
+        counts = array('i', [0] * len(self.trip_ids))
+        for trip in self.st_trip:
+            counts[trip] += 1
+        return counts
+
+    def is_service_active(self, service, date):
+        '''Check whether a service runs on a date.'''
+
+        exception_type = self.service_exceptions.get(service, {}).get(date)
+        if exception_type is not None:
+            return exception_type == 1
+        calendar = self.service_calendar.get(service)
+        if calendar is None:
+            return False
+        start_date, end_date, weekdays = calendar
+        return start_date <= date <= end_date and weekdays[date.weekday()]
+
+    def GetDateRangeWithOrigins(self):
+        '''Return the first and last service dates and where they come from.
+
+        Like transitfeed, exception dates that add service extend the range and
+        dates in feed_info.txt override it.
+
+        Returns:
+            tuple: (start date, end date, start origin, end origin) with dates in YYYYMMDD
+                format, or Nones if there are no service dates.
+        '''
+
+        start = end = start_origin = end_origin = None
+        for service in range(len(self.service_ids)):
+            dates = []
+            if service in self.service_calendar:
+                start_date, end_date, _ = self.service_calendar[service]
+                dates.append((start_date, False))
+                dates.append((end_date, False))
+            for date, exception_type in self.service_exceptions.get(service, {}).items():
+                if exception_type == 1:
+                    dates.append((date, True))
+            for date, is_exception in dates:
+                if start is None or date < start:
+                    start = date
+                    start_origin = (is_exception and
+                                    'earliest service exception date in calendar_dates.txt' or
+                                    'earliest service date in calendar.txt')
+                if end is None or date > end:
+                    end = date
+                    end_origin = (is_exception and
+                                  'last service exception date in calendar_dates.txt' or
+                                  'last service date in calendar.txt')
+
+        if start is None:
+            return None, None, None, None
+
+        start = start.strftime('%Y%m%d')
+        end = end.strftime('%Y%m%d')
+        if self.feed_start_date:
+            start, start_origin = self.feed_start_date, 'feed_start_date in feed_info.txt'
+        if self.feed_end_date:
+            end, end_origin = self.feed_end_date, 'feed_end_date in feed_info.txt'
+
+        return start, end, start_origin, end_origin
+
+    def GetDateRange(self):
+        return self.GetDateRangeWithOrigins()[0:2]
+
+    def GetServiceCalendars(self):
+        '''Yield (service_id, start date, end date, weekday flags, exceptions) of each service.
+
+        Used by feedvalidator to build the service x date bitmaps.
+        '''
+
+        for service, service_id in enumerate(self.service_ids):
+            start_date, end_date, weekdays = self.service_calendar.get(service,
+                                                                       (None, None, (False,) * 7))
+            exceptions = list(self.service_exceptions.get(service, {}).items())
+            yield service_id, start_date, end_date, weekdays, exceptions
+
+    def GetServiceTripDepartureCounts(self):
+        '''Count the trips and departures of each service on a day it is active.
+
+        Returns:
+            tuple: (dict, dict) maps from service_id to number of trips and to number of departures.
+        '''
+
+        service_trips = dict((service_id, 0) for service_id in self.service_ids)
+        service_departures = dict((service_id, 0) for service_id in self.service_ids)
+        stop_time_counts = self.stop_time_counts()
+        for trip in range(len(self.trip_ids)):
+            runs = self.get_trip_runs(trip)
+            service_id = self.service_ids[self.trip_service[trip]]
+            service_trips[service_id] += runs
+            service_departures[service_id] += (stop_time_counts[trip] - 1) * runs
+        return service_trips, service_departures
+
+    def GenerateDateTripsDeparturesList(self, date_start, date_end):
+        '''Return a list of (date object, number of trips, number of departures).
+
+        The list is generated for dates in the range [date_start, date_end), the same
+        as transitfeed's Schedule.
+        '''
+
+        return DateTripsDeparturesList(self, date_start, date_end)
+
+    def GetAgencyList(self):
+        return self.agencies
+
+    def GetRouteList(self):
+        return self.route_ids
+
+    def GetStopList(self):
+        return self.stop_ids
+
+    def GetTripList(self):
+        return self.trip_ids
+
+    def GetShapeList(self):
+        return self.shape_ids
+
+
+def _check_agency_timezone(feed, problems):
+    timezones = set(a.agency_timezone for a in feed.agencies)
+    if len(timezones) > 1:
+        problems.InvalidValue('agency_timezone',
+                              '"%s"' % ('", "'.join(timezones)),
+                              'All agencies should have the same time zone. '
+                              'Please review agency.txt.')
+
+
+def _check_service_range(feed, problems):
+    start_date, end_date, start_origin, end_origin = feed.GetDateRangeWithOrigins()
+    if not start_date or not end_date:
+        problems.OtherProblem('This feed has no effective service dates!', type=TYPE_WARNING)
+        return
+
+    today = datetime.date.today()
+    first_date = parse_date(start_date)
+    last_date = parse_date(end_date)
+    # the dates of feed_info.txt are used as they are written
+    for date, value, origin in ((first_date, start_date, start_origin),
+                                (last_date, end_date, end_origin)):
+        if date is None:
+            problems.InvalidValue(origin.split()[0], value, 'The %s is not a valid date.' % origin)
+    if last_date and last_date < today + datetime.timedelta(days=60):
+        problems.ExpirationDate(time.mktime(last_date.timetuple()), end_origin)
+    if first_date and first_date > today:
+        problems.FutureService(time.mktime(first_date.timetuple()), start_origin)
+
+
+def _check_stops(feed, problems):
+    used = array('b', [0] * len(feed.stop_ids))
+    for stop in feed.st_stop:
+        used[stop] = 1
+    for stop in range(len(feed.stop_ids)):
+        if feed.stop_location_type[stop] == 0 and not used[stop]:
+            problems.UnusedStop(feed.stop_ids[stop], feed.stop_names[stop])
+        elif feed.stop_location_type[stop] == 1 and used[stop]:
+            problems.UsedStation(feed.stop_ids[stop], feed.stop_names[stop])
+
+
+def _check_route_agency(feed, problems):
+    agency_ids = set(a.agency_id for a in feed.agencies)
+    for route, agency_id in enumerate(feed.route_agency_ids):
+        if agency_id and agency_id not in agency_ids:
+            problems.InvalidAgencyID('agency_id', agency_id, 'route', feed.route_ids[route])
+
+
+def _check_trip_stop_times(feed, problems):
+    counts = feed.stop_time_counts()
+    for trip, count in enumerate(counts):
+        if count == 0:
+            problems.OtherProblem('The trip with the trip_id "%s" doesn\'t have '
+                                  'any stop times defined.' % feed.trip_ids[trip],
+                                  type=TYPE_WARNING)
+        elif count == 1:
+            problems.OtherProblem('The trip with the trip_id "%s" only has one '
+                                  'stop on it; it should have at least one more '
+                                  'stop so that the riders can leave!' %
+                                  feed.trip_ids[trip], type=TYPE_WARNING)
+
+
+def _check_unused_shapes(feed, problems):
+    used = set(feed.trip_shape)
+    unused_shape_ids = [s for i, s in enumerate(feed.shape_ids) if i not in used]
+    if unused_shape_ids:
+        problems.OtherProblem('The shapes with the following shape_ids aren\'t '
+                              'used by any trips: %s' % ', '.join(unused_shape_ids),
+                              type=TYPE_WARNING)
+
+
+def _check_null_headsigns(feed, problems):
+    for headsign in feed.trip_headsign:
+        if headsign == 'null':
+            problems.InvalidValue('trip_headsign', 'null', type=TYPE_WARNING)
+
+
+# the checks that can run on the columns, named like the matching schedule checks
+COLUMNAR_CHECKS = [
+    ('agency_timezone', _check_agency_timezone),
+    ('service_range', _check_service_range),
+    ('stops', _check_stops),
+    ('route_agency', _check_route_agency),
+    ('trip_stop_times', _check_trip_stop_times),
+    ('unused_shapes', _check_unused_shapes),
+    ('null_headsigns', _check_null_headsigns)
+]
+
+
+def run_columnar_checks(feed, problems):
+    '''Run every check that works on the columns of a feed.
+
+    Args:
+        feed (ColumnarFeed): the loaded feed.
+        problems (transitfeed.ProblemReporter): reporter for the problems found.
+    '''
+
+    for name, check in COLUMNAR_CHECKS:
+        check(feed, problems)
@@ -0,0 +1,100 @@
+'''Reuse one ssh connection per host for all the Fab classes.
+
+Fabric keeps a connection per host string and runs every command as a new
+channel of it, so commands after the first don't pay for a handshake.  This
+module makes the Fab classes share those connections: the readiness probe
+(retrying while an instance starts up) runs once per host, dead connections are
+dropped so fabric reconnects, keepalives stop idle connections from timing out
+during long local steps and the connections are closed on exit.
+'''
+
+import atexit
+import time
+
+from fabric.api import env
+from fabric.exceptions import NetworkError
+from fabric.network import disconnect_all, normalize_to_string
+from fabric.state import connections
+
+
+DEFAULT_KEEPALIVE = 30
+MAX_PROBE_RETRIES = 6
+PROBE_RETRY_SECONDS = 10
+
+# host strings that passed the readiness probe
+_ready_hosts = set()
+
+
+def get_keepalive(aws_conf):
+    '''Get the seconds between ssh keepalives.
+
+    Args:
+        aws_conf (ConfigParser.ConfigParser): the aws config.
+
+    Returns:
+        int: the `ssh_keepalive` setting, or `DEFAULT_KEEPALIVE` if not set.
+    '''
+
+    if aws_conf.has_option('DEFAULT', 'ssh_keepalive'):
+        keepalive = aws_conf.get('DEFAULT', 'ssh_keepalive').strip()
+        if keepalive:
+            return int(keepalive)
+    return DEFAULT_KEEPALIVE
+
+
+def _is_active(host_string):
+    client = dict.get(connections, normalize_to_string(host_string))
+    if client is None:
+        return False
+    transport = client.get_transport()
+    return transport is not None and transport.is_active()
+
+
+def connect(user, host_name, aws_conf, probe):
+    '''Make fabric use the pooled connection to a host.
+
+    Args:
+        user (string): the user to connect as.
+        host_name (string): ec2 public dns name.
+        aws_conf (ConfigParser.ConfigParser): the aws config.
+        probe (function): a command to run to check the connection, only run the
+            first time a host is connected to.
+    '''
+
+    host_string = '{0}@{1}'.format(user, host_name)
+    env.host_string = host_string
+    env.key_filename = [aws_conf.get('DEFAULT', 'key_filename')]
+    env.keepalive = get_keepalive(aws_conf)
+
+    if host_string in _ready_hosts:
+        if host_string in connections and not _is_active(host_string):
+            # fabric only reconnects hosts it has no connection for
+            print('SSH connection to {0} was lost, reconnecting'.format(host_name))
+            connections[host_string].close()
+            del connections[host_string]
+        return
+
+    num_retries = 0
+    while True:
+        try:
+            # SSH into the box here.
+            probe()
+            break
+        except NetworkError as e:
+            print(e)
+            if num_retries > MAX_PROBE_RETRIES:
+                raise Exception('Maximum Number of SSH Retries Hit.  Did EC2 instance get configured with ssh correctly?')
+            num_retries += 1
+            print('SSH failed (the system may still be starting up), waiting 10 seconds...')
+            time.sleep(PROBE_RETRY_SECONDS)
+    _ready_hosts.add(host_string)
+
+
+def disconnect():
+    '''Close all the pooled connections.'''
+
+    disconnect_all()
+    _ready_hosts.clear()
+
+
+atexit.register(disconnect)
@@ -0,0 +1,362 @@
+'''Delta transfer of GTFS files with rsync style block checksums.
+
+The server keeps the uncompressed tables of the last uploaded GTFS file.  The
+block checksums of those tables are compared locally with a rolling checksum
+of the new tables, so only the changed parts are sent.  The server then
+rebuilds and checks the tables and zips them.
+
+This module only uses the standard library because it is also uploaded to the
+server and run there:
+
+    python gtfs_delta.py signatures <tables dir> <signatures file>
+    python gtfs_delta.py apply <delta file> <tables dir> <gtfs zip>
+    python gtfs_delta.py unpack <gtfs zip> <tables dir>
+'''
+
+import hashlib
+import json
+import math
+import os
+import shutil
+import sys
+import zipfile
+import zlib
+
+
+MIN_BLOCK_SIZE = 700
+MAX_BLOCK_SIZE = 128 * 1024
+READ_SIZE = 1024 * 1024
+ADLER_MOD = 65521
+
+OP_COPY = 0
+OP_DATA = 1
+
+
+def table_file_name(member_name):
+    '''Get the file name a zip member is kept as in the tables folder.'''
+
+    return member_name.replace('/', '__')
+
+
+def zip_members(zf):
+    '''Get the names of the files in a zip, in order, without folders.'''
+
+    return [info.filename for info in zf.infolist() if not info.filename.endswith('/')]
+
+
+def block_size_for(size):
+    '''Choose the block size for a file (about the square root of its size, like rsync).'''
+
+    return min(MAX_BLOCK_SIZE, max(MIN_BLOCK_SIZE, int(math.sqrt(size)) // 8 * 8))
+
+
+def weak_checksum(block):
+    '''The rolling checksum of a block of bytes (adler-32, like rsync's).'''
+
+    return zlib.adler32(bytes(block)) & 0xffffffff
+
+
+def strong_checksum(block):
+    return hashlib.md5(block).hexdigest()
+
+
+def file_signature(filename):
+    '''Get the block checksums of a file.
+
+    Returns:
+        dict: size, sha256, block_size and the [weak, strong] checksums of each block.
+    '''
+
+    size = os.path.getsize(filename)
+    block_size = block_size_for(size)
+    sha = hashlib.sha256()
+    blocks = []
+    with open(filename, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            sha.update(block)
+            blocks.append([weak_checksum(block), strong_checksum(block)])
+    return dict(size=size, sha256=sha.hexdigest(), block_size=block_size, blocks=blocks)
+
+
+def write_signatures(tables_dir, signatures_filename):
+    '''Write the block checksums of every table in the tables folder as json.'''
+
+    signatures = dict()
+    for name in os.listdir(tables_dir):
+        signatures[name] = file_signature(os.path.join(tables_dir, name))
+    with open(signatures_filename, 'w') as f:
+        json.dump(signatures, f)
+
+
+def table_delta(data, signature):
+    '''Find the parts of a table that are in the old table with the given signature.
+
+    Args:
+        data (bytearray): the new table.
+        signature (dict): the result of `file_signature` for the old table.
+
+    Returns:
+        list: ops, [OP_COPY, first block, number of blocks] to copy blocks of the old
+            table or [OP_DATA, start, end] to send data[start:end].
+    '''
+
+    block_size = signature['block_size']
+    blocks = signature['blocks']
+    tail_size = signature['size'] % block_size
+    num_full_blocks = len(blocks) - (1 if tail_size else 0)
+
+    lookup = dict()
+    for block, (weak, strong) in enumerate(blocks[:num_full_blocks]):
+        lookup.setdefault(weak, []).append(block)
+
+    ops = []
+
+    def add_copy(block):
+        if ops and ops[-1][0] == OP_COPY and ops[-1][1] + ops[-1][2] == block:
+            ops[-1][2] += 1
+        else:
+            ops.append([OP_COPY, block, 1])
+
+    n = len(data)
+    literal_start = 0
+    i = 0
+    a = b = None
+    while i + block_size <= n:
+        if a is None:
+            weak = weak_checksum(data[i:i + block_size])
+            a = weak & 0xffff
+            b = weak >> 16
+        match = None
+        candidates = lookup.get(a | (b << 16))
+        if candidates:
+            strong = strong_checksum(bytes(data[i:i + block_size]))
+            for block in candidates:
+                if blocks[block][1] == strong:
+                    match = block
+                    break
+        if match is not None:
+            if literal_start < i:
+                ops.append([OP_DATA, literal_start, i])
+            add_copy(match)
+            i += block_size
+            literal_start = i
+            a = b = None
+        else:
+            # roll the checksum forward by one byte
+            if i + block_size < n:
+                a = (a - data[i] + data[i + block_size]) % ADLER_MOD
+                b = (b - block_size * data[i] + a - 1) % ADLER_MOD
+            i += 1
+
+    # the last block of the old table is shorter than the others
+    if (tail_size and
+            n - tail_size >= literal_start and
+            strong_checksum(bytes(data[n - tail_size:])) == blocks[-1][1]):
+        if literal_start < n - tail_size:
+            ops.append([OP_DATA, literal_start, n - tail_size])
+        add_copy(len(blocks) - 1)
+        literal_start = n
+
+    if literal_start < n:
+        ops.append([OP_DATA, literal_start, n])
+    return ops
+
+
+def write_delta(zip_filename, signatures, delta_filename):
+    '''Write the delta that turns the tables on the server into the tables of a zip.
+
+    The delta is a zlib compressed stream of a json line with the member names,
+    then a json line for each table followed by the data of its OP_DATA ops.
+
+    Args:
+        zip_filename (string): the new GTFS zip.
+        signatures (dict): block checksums of the tables on the server, by table file name.
+        delta_filename (string): where to write the delta.
+
+    Returns:
+        dict: number of tables that are the same, changed or new.
+    '''
+
+    counts = dict(same=0, delta=0, new=0)
+    compressor = zlib.compressobj(9)
+    with zipfile.ZipFile(zip_filename) as zf, open(delta_filename, 'wb') as out:
+
+        def write(data):
+            out.write(compressor.compress(data))
+
+        def write_line(obj):
+            write(json.dumps(obj).encode('utf-8') + b'\n')
+
+        members = zip_members(zf)
+        write_line(dict(members=members))
+        for member in members:
+            data = bytearray(zf.read(member))
+            sha256 = hashlib.sha256(data).hexdigest()
+            signature = signatures.get(table_file_name(member))
+            if signature is None:
+                source = 'new'
+                ops = [[OP_DATA, 0, len(data)]]
+            elif signature['sha256'] == sha256:
+                source = 'same'
+                ops = []
+            else:
+                source = 'delta'
+                ops = table_delta(data, signature)
+            counts[source] += 1
+
+            entry_ops = []
+            for op in ops:
+                if op[0] == OP_COPY:
+                    entry_ops.append(op)
+                else:
+                    entry_ops.append([OP_DATA, op[2] - op[1]])
+            write_line(dict(name=member,
+                            sha256=sha256,
+                            size=len(data),
+                            source=source,
+                            block_size=signature['block_size'] if signature else None,
+                            ops=entry_ops))
+            for op in ops:
+                if op[0] == OP_DATA:
+                    write(bytes(data[op[1]:op[2]]))
+
+        out.write(compressor.flush())
+    return counts
+
+
+class _DeltaReader:
+    '''Read lines and bytes from a zlib compressed file.'''
+
+    def __init__(self, filename):
+        self._file = open(filename, 'rb')
+        self._decompressor = zlib.decompressobj()
+        self._buffer = b''
+
+    def _fill(self):
+        compressed = self._file.read(READ_SIZE)
+        if compressed:
+            self._buffer += self._decompressor.decompress(compressed)
+        else:
+            self._buffer += self._decompressor.flush()
+        return bool(compressed)
+
+    def readline(self):
+        while b'\n' not in self._buffer:
+            if not self._fill():
+                break
+        line, sep, self._buffer = self._buffer.partition(b'\n')
+        return line
+
+    def read(self, size):
+        while len(self._buffer) < size:
+            if not self._fill():
+                break
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def close(self):
+        self._file.close()
+
+
+def _replace_dir(new_dir, old_dir):
+    if os.path.exists(old_dir):
+        shutil.rmtree(old_dir)
+    os.rename(new_dir, old_dir)
+
+
+def _zip_tables(members, tables_dir, zip_filename):
+    '''Zip the tables and check the zip.'''
+
+    tmp_filename = zip_filename + '.tmp'
+    with zipfile.ZipFile(tmp_filename, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for member in members:
+            zf.write(os.path.join(tables_dir, table_file_name(member)), member)
+    with zipfile.ZipFile(tmp_filename) as zf:
+        if zf.testzip() is not None:
+            raise Exception('Rebuilt GTFS zip is corrupt.')
+    if os.path.exists(zip_filename):
+        os.remove(zip_filename)
+    os.rename(tmp_filename, zip_filename)
+
+
+def apply_delta(delta_filename, tables_dir, zip_filename):
+    '''Rebuild the new tables from the old ones and a delta, check them and zip them.
+
+    The tables folder is only replaced if every table has the expected sha256.
+    '''
+
+    new_dir = tables_dir + '.new'
+    if os.path.exists(new_dir):
+        shutil.rmtree(new_dir)
+    os.makedirs(new_dir)
+
+    reader = _DeltaReader(delta_filename)
+    try:
+        members = json.loads(reader.readline().decode('utf-8'))['members']
+        for member in members:
+            entry = json.loads(reader.readline().decode('utf-8'))
+            file_name = table_file_name(entry['name'])
+            old_filename = os.path.join(tables_dir, file_name)
+            new_filename = os.path.join(new_dir, file_name)
+            sha = hashlib.sha256()
+            if entry['source'] == 'same':
+                shutil.copyfile(old_filename, new_filename)
+                with open(new_filename, 'rb') as f:
+                    for block in iter(lambda: f.read(READ_SIZE), b''):
+                        sha.update(block)
+            else:
+                old = open(old_filename, 'rb') if entry['source'] == 'delta' else None
+                with open(new_filename, 'wb') as out:
+                    for op in entry['ops']:
+                        if op[0] == OP_COPY:
+                            old.seek(op[1] * entry['block_size'])
+                            data = old.read(op[2] * entry['block_size'])
+                        else:
+                            data = reader.read(op[1])
+                        sha.update(data)
+                        out.write(data)
+                if old:
+                    old.close()
+            if sha.hexdigest() != entry['sha256']:
+                raise Exception('Rebuilt {0} does not match, sha256 {1} instead of {2}'.format(
+                    entry['name'], sha.hexdigest(), entry['sha256']))
+    finally:
+        reader.close()
+
+    _zip_tables(members, new_dir, zip_filename)
+    _replace_dir(new_dir, tables_dir)
+
+
+def unpack(zip_filename, tables_dir):
+    '''Keep the uncompressed tables of a zip in the tables folder.'''
+
+    new_dir = tables_dir + '.new'
+    if os.path.exists(new_dir):
+        shutil.rmtree(new_dir)
+    os.makedirs(new_dir)
+    with zipfile.ZipFile(zip_filename) as zf:
+        for member in zip_members(zf):
+            with zf.open(member) as src, \
+                    open(os.path.join(new_dir, table_file_name(member)), 'wb') as dst:
+                shutil.copyfileobj(src, dst, READ_SIZE)
+    _replace_dir(new_dir, tables_dir)
+
+
+def main(args):
+    if len(args) == 3 and args[0] == 'signatures':
+        write_signatures(args[1], args[2])
+    elif len(args) == 4 and args[0] == 'apply':
+        apply_delta(args[1], args[2], args[3])
+    elif len(args) == 3 and args[0] == 'unpack':
+        unpack(args[1], args[2])
+    else:
+        print(__doc__)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,175 @@
+import hashlib
+import json
+import os
+import shutil
+
+import requests
+
+from oba_rvtd_deployer import DL_DIR
+
+
+MANIFEST_FILE = os.path.join(DL_DIR, 'gtfs_manifest.json')
+PARTIAL_FILE = os.path.join(DL_DIR, 'gtfs_download.part')
+CHUNK_SIZE = 256 * 1024
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+
+def file_sha256(filename, initial=None):
+    '''Calculate the SHA-256 digest of a file.
+
+    Args:
+        filename (string): the file to hash.
+        initial (hashlib hash, default=None): a hash object to continue updating.
+
+    Returns:
+        hashlib hash: the updated hash object.
+    '''
+
+    sha = initial or hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(WRITE_BUFFER_SIZE), b''):
+            sha.update(block)
+    return sha
+
+
+def read_manifest():
+    '''Read the download manifest.
+
+    Returns:
+        dict: the manifest (empty if no feed has been downloaded yet).
+    '''
+
+    if not os.path.exists(MANIFEST_FILE):
+        return dict()
+
+    with open(MANIFEST_FILE) as f:
+        try:
+            return json.load(f)
+        except ValueError:
+            return dict()
+
+
+def write_manifest(manifest):
+    '''Write the download manifest, replacing the old one in a single step.
+
+    Args:
+        manifest (dict): the manifest to save.
+    '''
+
+    tmp_file = MANIFEST_FILE + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    if os.path.exists(MANIFEST_FILE):
+        os.remove(MANIFEST_FILE)
+    os.rename(tmp_file, MANIFEST_FILE)
+
+
+def update_manifest(**kwargs):
+    '''Add or update keys of the download manifest.
+    '''
+
+    manifest = read_manifest()
+    manifest.update(kwargs)
+    write_manifest(manifest)
+    return manifest
+
+
+def download_feed(url, dest_filename, conditional=True):
+    '''Download a feed unless the server or the content hash says it is unchanged.
+
+    Sends If-None-Match/If-Modified-Since when a previous download of the same url
+    is recorded in the manifest and resumes an interrupted transfer with a Range
+    request when the server supports it.
+
+    Args:
+        url (string): the url of the feed.
+        dest_filename (string): where the feed should be saved.
+        conditional (boolean, default=True): whether to send conditional request headers.
+
+    Returns:
+        tuple: (boolean, dict) whether the feed content changed and the manifest.
+    '''
+
+    manifest = read_manifest()
+    previous_file = manifest.get('file_name')
+    have_previous = (conditional and
+                     manifest.get('url') == url and
+                     previous_file is not None and
+                     os.path.exists(previous_file))
+
+    headers = dict()
+    if have_previous:
+        if manifest.get('etag'):
+            headers['If-None-Match'] = manifest['etag']
+        if manifest.get('last_modified'):
+            headers['If-Modified-Since'] = manifest['last_modified']
+
+    # resume a partial download if the server gave us a validator for it
+    partial = manifest.get('partial') or dict()
+    partial_validator = partial.get('etag') or partial.get('last_modified')
+    resume_from = 0
+    if os.path.exists(PARTIAL_FILE) and partial.get('url') == url and partial_validator:
+        resume_from = os.path.getsize(PARTIAL_FILE)
+        headers['Range'] = 'bytes={0}-'.format(resume_from)
+        headers['If-Range'] = partial_validator
+
+    r = requests.get(url, headers=headers, stream=True)
+
+    if r.status_code == 416:
+        # the partial file is unusable, start over
+        r.close()
+        os.remove(PARTIAL_FILE)
+        return download_feed(url, dest_filename, conditional)
+
+    if r.status_code == 304:
+        r.close()
+        print('GTFS not modified on server')
+        if os.path.abspath(previous_file) != os.path.abspath(dest_filename):
+            shutil.copyfile(previous_file, dest_filename)
+        if file_sha256(dest_filename).hexdigest() != manifest.get('sha256'):
+            print('Local copy of GTFS does not match manifest, downloading again')
+            return download_feed(url, dest_filename, conditional=False)
+        manifest = update_manifest(file_name=dest_filename)
+        return False, manifest
+
+    r.raise_for_status()
+
+    sha = hashlib.sha256()
+    if r.status_code == 206 and resume_from > 0:
+        print('Resuming GTFS download at byte {0}'.format(resume_from))
+        file_sha256(PARTIAL_FILE, sha)
+        mode = 'ab'
+    else:
+        mode = 'wb'
+
+    # remember how to resume this transfer if it gets interrupted
+    manifest['partial'] = dict(url=url,
+                               etag=r.headers.get('ETag'),
+                               last_modified=r.headers.get('Last-Modified'))
+    write_manifest(manifest)
+
+    with open(PARTIAL_FILE, mode, WRITE_BUFFER_SIZE) as f:
+        for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+            if chunk:  # filter out keep-alive new chunks
+                f.write(chunk)
+                sha.update(chunk)
+
+    if os.path.exists(dest_filename):
+        os.remove(dest_filename)
+    os.rename(PARTIAL_FILE, dest_filename)
+
+    digest = sha.hexdigest()
+    changed = digest != manifest.get('sha256')
+    if not changed:
+        print('Downloaded GTFS is identical to the previous download')
+
+    manifest.pop('partial', None)
+    manifest.update(url=url,
+                    file_name=dest_filename,
+                    sha256=digest,
+                    size=os.path.getsize(dest_filename),
+                    etag=r.headers.get('ETag'),
+                    last_modified=r.headers.get('Last-Modified'))
+    write_manifest(manifest)
+
+    return changed, manifest
@@ -0,0 +1,508 @@
+import argparse
+from collections import defaultdict
+import datetime
+import glob
+import hashlib
+import heapq
+from itertools import groupby
+import json
+import math
+import os
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+import tempfile
+import zipfile
+
+from oba_rvtd_deployer import DL_DIR, REPORTS_DIR
+from oba_rvtd_deployer.columnar import (NO_VALUE,
+                                        parse_date,
+                                        parse_time,
+                                        read_table,
+                                        zip_tables)
+from oba_rvtd_deployer.feedvalidator import ServiceDateMasks
+
+
+DEFAULT_WINDOW = 100000
+# sorted runs merged at a time, each one is an open temporary file
+MAX_MERGE_RUNS = 64
+
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+TABLE_KEYS = {
+    'stops.txt': ['stop_id'],
+    'routes.txt': ['route_id'],
+    'trips.txt': ['trip_id'],
+    'calendar.txt': ['service_id'],
+    'calendar_dates.txt': ['service_id', 'date']
+}
+
+# changes to these only change how things are shown, not where or when service runs
+COSMETIC_FIELDS = {
+    'stops.txt': set(['stop_name', 'stop_desc', 'stop_url', 'stop_code', 'tts_stop_name']),
+    'routes.txt': set(['route_short_name', 'route_long_name', 'route_desc', 'route_url',
+                       'route_color', 'route_text_color', 'route_sort_order']),
+    'trips.txt': set(['trip_headsign', 'trip_short_name']),
+    'calendar.txt': set(),
+    'calendar_dates.txt': set()
+}
+
+COORDINATE_FIELDS = set(['stop_lat', 'stop_lon'])
+TIME_FIELDS = set(['arrival_time', 'departure_time'])
+
+
+def _normalize(field, value):
+    '''Strip a value and give numbers one format so that only real changes differ.'''
+
+    value = value.strip()
+    if field in COORDINATE_FIELDS:
+        try:
+            return '{0:.6f}'.format(float(value))
+        except ValueError:
+            return value
+    if field in TIME_FIELDS:
+        seconds = parse_time(value)
+        if seconds is not None and seconds != NO_VALUE:
+            return str(seconds)
+    return value
+
+
+def _int_or_zero(value):
+    try:
+        return int(value)
+    except ValueError:
+        return 0
+
+
+def table_rows(zf, names, table):
+    '''Stream the rows of a table as dicts of normalized values.'''
+
+    if table not in names:
+        return
+    for row_num, row, headers in read_table(zf, names[table]):
+        yield dict((h, _normalize(h, v)) for h, v in zip(headers, row))
+
+
+def _spill(items):
+    '''Write sorted items to a temporary file and return an iterator over it.'''
+
+    f = tempfile.TemporaryFile()
+    for item in items:
+        pickle.dump(item, f, 2)
+    f.seek(0)
+
+    def read_run():
+        try:
+            while True:
+                yield pickle.load(f)
+        except EOFError:
+            f.close()
+
+    return read_run()
+
+
+def sorted_stream(items, key, window=DEFAULT_WINDOW):
+    '''Sort a stream keeping at most `window` items in memory.
+
+    Items are sorted in chunks of `window` that are spilled to temporary files and
+    then merged, so memory use does not depend on the size of the table.  When
+    there are MAX_MERGE_RUNS chunks they are merged into one before going on.
+
+    Args:
+        items (iterable): the items to sort.
+        key (function): returns the sort key of an item.
+        window (int, default=DEFAULT_WINDOW): maximum number of items kept in memory.
+
+    Returns:
+        generator: (key, item) tuples sorted by key, in input order for equal keys.
+    '''
+
+    runs = []
+    chunk = []
+    for seq, item in enumerate(items):
+        # the sequence number keeps the sort stable and items from being compared
+        chunk.append((key(item), seq, item))
+        if len(chunk) >= window:
+            chunk.sort()
+            runs.append(_spill(chunk))
+            chunk = []
+            if len(runs) >= MAX_MERGE_RUNS:
+                runs = [_spill(heapq.merge(*runs))]
+    chunk.sort()
+    runs.append(iter(chunk))
+
+    for k, seq, item in heapq.merge(*runs):
+        yield k, item
+
+
+def merge_join(old_stream, new_stream):
+    '''Join two streams of (key, item) that are sorted by key.
+
+    Returns:
+        generator: (key, old item or None, new item or None) tuples.
+    '''
+
+    old_stream = iter(old_stream)
+    new_stream = iter(new_stream)
+    old = next(old_stream, None)
+    new = next(new_stream, None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and old[0] < new[0]):
+            yield old[0], old[1], None
+            old = next(old_stream, None)
+        elif old is None or new[0] < old[0]:
+            yield new[0], None, new[1]
+            new = next(new_stream, None)
+        else:
+            yield old[0], old[1], new[1]
+            old = next(old_stream, None)
+            new = next(new_stream, None)
+
+
+def _table_key(table):
+    fields = TABLE_KEYS[table]
+    return lambda row: tuple(row.get(f, '') for f in fields)
+
+
+def sorted_table(zf, names, table, window):
+    '''Stream (key, row) of a table sorted by its key fields.'''
+
+    return sorted_stream(table_rows(zf, names, table), _table_key(table), window)
+
+
+def trip_stop_times(zf, names, window):
+    '''Stream a digest of the stop times of each trip, sorted by trip_id.
+
+    Returns:
+        generator: ((trip_id,), dict) tuples with the number of stop times and a
+            digest of their stops, times and pickup/drop off types.
+    '''
+
+    stop_times = sorted_stream(table_rows(zf, names, 'stop_times.txt'),
+                               lambda r: (r.get('trip_id', ''),
+                                          _int_or_zero(r.get('stop_sequence', ''))),
+                               window)
+    for trip_id, group in groupby(stop_times, lambda item: item[0][0]):
+        sha = hashlib.sha1()
+        count = 0
+        for key, row in group:
+            count += 1
+            line = '|'.join([row.get('stop_id', ''),
+                             row.get('arrival_time', ''),
+                             row.get('departure_time', ''),
+                             row.get('pickup_type', ''),
+                             row.get('drop_off_type', '')]) + '\n'
+            if not isinstance(line, bytes):
+                line = line.encode('utf-8')
+            sha.update(line)
+        yield (trip_id,), dict(stop_times=sha.hexdigest(), stop_time_count=str(count))
+
+
+def sorted_trips(zf, names, window):
+    '''Stream (key, trip) sorted by trip_id, with the digest of each trip's stop times.'''
+
+    joined = merge_join(sorted_table(zf, names, 'trips.txt', window),
+                        trip_stop_times(zf, names, window))
+    for key, trip, stop_times in joined:
+        if trip is None:
+            # stop times of a trip that isn't in trips.txt
+            continue
+        trip = dict(trip)
+        trip.update(stop_times or dict(stop_times='', stop_time_count='0'))
+        yield key, trip
+
+
+def trip_runs(zf, names):
+    '''Get the number of times each trip of frequencies.txt runs on a day.'''
+
+    runs = defaultdict(int)
+    for row in table_rows(zf, names, 'frequencies.txt'):
+        start = parse_time(row.get('start_time', ''))
+        end = parse_time(row.get('end_time', ''))
+        headway = _int_or_zero(row.get('headway_secs', ''))
+        if start in (None, NO_VALUE) or end in (None, NO_VALUE) or headway <= 0 or end <= start:
+            continue
+        runs[row.get('trip_id', '')] += int(math.ceil((end - start) / float(headway)))
+    return runs
+
+
+class ServiceCalendars:
+    '''The calendar and calendar_dates of a feed, by service_id.
+
+    Provides `GetServiceCalendars`, so that feedvalidator.ServiceDateMasks can
+    compute the dates each service is active on.
+    '''
+
+    def __init__(self):
+        self.calendar = dict()
+        self.exceptions = defaultdict(list)
+
+    def add_calendar(self, row):
+        start_date = parse_date(row.get('start_date', ''))
+        end_date = parse_date(row.get('end_date', ''))
+        weekdays = tuple(row.get(d, '') == '1' for d in WEEKDAYS)
+        self.calendar[row.get('service_id', '')] = (start_date, end_date, weekdays)
+
+    def add_calendar_date(self, row):
+        date = parse_date(row.get('date', ''))
+        exception_type = _int_or_zero(row.get('exception_type', ''))
+        if date is not None and exception_type in (1, 2):
+            self.exceptions[row.get('service_id', '')].append((date, exception_type))
+
+    def date_range(self):
+        '''Get the first and last service date (Nones if there are none).'''
+
+        dates = []
+        for start_date, end_date, weekdays in self.calendar.values():
+            if start_date and end_date:
+                dates.extend([start_date, end_date])
+        for exceptions in self.exceptions.values():
+            dates.extend([date for date, exception_type in exceptions if exception_type == 1])
+        if not dates:
+            return None, None
+        return min(dates), max(dates)
+
+    def GetServiceCalendars(self):
+        for service_id in set(self.calendar.keys()).union(self.exceptions.keys()):
+            start_date, end_date, weekdays = self.calendar.get(service_id,
+                                                               (None, None, (False,) * 7))
+            yield service_id, start_date, end_date, weekdays, self.exceptions.get(service_id, [])
+
+
+def trips_per_day(calendars, service_trips, date_start, date_end):
+    '''Count the trips of each day in [date_start, date_end).
+
+    Returns:
+        list: number of trips on each day.
+    '''
+
+    num_days = max(0, (date_end - date_start).days)
+    day_trips = [0] * num_days
+    for service_id, mask in ServiceDateMasks(calendars, date_start, date_end).items():
+        trips = service_trips.get(service_id, 0)
+        i = 0
+        while mask and trips:
+            if mask & 1:
+                day_trips[i] += trips
+            mask >>= 1
+            i += 1
+    return day_trips
+
+
+class FeedDiffWriter:
+    '''Write the changes between two feeds as JSON Lines and count them.'''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, 'w')
+        self.counts = defaultdict(lambda: defaultdict(int))
+        self.structural = False
+
+    def write(self, record):
+        self._file.write(json.dumps(record, sort_keys=True, default=str))
+        self._file.write('\n')
+
+    def change(self, table, change, key, fields=None, cosmetic=False):
+        '''Record an added, removed or changed row of a table.'''
+
+        self.counts[table][change] += 1
+        if change == 'changed' and cosmetic:
+            self.counts[table]['cosmetic'] += 1
+        else:
+            self.structural = True
+        record = dict(table=table, change=change, key=list(key))
+        if fields:
+            record['fields'] = fields
+        if change == 'changed':
+            record['cosmetic'] = cosmetic
+        self.write(record)
+
+    def close(self):
+        self._file.close()
+
+
+def diff_rows(table, joined, writer, on_old=None, on_new=None):
+    '''Record the differences of a table from a merge join of the old and new rows.
+
+    Args:
+        table (string): the table name.
+        joined (iterable): (key, old row, new row) tuples from `merge_join`.
+        writer (FeedDiffWriter): where the changes are recorded.
+        on_old (function, default=None): called with each row of the old feed.
+        on_new (function, default=None): called with each row of the new feed.
+    '''
+
+    for key, old, new in joined:
+        if old is not None and on_old:
+            on_old(old)
+        if new is not None and on_new:
+            on_new(new)
+
+        if old is None:
+            writer.change(table, 'added', key)
+        elif new is None:
+            writer.change(table, 'removed', key)
+        else:
+            fields = dict()
+            for field in set(old.keys()).union(new.keys()):
+                if old.get(field, '') != new.get(field, ''):
+                    fields[field] = [old.get(field), new.get(field)]
+            if fields:
+                cosmetic = set(fields.keys()).issubset(COSMETIC_FIELDS[table])
+                writer.change(table, 'changed', key, fields, cosmetic)
+
+
+def diff_feeds(old_filename, new_filename, window=DEFAULT_WINDOW, output_filename=None):
+    '''Compare two GTFS zips.
+
+    Every table is streamed, sorted by its key with at most `window` rows in
+    memory at a time, and merge joined with the same table of the other feed.
+    Only the calendars and the trip count of each service are kept for the whole
+    feed, to count the trips of each day.
+
+    Args:
+        old_filename (string): the older GTFS zip.
+        new_filename (string): the newer GTFS zip.
+        window (int, default=DEFAULT_WINDOW): maximum number of rows of a table to sort in memory.
+        output_filename (string, default=None): where to write each change as JSON Lines,
+            defaults to a file in the reports folder.
+
+    Returns:
+        dict: summary of the changes.
+    '''
+
+    if not output_filename:
+        output_filename = os.path.join(REPORTS_DIR, 'gtfs_diff_{0}_{1}.jsonl'.format(
+            os.path.splitext(os.path.basename(old_filename))[0],
+            os.path.splitext(os.path.basename(new_filename))[0]))
+
+    writer = FeedDiffWriter(output_filename)
+    calendars = [ServiceCalendars(), ServiceCalendars()]
+    service_trips = [defaultdict(int), defaultdict(int)]
+
+    with zipfile.ZipFile(old_filename) as old_zf, zipfile.ZipFile(new_filename) as new_zf:
+        zfs = [old_zf, new_zf]
+        names = [zip_tables(old_zf), zip_tables(new_zf)]
+        runs = [trip_runs(old_zf, names[0]), trip_runs(new_zf, names[1])]
+
+        def sorted_tables(table):
+            return [sorted_table(zfs[i], names[i], table, window) for i in range(2)]
+
+        def count_trips(i):
+            def count(trip):
+                service_trips[i][trip.get('service_id', '')] += runs[i].get(trip.get('trip_id', ''), 1)
+            return count
+
+        for table in ['stops.txt', 'routes.txt']:
+            diff_rows(table, merge_join(*sorted_tables(table)), writer)
+
+        diff_rows('calendar.txt',
+                  merge_join(*sorted_tables('calendar.txt')),
+                  writer,
+                  calendars[0].add_calendar,
+                  calendars[1].add_calendar)
+        diff_rows('calendar_dates.txt',
+                  merge_join(*sorted_tables('calendar_dates.txt')),
+                  writer,
+                  calendars[0].add_calendar_date,
+                  calendars[1].add_calendar_date)
+        diff_rows('trips.txt',
+                  merge_join(sorted_trips(old_zf, names[0], window),
+                             sorted_trips(new_zf, names[1], window)),
+                  writer,
+                  count_trips(0),
+                  count_trips(1))
+
+    # calendar range of the whole feed
+    old_range = calendars[0].date_range()
+    new_range = calendars[1].date_range()
+    if old_range != new_range:
+        writer.structural = True
+        writer.write(dict(table='calendar', change='range', old=old_range, new=new_range))
+
+    # trips of each service day
+    days_changed = 0
+    dates = [d for d in old_range + new_range if d is not None]
+    if dates:
+        date_start = min(dates)
+        date_end = max(dates) + datetime.timedelta(days=1)
+        old_trips = trips_per_day(calendars[0], service_trips[0], date_start, date_end)
+        new_trips = trips_per_day(calendars[1], service_trips[1], date_start, date_end)
+        for i, (old_count, new_count) in enumerate(zip(old_trips, new_trips)):
+            if old_count != new_count:
+                days_changed += 1
+                writer.write(dict(table='service_day',
+                                  change='trip_count',
+                                  date=date_start + datetime.timedelta(days=i),
+                                  old=old_count,
+                                  new=new_count,
+                                  delta=new_count - old_count))
+    if days_changed:
+        writer.structural = True
+
+    writer.close()
+
+    return dict(old_feed=old_filename,
+                new_feed=new_filename,
+                tables=dict((table, dict(counts)) for table, counts in writer.counts.items()),
+                old_range=old_range,
+                new_range=new_range,
+                days_with_trip_count_changes=days_changed,
+                structural=writer.structural,
+                diff_file=output_filename)
+
+
+def print_summary(summary):
+    '''Print the summary of a feed diff.'''
+
+    print('Comparing {0} to {1}'.format(summary['old_feed'], summary['new_feed']))
+    for table in sorted(TABLE_KEYS.keys()):
+        counts = summary['tables'].get(table, dict())
+        print('{0}: {1} added, {2} removed, {3} changed ({4} cosmetic)'.format(table,
+                                                                              counts.get('added', 0),
+                                                                              counts.get('removed', 0),
+                                                                              counts.get('changed', 0),
+                                                                              counts.get('cosmetic', 0)))
+    if summary['old_range'] != summary['new_range']:
+        print('Service range changed from {0} - {1} to {2} - {3}'.format(*(summary['old_range'] +
+                                                                           summary['new_range'])))
+    print('Days with a different number of trips: {0}'.format(summary['days_with_trip_count_changes']))
+    if summary['structural']:
+        print('The feeds have structural changes')
+    elif any(summary['tables'].values()):
+        print('The feeds only have cosmetic changes')
+    else:
+        print('The feeds have no changes')
+    print('Changes written to {0}'.format(summary['diff_file']))
+
+
+def diff_gtfs():
+    '''Compare two GTFS files, by default the two most recent downloads.
+    '''
+
+    parser = argparse.ArgumentParser(description='Compare two GTFS zip files.')
+    parser.add_argument('old_feed', nargs='?', help='the older GTFS zip')
+    parser.add_argument('new_feed', nargs='?', help='the newer GTFS zip')
+    parser.add_argument('--window',
+                        type=int,
+                        default=DEFAULT_WINDOW,
+                        help='maximum number of rows of a table to sort in memory')
+    args = parser.parse_args()
+
+    if args.old_feed and args.new_feed:
+        old_feed, new_feed = args.old_feed, args.new_feed
+    elif args.old_feed or args.new_feed:
+        parser.error('give both GTFS files or neither')
+    else:
+        downloads = sorted(glob.glob(os.path.join(DL_DIR, 'google_transit_*.zip')))
+        if len(downloads) < 2:
+            raise Exception('Need two downloaded GTFS files to compare.')
+        old_feed, new_feed = downloads[-2:]
+
+    if not os.path.exists(REPORTS_DIR):
+        os.makedirs(REPORTS_DIR)
+
+    summary = diff_feeds(old_feed, new_feed, args.window)
+    print_summary(summary)
+    return summary
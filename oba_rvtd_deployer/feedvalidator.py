@@ -20,14 +20,16 @@
 For usage information run feedvalidator.py --help
 """
 
-import bisect
 import codecs
 import datetime
 from transitfeed.util import defaultdict
+import heapq
+import json
 import optparse
 import os
 import os.path
 import re
+import sqlite3
 import sys
 import time
 import transitfeed
@@ -60,6 +62,117 @@ def ProblemCountText(error_count, warning_count):
   return ' and '.join(results)
 
 
+def _ServiceCalendars(schedule):
+  """Yield (service_id, start date, end date, day_of_week, exceptions).
+
+  Dates are date objects (start and end may be None), day_of_week is a list of
+  7 flags starting on monday and exceptions a list of (date, exception_type).
+  """
+  if hasattr(schedule, 'GetServiceCalendars'):
+    for calendar in schedule.GetServiceCalendars():
+      yield calendar
+    return
+
+  for period in schedule.GetServicePeriodList():
+    start = end = None
+    if period.start_date and period.end_date:
+      start = transitfeed.DateStringToDateObject(period.start_date)
+      end = transitfeed.DateStringToDateObject(period.end_date)
+    exceptions = []
+    for date, (exception_type, _) in period.date_exceptions.items():
+      date_object = transitfeed.DateStringToDateObject(date)
+      if date_object:
+        exceptions.append((date_object, exception_type))
+    yield period.service_id, start, end, period.day_of_week, exceptions
+
+
+def ServiceDateMasks(schedule, date_start, date_end):
+  """Return a map from service_id to a bitmap of the dates it is active on.
+
+  Bit i of a bitmap is set if the service runs on date_start + i days, for the
+  dates in [date_start, date_end). Together the bitmaps form the service id x
+  date matrix.
+  """
+  num_days = (date_end - date_start).days
+  if num_days <= 0:
+    return {}
+
+  weekday_bits = [0] * 7
+  for i in range(num_days):
+    weekday_bits[(date_start.weekday() + i) % 7] |= 1 << i
+
+  masks = {}
+  for service_id, start, end, day_of_week, exceptions in \
+      _ServiceCalendars(schedule):
+    mask = 0
+    if start and end:
+      first = max(0, (start - date_start).days)
+      last = min(num_days - 1, (end - date_start).days)
+      if first <= last:
+        for weekday in range(7):
+          if day_of_week[weekday]:
+            mask |= weekday_bits[weekday]
+        mask &= ((1 << (last + 1)) - 1) & ~((1 << first) - 1)
+    for date, exception_type in exceptions:
+      i = (date - date_start).days
+      if 0 <= i < num_days:
+        if exception_type == 1:
+          mask |= 1 << i
+        else:
+          mask &= ~(1 << i)
+    masks[service_id] = mask
+  return masks
+
+
+def ServiceTripDepartureCounts(schedule):
+  """Return maps from service_id to number of trips and of departures per day."""
+  if hasattr(schedule, 'GetServiceTripDepartureCounts'):
+    return schedule.GetServiceTripDepartureCounts()
+
+  # Count the stop times of every trip in one query instead of one per trip
+  cursor = schedule._connection.cursor()
+  cursor.execute("SELECT trip_id, count(*) FROM stop_times GROUP BY trip_id")
+  stop_time_counts = dict(cursor.fetchall())
+
+  service_trips = defaultdict(lambda: 0)
+  service_departures = defaultdict(lambda: 0)
+  for trip in schedule.GetTripList():
+    trip_runs = len(trip.GetFrequencyStartTimes()) or 1
+    service_trips[trip.service_id] += trip_runs
+    service_departures[trip.service_id] += (
+        (stop_time_counts.get(trip.trip_id, 0) - 1) * trip_runs)
+  return service_trips, service_departures
+
+
+def DateTripsDeparturesList(schedule, date_start, date_end):
+  """Return a list of (date object, number of trips, number of departures).
+
+  Same as Schedule.GenerateDateTripsDeparturesList, but computed from the
+  service x date bitmaps and the per service counts.
+  """
+  masks = ServiceDateMasks(schedule, date_start, date_end)
+  service_trips, service_departures = ServiceTripDepartureCounts(schedule)
+
+  num_days = max(0, (date_end - date_start).days)
+  day_trips = [0] * num_days
+  day_departures = [0] * num_days
+  for service_id, mask in masks.items():
+    trips = service_trips.get(service_id, 0)
+    departures = service_departures.get(service_id, 0)
+    if not trips and not departures:
+      continue
+    i = 0
+    while mask:
+      if mask & 1:
+        day_trips[i] += trips
+        day_departures[i] += departures
+      mask >>= 1
+      i += 1
+
+  return [(date_start + datetime.timedelta(days=i), day_trips[i],
+           day_departures[i]) for i in range(num_days)]
+
+
 def CalendarSummary(schedule):
   today = datetime.date.today()
   summary_end_date = today + datetime.timedelta(days=60)
@@ -76,7 +189,8 @@ def CalendarSummary(schedule):
   # Get the list of trips only during the period the feed is active.
   # As such we have to check if it starts in the future and/or if
   # if it ends in less than 60 days.
-  date_trips_departures = schedule.GenerateDateTripsDeparturesList(
+  date_trips_departures = DateTripsDeparturesList(
+                              schedule,
                               max(today, start_date_object),
                               min(summary_end_date, end_date_object))
 
@@ -89,23 +203,21 @@ def CalendarSummary(schedule):
   assert start_date <= date_trips_departures[0][0].strftime("%Y%m%d")
   assert end_date >= date_trips_departures[-1][0].strftime("%Y%m%d")
 
-  # Generate a map from int number of trips in a day to a list of date objects
-  # with that many trips. The list of dates is sorted.
-  trips_dates = defaultdict(lambda: [])
-  trips = 0
-  for date, day_trips, day_departures in date_trips_departures:
-    trips += day_trips
-    trips_dates[day_trips].append(date)
-  mean_trips = trips / len(date_trips_departures)
-  max_trips = max(trips_dates.keys())
-  min_trips = min(trips_dates.keys())
+  # Reduce the trips per day to the mean, max and min and the sorted list of
+  # dates with the max and min number of trips.
+  day_trips = [day_trips for _, day_trips, _ in date_trips_departures]
+  mean_trips = sum(day_trips) / len(day_trips)
+  max_trips = max(day_trips)
+  min_trips = min(day_trips)
 
   calendar_summary = {}
   calendar_summary['mean_trips'] = mean_trips
   calendar_summary['max_trips'] = max_trips
-  calendar_summary['max_trips_dates'] = FormatDateList(trips_dates[max_trips])
+  calendar_summary['max_trips_dates'] = FormatDateList(
+      [date for date, trips, _ in date_trips_departures if trips == max_trips])
   calendar_summary['min_trips'] = min_trips
-  calendar_summary['min_trips_dates'] = FormatDateList(trips_dates[min_trips])
+  calendar_summary['min_trips_dates'] = FormatDateList(
+      [date for date, trips, _ in date_trips_departures if trips == min_trips])
   calendar_summary['date_trips_departures'] = date_trips_departures
   calendar_summary['date_summary_range'] = "%s to %s" % (
       date_trips_departures[0][0].strftime("%a %b %d"),
@@ -125,6 +237,139 @@ def FormatDateList(dates):
                       ", ".join(formatted))
 
 
+def ProblemToDict(e):
+  """Return a plain dict with the class, type and attributes of a problem."""
+  fields = {}
+  for k, v in e.__dict__.items():
+    if k.startswith('_') or k == 'type':
+      continue
+    fields[k] = v
+  return {'class_name': e.__class__.__name__,
+          'type': e.GetType(),
+          'text': e.FormatProblem(),
+          'fields': fields}
+
+
+def _EncodeUnicode(value):
+  """Encode the unicode json gives back to UTF-8 strs, like transitfeed's."""
+  if isinstance(value, unicode):
+    return value.encode('utf-8')
+  if isinstance(value, list):
+    return [_EncodeUnicode(v) for v in value]
+  if isinstance(value, dict):
+    return dict((_EncodeUnicode(k), _EncodeUnicode(v)) for k, v in value.items())
+  return value
+
+
+def ProblemFromDict(d):
+  """Rebuild a problem from the result of ProblemToDict.
+
+  The problem is the same as a freshly found one: its text fields are UTF-8
+  encoded strs, not the unicode they are read back from the json state as.
+  """
+  problem_class = getattr(transitfeed.problems, d['class_name'], None)
+  if problem_class is None:
+    # Defined by an extension that isn't loaded, keep the text at least
+    return transitfeed.problems.OtherProblem(description=_EncodeUnicode(d['text']),
+                                             type=d['type'])
+  return problem_class(type=d['type'], **_EncodeUnicode(d['fields']))
+
+
+SEVERITY_NAMES = {TYPE_ERROR: 'error',
+                  TYPE_WARNING: 'warning',
+                  TYPE_NOTICE: 'notice'}
+
+
+def ProblemRecord(e):
+  """Return a flat dict describing a problem for machine-readable output.
+
+  Every text field is unicode, problems of feeds with non-ASCII names carry
+  UTF-8 encoded strs which json can't mix with unicode.
+  """
+  value = getattr(e, 'value', None)
+  if value is not None and not isinstance(value, (str, unicode, int, long, float)):
+    value = unicode(value)
+  record = {'severity': SEVERITY_NAMES.get(e.GetType(), str(e.GetType())),
+            'type': e.__class__.__name__,
+            'file': getattr(e, 'file_name', None),
+            'row': getattr(e, 'row_num', None),
+            'field': getattr(e, 'column_name', None),
+            'value': value,
+            'text': e.FormatProblem()}
+  for k, v in record.items():
+    if isinstance(v, str):
+      record[k] = v.decode('utf-8', 'replace')
+  return record
+
+
+class JsonLinesProblemWriter(object):
+  """Write each problem as one JSON object per line."""
+
+  def __init__(self, filename, run=None):
+    self.filename = filename
+    self._run = run
+    self._file = codecs.open(filename, 'w', 'utf-8')
+
+  def Write(self, e):
+    self.WriteRecord(ProblemRecord(e))
+
+  def WriteRecord(self, record):
+    record = dict(record, run=self._run)
+    self._file.write(json.dumps(record, sort_keys=True, ensure_ascii=False))
+    self._file.write(u'\n')
+
+  def Close(self):
+    self._file.close()
+
+
+class SqliteProblemWriter(object):
+  """Insert each problem into the problems table of a SQLite database.
+
+  Every run is kept in the same database, so problem sets of different runs can
+  be compared with a query on the run column.
+  """
+
+  BATCH_SIZE = 1000
+
+  def __init__(self, filename, run):
+    self.filename = filename
+    self._run = run
+    self._batch = []
+    self._connection = sqlite3.connect(filename)
+    self._connection.execute("""CREATE TABLE IF NOT EXISTS problems (
+                                  run TEXT NOT NULL,
+                                  severity TEXT,
+                                  type TEXT,
+                                  file TEXT,
+                                  row INTEGER,
+                                  field TEXT,
+                                  value TEXT,
+                                  text TEXT)""")
+    self._connection.execute(
+        "CREATE INDEX IF NOT EXISTS problems_run ON problems (run, type)")
+    # a run that is written again replaces the old problems
+    self._connection.execute("DELETE FROM problems WHERE run = ?", (run,))
+
+  def Write(self, e):
+    self.WriteRecord(ProblemRecord(e))
+
+  def WriteRecord(self, r):
+    self._batch.append((self._run, r['severity'], r['type'], r['file'],
+                        r['row'], r['field'], r['value'], r['text']))
+    if len(self._batch) >= self.BATCH_SIZE:
+      self._Flush()
+
+  def _Flush(self):
+    self._connection.executemany(
+        "INSERT INTO problems VALUES (?, ?, ?, ?, ?, ?, ?, ?)", self._batch)
+    self._batch = []
+
+  def Close(self):
+    self._Flush()
+    self._connection.commit()
+    self._connection.close()
+
+
 class CountingConsoleProblemAccumulator(transitfeed.SimpleProblemAccumulator):
   """Accumulate problems and count errors and warnings.
 
@@ -168,38 +413,82 @@ class CountingConsoleProblemAccumulator(transitfeed.SimpleProblemAccumulator):
   def HasNotices(self):
     return self.NoticeCount()
 
+class _RetainedProblem(object):
+  """A problem kept by BoundedProblemList, ordered least significant first.
+
+  Problems compare with __cmp__, most significant first. Ties are broken by the
+  order they were reported in so the earliest reported is kept, like insort did.
+  """
+  __slots__ = ('problem', 'sequence')
+
+  def __init__(self, problem, sequence):
+    self.problem = problem
+    self.sequence = sequence
+
+  def __lt__(self, other):
+    c = cmp(self.problem, other.problem)
+    if c:
+      return c > 0
+    return self.sequence > other.sequence
+
+
 class BoundedProblemList(object):
-  """A list of one type of ExceptionWithContext objects with bounded size."""
+  """A list of one type of ExceptionWithContext objects with bounded size.
+
+  The retained problems are kept in a heap with the least significant one at
+  the root so adding a problem is O(log size_bound) and problems that are not
+  kept are not referenced.
+  """
+  __slots__ = ('_count', '_heap', '_comparable', '_size_bound')
+
   def __init__(self, size_bound):
     self._count = 0
-    self._exceptions = []
+    self._heap = []
+    self._comparable = True
     self._size_bound = size_bound
 
   def Add(self, e):
     self._count += 1
-    try:
-      bisect.insort(self._exceptions, e)
-    except TypeError:
-      # The base class ExceptionWithContext raises this exception in __cmp__
-      # to signal that an object is not comparable. Instead of keeping the most
-      # significant issue keep the first reported.
+    if self._comparable and self._heap:
+      try:
+        cmp(e, self._heap[0].problem)
+      except TypeError:
+        # The base class ExceptionWithContext raises this exception in __cmp__
+        # to signal that an object is not comparable. Instead of keeping the
+        # most significant issue keep the first reported.
+        self._comparable = False
+    if not self._comparable:
       if self._count <= self._size_bound:
-        self._exceptions.append(e)
-    else:
-      # self._exceptions is in order. Drop the least significant if the list is
-      # now too long.
-      if self._count > self._size_bound:
-        del self._exceptions[-1]
+        self._heap.append(_RetainedProblem(e, self._count))
+      return
+
+    retained = _RetainedProblem(e, self._count)
+    if len(self._heap) < self._size_bound:
+      heapq.heappush(self._heap, retained)
+    elif self._heap and self._heap[0] < retained:
+      # More significant than the least significant retained problem
+      heapq.heapreplace(self._heap, retained)
+
+  def AddDroppedCount(self, count):
+    """Count problems that were reported elsewhere but not kept."""
+    self._count += count
 
   def _GetDroppedCount(self):
-    return self._count - len(self._exceptions)
+    return self._count - len(self._heap)
+
+  def _GetProblems(self):
+    if self._comparable:
+      retained = sorted(self._heap, reverse=True)
+    else:
+      retained = self._heap
+    return [r.problem for r in retained]
 
   def __repr__(self):
-    return "<BoundedProblemList %s>" % repr(self._exceptions)
+    return "<BoundedProblemList %s>" % repr(self._GetProblems())
 
   count = property(lambda s: s._count)
   dropped_count = property(_GetDroppedCount)
-  problems = property(lambda s: s._exceptions)
+  problems = property(_GetProblems)
 
 
 class LimitPerTypeProblemAccumulator(transitfeed.ProblemAccumulatorInterface):
@@ -209,9 +498,12 @@ class LimitPerTypeProblemAccumulator(transitfeed.ProblemAccumulatorInterface):
     limit_per_type: maximum number of errors and warnings to keep of each type
     ignore_types: list of error type names that will be ignored. E.g.
                   ['ExpirationDate', 'UnusedStop']
+    writers: list of objects with a Write(problem) method, such as
+             JsonLinesProblemWriter, that every problem is passed to as it is
+             reported, whether it is kept or not.
   """
 
-  def __init__(self, limit_per_type, ignore_types=None):
+  def __init__(self, limit_per_type, ignore_types=None, writers=None):
     # {TYPE_WARNING: {"ClassName": BoundedProblemList()}}
     self._type_to_name_to_problist = {
       TYPE_WARNING: defaultdict(lambda: BoundedProblemList(limit_per_type)),
@@ -219,6 +511,7 @@ class LimitPerTypeProblemAccumulator(transitfeed.ProblemAccumulatorInterface):
       TYPE_NOTICE: defaultdict(lambda: BoundedProblemList(limit_per_type))
     }
     self._ignore_types = ignore_types or set()
+    self._writers = writers or []
 
   def HasIssues(self):
     return (self._type_to_name_to_problist[TYPE_ERROR] or
@@ -230,6 +523,8 @@ class LimitPerTypeProblemAccumulator(transitfeed.ProblemAccumulatorInterface):
   def _Report(self, e):
     if e.__class__.__name__ in self._ignore_types:
       return
+    for writer in self._writers:
+      writer.Write(e)
     self._type_to_name_to_problist[e.GetType()][e.__class__.__name__].Add(e)
 
   def ErrorCount(self):
@@ -248,6 +543,41 @@ class LimitPerTypeProblemAccumulator(transitfeed.ProblemAccumulatorInterface):
     """Return the map from class name to BoundedProblemList object."""
     return self._type_to_name_to_problist[problem_type]
 
+  def Snapshot(self):
+    """Return the kept problems and the count of each type as plain data.
+
+    The snapshot only contains lists, dicts, strings and numbers so that it can
+    be saved and later merged into another accumulator with MergeSnapshot.
+    """
+    snapshot = []
+    for problem_type in (TYPE_ERROR, TYPE_WARNING, TYPE_NOTICE):
+      name_to_problist = self._type_to_name_to_problist[problem_type]
+      for class_name in sorted(name_to_problist.keys()):
+        problist = name_to_problist[class_name]
+        snapshot.append({'type': problem_type,
+                         'class_name': class_name,
+                         'count': problist.count,
+                         'problems': [ProblemToDict(e) for e in problist.problems]})
+    return snapshot
+
+  def MergeSnapshot(self, snapshot, write=True):
+    """Add the problems of a snapshot as if they were reported here.
+
+    Only the problems kept in the snapshot are passed to the writers, pass
+    write=False when all problems of the snapshot were written elsewhere.
+    """
+    for entry in snapshot:
+      if entry['class_name'] in self._ignore_types:
+        continue
+      problist = self.ProblemList(entry['type'], _EncodeUnicode(entry['class_name']))
+      for d in entry['problems']:
+        e = ProblemFromDict(d)
+        if write:
+          for writer in self._writers:
+            writer.Write(e)
+        problist.Add(e)
+      problist.AddDroppedCount(entry['count'] - len(entry['problems']))
+
 
 class HTMLCountingProblemAccumulator(LimitPerTypeProblemAccumulator):
   def FormatType(self, level_name, class_problist):
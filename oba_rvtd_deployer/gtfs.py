@@ -3,30 +3,94 @@ try:
 except NameError: 
     pass
 from datetime import datetime
+import json
 import os
+import shutil
 import sys
+import tarfile
+import tempfile
 import time
 
-from fabric.api import env, run, put, cd
+from fabric.api import env, run, put, get, cd, settings
 from fabric.contrib.files import exists
-from fabric.exceptions import NetworkError
 from transitfeed.gtfsfactory import GetGtfsFactory
 from transitfeed.problems import ProblemReporter, TYPE_WARNING
-import requests
 import transitfeed
 
-from oba_rvtd_deployer import CONFIG_TEMPLATE_DIR, DL_DIR, REPORTS_DIR
+from oba_rvtd_deployer import CONFIG_TEMPLATE_DIR, DATA_DIR, DL_DIR, REPORTS_DIR
+from oba_rvtd_deployer.columnar import ColumnarFeed, run_columnar_checks
+from oba_rvtd_deployer import bundle_stats, delta
 from oba_rvtd_deployer.config import (get_aws_config, 
                                       get_gtfs_config,
                                       get_oba_config)
-from oba_rvtd_deployer.fab_crontab import crontab_update
+from oba_rvtd_deployer.connections import connect
+from oba_rvtd_deployer.download import download_feed, file_sha256
+from oba_rvtd_deployer.fab_crontab import crontab_remove, crontab_update
 from oba_rvtd_deployer.feedvalidator import HTMLCountingProblemAccumulator
+from oba_rvtd_deployer.hosts import HostGroup, split_host_names
 from oba_rvtd_deployer.util import FabLogger, unix_path_join, write_template
+from oba_rvtd_deployer.validation import (check_validation_result,
+                                          close_problem_writers,
+                                          get_cached_result,
+                                          get_ignore_types,
+                                          get_problem_outputs,
+                                          get_validation_loader,
+                                          get_validation_processes,
+                                          open_problem_writers,
+                                          run_schedule_checks,
+                                          store_result,
+                                          validation_cache_key)
 
 
 gtfs_file_name_raw = 'google_transit_{0}.zip'.format(datetime.now().strftime('%Y-%m-%d'))
 gtfs_file_name = os.path.join(DL_DIR, gtfs_file_name_raw)
 
+# files every successfully built OBA bundle has
+BUNDLE_REQUIRED_FILES = ['TransitGraph.obj', 'CalendarServiceData.obj']
+BUNDLE_DIGEST_FILE_NAME = 'gtfs_feed.sha256'
+
+BUNDLE_MAIN = 'org.onebusaway.transit_data_federation.bundle.FederatedTransitDataBundleCreatorMain'
+
+# records of the bundle builds on each server, see the `bundle_stats` module
+BUNDLE_STATS_DIR = os.path.join(REPORTS_DIR, 'bundle_builds')
+
+# bundles built locally or on a bundle builder, to install on the serving instances
+BUNDLE_ARTIFACT_DIR = os.path.join(DATA_DIR, 'bundles')
+BUNDLE_ARTIFACT_NAME = 'oba_bundle_{0}.tar.gz'
+
+
+def get_bundles_to_keep(gtfs_conf):
+    '''Get the number of bundles to keep for rollback.
+    
+    Args:
+        gtfs_conf (ConfigParser.ConfigParser): the gtfs config.
+        
+    Returns:
+        int: the `bundles_to_keep` setting, or 3 if not set.
+    '''
+    
+    if gtfs_conf.has_option('DEFAULT', 'bundles_to_keep'):
+        bundles_to_keep = gtfs_conf.get('DEFAULT', 'bundles_to_keep').strip()
+        if bundles_to_keep:
+            return max(1, int(bundles_to_keep))
+    return 3
+
+
+def get_bundle_builder(gtfs_conf):
+    '''Get where bundles are built, from the `bundle_builder` setting.
+    
+    Args:
+        gtfs_conf (ConfigParser.ConfigParser): the gtfs config.
+        
+    Returns:
+        string: None to build on each serving instance, 'local' to build on this
+            machine or the public dns name of the EC2 instance that builds bundles.
+    '''
+    
+    if gtfs_conf.has_option('DEFAULT', 'bundle_builder'):
+        return gtfs_conf.get('DEFAULT', 'bundle_builder').strip() or None
+    return None
+
 
 class GtfsFab:
     
@@ -35,74 +99,391 @@ class GtfsFab:
     oba_conf = get_oba_config()
     oba_base_folder = oba_conf.get('DEFAULT', 'oba_base_folder')
     user = aws_conf.get('DEFAULT', 'user')
+    log_name = 'gtfs_fab'
     data_dir = unix_path_join('/home', user, 'data')
     bundle_dir = unix_path_join(data_dir, 'bundle')
+    bundle_builds_dir = unix_path_join(bundle_dir, 'builds')
+    bundle_current = unix_path_join(bundle_dir, 'current')
+    bundle_digest_file = unix_path_join(bundle_current, BUNDLE_DIGEST_FILE_NAME)
+    bundle_stats_dir = unix_path_join(data_dir, 'bundle_stats')
     script_dir = unix_path_join('/home', user, 'scripts')
+    gtfs_tables_dir = unix_path_join(data_dir, 'gtfs_tables')
     federation_builder_folder = unix_path_join('/home', 
                                                user, 
                                                oba_base_folder, 
                                                'onebusaway-transit-data-federation-builder')
         
-    def __init__(self, host_name):
+    def __init__(self, host_name, log_filename=None):
         '''Constructor for Class.  Sets up fabric environment.
         
         Args:
             host_name (string): ec2 public dns name
+            log_filename (string, default=None): where to log the output, defaults to 
+                `gtfs_fab.log` in the reports folder.
         '''
         
-        env.host_string = '{0}@{1}'.format(self.user, host_name)
-        env.key_filename = [self.aws_conf.get('DEFAULT', 'key_filename')]
-        sys.stdout = FabLogger(os.path.join(REPORTS_DIR, 'gtfs_fab.log'))
-        
-        max_retries = 6
-        num_retries = 0
-    
-        retry = True
-        while retry:
-            try:
-                # SSH into the box here.
-                self.test_cmd()
-                retry = False
-            except NetworkError as e:
-                print(e)
-                if num_retries > max_retries:
-                    raise Exception('Maximum Number of SSH Retries Hit.  Did EC2 instance get configured with ssh correctly?')
-                num_retries += 1 
-                print('SSH failed (the system may still be starting up), waiting 10 seconds...')
-                time.sleep(10)
+        sys.stdout = FabLogger(log_filename or os.path.join(REPORTS_DIR, self.log_name + '.log'))
+        connect(self.user, host_name, self.aws_conf, self.test_cmd)
         
     def test_cmd(self):
         '''Simple command to test if connection works.
         '''
         run('uname')
         
-    def update_gtfs(self):
-        '''Uploads the downloaded gtfs zip file to the server and builds a new bundle.
+    def get_bundle_digest(self):
+        '''Get the digest of the gtfs file the current bundle was built from.
+        
+        Returns:
+            string: the sha256 hex digest, or None if unknown.
         '''
         
-        remote_gtfs_file = unix_path_join(self.data_dir, gtfs_file_name_raw)
+        if not exists(self.bundle_digest_file):
+            return None
+        return run('cat {0}'.format(self.bundle_digest_file)).strip() or None
         
-        # check if data folders exists
-        if not exists(self.data_dir):
-            run('mkdir {0}'.format(self.data_dir))
+    def get_bundles_to_keep(self):
+        '''Get the number of bundles to keep on the server for rollback.
+        
+        Returns:
+            int: the `bundles_to_keep` setting, or 3 if not set.
+        '''
+        
+        return get_bundles_to_keep(self.gtfs_conf)
+        
+    def list_bundles(self):
+        '''List the bundle versions on the server.
+        
+        Returns:
+            list: bundle versions, oldest first.
+        '''
+        
+        if not exists(self.bundle_builds_dir):
+            return []
+        return sorted(run('ls -1 {0}'.format(self.bundle_builds_dir)).split())
+        
+    def get_current_bundle(self):
+        '''Get the version of the bundle that `current` points at (None if there is none).
+        '''
+        
+        with settings(warn_only=True):
+            target = run('readlink {0}'.format(self.bundle_current))
+        if target.failed or not target.strip():
+            return None
+        return target.strip().rstrip('/').split('/')[-1]
+        
+    def validate_bundle(self, bundle_path):
+        '''Check that a bundle was completely built.
+        
+        Args:
+            bundle_path (string): the bundle folder on the server.
+            
+        Returns:
+            boolean: True if every file of BUNDLE_REQUIRED_FILES exists.
+        '''
+        
+        for required_file in BUNDLE_REQUIRED_FILES:
+            if not exists(unix_path_join(bundle_path, required_file)):
+                print('Bundle {0} is missing {1}'.format(bundle_path, required_file))
+                return False
+        return True
+        
+    def activate_bundle(self, version):
+        '''Point `current` at a bundle.
+        
+        The symlink is replaced with a rename, so the bundle path is always either
+        the old or the new bundle.  Tomcat uses the bundle after its next restart.
+        
+        Args:
+            version (string): the bundle version to use.
+        '''
+        
+        tmp_link = self.bundle_current + '.tmp'
+        run('ln -sfn {0} {1}'.format(unix_path_join('builds', version), tmp_link))
+        run('mv -T {0} {1}'.format(tmp_link, self.bundle_current))
+        print('Bundle {0} is now the current bundle'.format(version))
+        
+    def prune_bundles(self):
+        '''Remove the oldest bundles, keeping `bundles_to_keep` and the current one.
+        '''
+        
+        current = self.get_current_bundle()
+        versions = self.list_bundles()
+        for version in versions[:-self.get_bundles_to_keep()]:
+            if version != current:
+                run('rm -rf {0}'.format(unix_path_join(self.bundle_builds_dir, version)))
+        
+    def put_script(self, module, script_name):
+        '''Upload a module of this package to the scripts folder on the server.
+        
+        Args:
+            module (module): a module that only uses the standard library.
+            script_name (string): the file name to give it on the server.
             
+        Returns:
+            string: the path of the script on the server.
+        '''
+        
+        # check if script folders exists
+        if not exists(self.script_dir):
+            run('mkdir {0}'.format(self.script_dir))
+        remote_script = unix_path_join(self.script_dir, script_name)
+        put(os.path.splitext(module.__file__)[0] + '.py', remote_script)
+        return remote_script
+        
+    def fetch_bundle_stats(self):
+        '''Download the records of the bundle builds on the server that aren't downloaded yet.
+        
+        Returns:
+            string: the local folder with the records of this server.
+        '''
+        
+        local_dir = os.path.join(BUNDLE_STATS_DIR, env.host_string.split('@')[-1])
+        if not os.path.exists(local_dir):
+            os.makedirs(local_dir)
+        if not exists(self.bundle_stats_dir):
+            return local_dir
+        for filename in run('ls -1 {0}'.format(self.bundle_stats_dir)).split():
+            if filename.endswith('.json') and not os.path.exists(os.path.join(local_dir, filename)):
+                get(unix_path_join(self.bundle_stats_dir, filename), 
+                    os.path.join(local_dir, filename))
+        return local_dir
+        
+    def upload_gtfs(self, remote_gtfs_file):
+        '''Upload the gtfs zip file, sending only the changed parts of its tables when possible.
+        
+        The server keeps the uncompressed tables of the last uploaded file in
+        `gtfs_tables_dir`.  Their block checksums are compared with the new tables
+        and only the differences are uploaded, then the server rebuilds the tables,
+        checks them and zips them (see the `delta` module).  The whole file is
+        uploaded the first time or if the delta isn't smaller.
+        
+        Args:
+            remote_gtfs_file (string): where to put the gtfs zip on the server.
+        '''
+        
+        remote_script = self.put_script(delta, 'gtfs_delta.py')
+        
+        if exists(self.gtfs_tables_dir):
+            remote_signatures = unix_path_join(self.data_dir, 'gtfs_signatures.json')
+            remote_delta = unix_path_join(self.data_dir, 'gtfs.delta')
+            local_dir = tempfile.mkdtemp()
+            try:
+                local_signatures = os.path.join(local_dir, 'gtfs_signatures.json')
+                local_delta = os.path.join(local_dir, 'gtfs.delta')
+                run('python {0} signatures {1} {2}'.format(remote_script,
+                                                           self.gtfs_tables_dir,
+                                                           remote_signatures))
+                get(remote_signatures, local_signatures)
+                run('rm {0}'.format(remote_signatures))
+                with open(local_signatures) as f:
+                    signatures = json.load(f)
+                counts = delta.write_delta(gtfs_file_name, signatures, local_delta)
+                delta_size = os.path.getsize(local_delta)
+                print('GTFS tables: {same} unchanged, {delta} changed, {new} new'.format(**counts))
+                print('GTFS delta is {0} bytes, the file is {1} bytes'.format(delta_size,
+                                                                             os.path.getsize(gtfs_file_name)))
+                if delta_size < os.path.getsize(gtfs_file_name):
+                    put(local_delta, remote_delta)
+                    with settings(warn_only=True):
+                        result = run('python {0} apply {1} {2} {3}'.format(remote_script,
+                                                                           remote_delta,
+                                                                           self.gtfs_tables_dir,
+                                                                           remote_gtfs_file))
+                    run('rm {0}'.format(remote_delta))
+                    if result.succeeded:
+                        return
+                    print('Applying the GTFS delta failed, uploading the whole file')
+            finally:
+                shutil.rmtree(local_dir)
+        
         # remove old gtfs file (if needed)
         if exists(remote_gtfs_file):
             run('rm {0}'.format(remote_gtfs_file))
         
+        put(gtfs_file_name, remote_gtfs_file)
+        run('python {0} unpack {1} {2}'.format(remote_script,
+                                               remote_gtfs_file,
+                                               self.gtfs_tables_dir))
+        
+    def new_bundle_dir(self):
+        '''Create the folder for a new bundle, named by the server's time like the nightly builds.
+        
+        Returns:
+            tuple: (version, path of the folder).
+        '''
+        
+        run('mkdir -p {0}'.format(self.bundle_builds_dir))
+        version = run('date +%Y%m%d%H%M%S').strip()
+        while exists(unix_path_join(self.bundle_builds_dir, version)):
+            time.sleep(1)
+            version = run('date +%Y%m%d%H%M%S').strip()
+        staging_dir = unix_path_join(self.bundle_builds_dir, version)
+        run('mkdir {0}'.format(staging_dir))
+        return version, staging_dir
+        
+    def build_bundle(self, feed_sha256):
+        '''Upload the downloaded gtfs zip file and build a bundle from it in a new folder.
+        
+        The build is measured by the `bundle_stats` script and its record is
+        downloaded to `BUNDLE_STATS_DIR`.  The folder is removed if the build fails.
+        
+        Args:
+            feed_sha256 (string): the digest of the gtfs file, kept with the bundle.
+            
+        Returns:
+            string: the version of the new bundle.
+        '''
+        
+        remote_gtfs_file = unix_path_join(self.data_dir, gtfs_file_name_raw)
+        
+        # check if data folders exists
+        if not exists(self.data_dir):
+            run('mkdir {0}'.format(self.data_dir))
+            
         # upload new file
-        put(gtfs_file_name, 'data')
-        
-        # create new bundle
-        bundle_main = '.'.join(['org',
-                                'onebusaway',
-                                'transit_data_federation',
-                                'bundle',
-                                'FederatedTransitDataBundleCreatorMain'])
-        with cd(self.federation_builder_folder):
-            run('java -classpath .:target/* {0} {1} {2}'.format(bundle_main,
-                                                                remote_gtfs_file,
-                                                                self.bundle_dir))
+        self.upload_gtfs(remote_gtfs_file)
+        
+        version, staging_dir = self.new_bundle_dir()
+        stats_script = self.put_script(bundle_stats, 'bundle_stats.py')
+        run('mkdir -p {0}'.format(self.bundle_stats_dir))
+        stats_record = unix_path_join(self.bundle_stats_dir, version + '.json')
+        with cd(self.federation_builder_folder), settings(warn_only=True):
+            result = run('python {0} run {1} {2} {3} -- java -classpath .:target/* {4} {3} {2}'.format(
+                stats_script,
+                stats_record,
+                staging_dir,
+                remote_gtfs_file,
+                BUNDLE_MAIN))
+        self.fetch_bundle_stats()
+        if result.failed or not self.validate_bundle(staging_dir):
+            run('rm -rf {0}'.format(staging_dir))
+            raise Exception('Bundle build failed, the current bundle was kept.')
+        run('echo {0} > {1}'.format(feed_sha256,
+                                    unix_path_join(staging_dir, BUNDLE_DIGEST_FILE_NAME)))
+        
+        return version
+        
+    def update_gtfs(self, force=False):
+        '''Uploads the downloaded gtfs zip file to the server and builds a new bundle.
+        
+        The bundle is built in a new folder in `bundle/builds` and `bundle/current`
+        is switched to it once it is built, so the current bundle is untouched
+        while building and if the build fails.  Nothing is done if the current
+        bundle was already built from a file with the same content.
+        
+        Args:
+            force (boolean, default=False): build the bundle even if the gtfs is unchanged.
+            
+        Returns:
+            boolean: True if a new bundle was built.
+        '''
+        
+        feed_sha256 = file_sha256(gtfs_file_name).hexdigest()
+        if not force and feed_sha256 == self.get_bundle_digest():
+            print('GTFS unchanged since the current bundle was built, skipping bundle build')
+            return False
+        
+        version = self.build_bundle(feed_sha256)
+        self.activate_bundle(version)
+        self.prune_bundles()
+        
+        return True
+        
+    def package_bundle(self, version):
+        '''Download a bundle built on this server (the bundle builder) as a bundle artifact.
+        
+        Args:
+            version (string): the bundle version.
+            
+        Returns:
+            string: the manifest file of the artifact, see `write_bundle_manifest`.
+        '''
+        
+        artifact_name = BUNDLE_ARTIFACT_NAME.format(version)
+        remote_artifact = unix_path_join(self.data_dir, artifact_name)
+        run('tar czf {0} -C {1} .'.format(remote_artifact, 
+                                          unix_path_join(self.bundle_builds_dir, version)))
+        remote_sha256 = run('sha256sum {0}'.format(remote_artifact)).split()[0]
+        feed_sha256 = run('cat {0}'.format(unix_path_join(self.bundle_builds_dir, 
+                                                          version,
+                                                          BUNDLE_DIGEST_FILE_NAME))).strip()
+        
+        if not os.path.exists(BUNDLE_ARTIFACT_DIR):
+            os.makedirs(BUNDLE_ARTIFACT_DIR)
+        artifact_filename = os.path.join(BUNDLE_ARTIFACT_DIR, artifact_name)
+        get(remote_artifact, artifact_filename)
+        run('rm {0}'.format(remote_artifact))
+        
+        manifest_filename = write_bundle_manifest(artifact_filename, version, feed_sha256)
+        with open(manifest_filename) as f:
+            if json.load(f)['sha256'] != remote_sha256:
+                raise Exception('Bundle artifact {0} was corrupted in the download.'.format(artifact_name))
+        return manifest_filename
+        
+    def install_bundle(self, manifest_filename, force=False):
+        '''Upload a bundle artifact built elsewhere, check it and make it the current bundle.
+        
+        Args:
+            manifest_filename (string): the manifest file of the artifact.
+            force (boolean, default=False): install the bundle even if the current bundle 
+                was built from the same gtfs.
+            
+        Returns:
+            boolean: True if the bundle was installed.
+        '''
+        
+        with open(manifest_filename) as f:
+            manifest = json.load(f)
+            
+        if not force and manifest['gtfs_sha256'] == self.get_bundle_digest():
+            print('GTFS unchanged since the current bundle was built, skipping bundle install')
+            return False
+        
+        artifact_filename = os.path.join(os.path.dirname(manifest_filename), manifest['artifact'])
+        if file_sha256(artifact_filename).hexdigest() != manifest['sha256']:
+            raise Exception('Bundle artifact {0} does not match its manifest.'.format(manifest['artifact']))
+        
+        # check if data folders exists
+        if not exists(self.data_dir):
+            run('mkdir {0}'.format(self.data_dir))
+        
+        remote_artifact = unix_path_join(self.data_dir, manifest['artifact'])
+        put(artifact_filename, remote_artifact)
+        version, staging_dir = self.new_bundle_dir()
+        with settings(warn_only=True):
+            installed = (run('sha256sum {0}'.format(remote_artifact)).split()[:1] == [manifest['sha256']] and
+                         run('tar xzf {0} -C {1}'.format(remote_artifact, staging_dir)).succeeded)
+        run('rm {0}'.format(remote_artifact))
+        if not installed or not self.validate_bundle(staging_dir):
+            run('rm -rf {0}'.format(staging_dir))
+            raise Exception('Bundle {0} could not be installed, the current bundle was kept.'.format(
+                manifest['version']))
+        
+        self.activate_bundle(version)
+        self.prune_bundles()
+        
+        return True
+        
+    def rollback_bundle(self, version=None):
+        '''Point `current` back at an older bundle.
+        
+        Args:
+            version (string, default=None): the bundle version to use, defaults to the
+                one built before the current bundle.
+        '''
+        
+        versions = self.list_bundles()
+        if version is None:
+            current = self.get_current_bundle()
+            older = [v for v in versions if current is None or v < current]
+            if not older:
+                raise Exception('No bundle older than {0} to roll back to.'.format(current))
+            version = older[-1]
+        elif version not in versions:
+            raise Exception('Bundle {0} not found, available bundles: {1}'.format(version, 
+                                                                                   ', '.join(versions)))
+        
+        self.activate_bundle(version)
             
     def install_gtfs_update_crontab(self):
         '''Installs and starts a crontab to automatically dl and build a data bundle nightly.
@@ -114,13 +495,18 @@ class GtfsFab:
                                 gtfs_dl_logfile=unix_path_join(self.data_dir, 'nightly_dl.out'),
                                 federation_builder_folder=self.federation_builder_folder,
                                 bundle_dir=self.bundle_dir,
+                                bundle_builds_dir=self.bundle_builds_dir,
+                                bundle_current=self.bundle_current,
+                                bundle_digest_file_name=BUNDLE_DIGEST_FILE_NAME,
+                                bundles_to_keep=self.get_bundles_to_keep(),
+                                bundle_stats_dir=self.bundle_stats_dir,
+                                script_folder=self.script_dir,
                                 user=self.user,
                                 cron_email=self.aws_conf.get('DEFAULT', 'cron_email'),
                                 from_mailer=env.host_string)
         
-        # check if script folders exists
-        if not exists(self.script_dir):
-            run('mkdir {0}'.format(self.script_dir))
+        # the script measures the builds with the bundle_stats script
+        self.put_script(bundle_stats, 'bundle_stats.py')
             
         put(write_template(refresh_settings, 'gtfs_refresh.sh'), self.script_dir)
         with cd(self.script_dir):
@@ -136,6 +522,12 @@ class GtfsFab:
         gtfs_refresh_cron = refresh_cron_template.format(**cron_settings)
             
         crontab_update(gtfs_refresh_cron, 'gtfs_refresh_cron')
+        
+    def remove_gtfs_update_crontab(self):
+        '''Removes the crontab that builds a data bundle nightly.
+        '''
+        
+        crontab_remove('gtfs_refresh_cron')
     
 
 def validate_gtfs():
@@ -156,58 +548,353 @@ def validate_gtfs():
     if not os.path.exists(REPORTS_DIR):
         os.makedirs(REPORTS_DIR)
     
-    # download gtfs
+    # download gtfs (skipped if the server says it hasn't changed)
     print('Downloading GTFS')
-    r = requests.get(gtfs_conf.get('DEFAULT', 'gtfs_static_url'), stream=True)
-    with open(gtfs_file_name, 'wb') as f:
-        for chunk in r.iter_content(chunk_size=1024): 
-            if chunk:  # filter out keep-alive new chunks
-                f.write(chunk)
-                f.flush()
+    changed, manifest = download_feed(gtfs_conf.get('DEFAULT', 'gtfs_static_url'),
+                                      gtfs_file_name)
+    
+    return validate_gtfs_file(gtfs_file_name, manifest['sha256'])
+
+
+def validate_gtfs_file(feed_filename, feed_sha256=None, incremental=True):
+    '''Validate a static GTFS file.
+    
+    If the same feed contents were already validated with the same version of
+    transitfeed and the same ignored problem types, the cached result is used.
+    
+    Args:
+        feed_filename (string): path to the GTFS zip file.
+        feed_sha256 (string, default=None): hex digest of the file, calculated if not given.
+        incremental (boolean, default=True): whether to skip checks of tables that didn't change
+            since the last validated feed.
+    
+    Returns:
+        boolean: True if no errors in GTFS.
+    '''
+    
+    gtfs_conf = get_gtfs_config()
+    ignore_types = get_ignore_types(gtfs_conf)
+    
+    if not feed_sha256:
+        feed_sha256 = file_sha256(feed_filename).hexdigest()
+        
+    loader = get_validation_loader(gtfs_conf)
+    cache_key = validation_cache_key(feed_sha256, ignore_types, loader)
+    result = get_cached_result(cache_key)
+    if result:
+        print('GTFS already validated on {0}, skipping validation'.format(result['validated_at']))
+    else:
+        if loader == 'columnar':
+            result = run_columnar_validation(feed_filename,
+                                             ignore_types,
+                                             get_problem_outputs(gtfs_conf))
+        else:
+            result = run_validation(feed_filename,
+                                    ignore_types,
+                                    incremental,
+                                    get_validation_processes(gtfs_conf),
+                                    get_problem_outputs(gtfs_conf))
+        store_result(cache_key, result)
+    
+    return check_validation_result(result, ignore_types)
+
+
+def run_validation(feed_filename, ignore_types, incremental=True, processes=1, problem_outputs=None):
+    '''Load and validate a GTFS file with transitfeed and write the html report.
+    
+    The loader always reads every table, but the schedule-wide checks are only
+    run for tables that changed since the last validated feed (unless incremental
+    is False).  Problems of the other checks are taken from the last run.
+    
+    Args:
+        feed_filename (string): path to the GTFS zip file.
+        ignore_types (list): problem class names to ignore.
+        incremental (boolean, default=True): whether to skip checks of unchanged tables.
+        processes (int, default=1): number of processes to run the schedule-wide checks with.
+        problem_outputs (list, default=None): machine-readable formats to also write every
+            problem to, see `validation.get_problem_outputs`.
+        
+    Returns:
+        dict: the validation result.
+    '''
                 
     # load gtfs
     print('Validating GTFS')
     gtfs_factory = GetGtfsFactory()
-    accumulator = HTMLCountingProblemAccumulator(limit_per_type=50)
-    problem_reporter = ProblemReporter(accumulator)
-    loader = gtfs_factory.Loader(gtfs_file_name, problems=problem_reporter)
-    schedule = loader.Load()
-    
-    # validate gtfs
-    schedule.Validate()
-    
-    # check for trips with a null value for trip_headsign
-    for trip in schedule.GetTripList():
-        if trip.trip_headsign == 'null':
-            problem_reporter.InvalidValue('trip_headsign', 'null', type=TYPE_WARNING)
+    limit_per_type = 50
+    problem_writers = open_problem_writers(problem_outputs or [],
+                                           datetime.now().strftime('%Y-%m-%d %H:%M:%S transitfeed'))
+    try:
+        accumulator = HTMLCountingProblemAccumulator(limit_per_type=limit_per_type,
+                                                     ignore_types=ignore_types,
+                                                     writers=problem_writers)
+        problem_reporter = ProblemReporter(accumulator)
+        # the check workers open the schedule's db themselves, so it has to be a file
+        loader = gtfs_factory.Loader(feed_filename, 
+                                     problems=problem_reporter, 
+                                     memory_db=processes <= 1)
+        schedule = loader.Load()
+        
+        # validate gtfs (only re-running checks affected by changed tables)
+        run_schedule_checks(schedule,
+                            accumulator,
+                            feed_filename,
+                            limit_per_type,
+                            ignore_types,
+                            incremental,
+                            processes,
+                            problem_writers)
+    finally:
+        problem_files = close_problem_writers(problem_writers)
             
+    result = write_report(feed_filename, accumulator, schedule)
+    result['problem_files'] = problem_files
+    return result
+
+
+def run_columnar_validation(feed_filename, ignore_types, problem_outputs=None):
+    '''Validate a GTFS file with the columnar loader and write the html report.
+    
+    The feed is streamed into compact columns instead of transitfeed's objects,
+    which uses far less memory for big feeds, but only the checks in
+    `columnar.COLUMNAR_CHECKS` are done.
+    
+    Args:
+        feed_filename (string): path to the GTFS zip file.
+        ignore_types (list): problem class names to ignore.
+        problem_outputs (list, default=None): machine-readable formats to also write every
+            problem to, see `validation.get_problem_outputs`.
+        
+    Returns:
+        dict: the validation result.
+    '''
+    
+    print('Validating GTFS (columnar loader)')
+    problem_writers = open_problem_writers(problem_outputs or [],
+                                           datetime.now().strftime('%Y-%m-%d %H:%M:%S columnar'))
+    try:
+        accumulator = HTMLCountingProblemAccumulator(limit_per_type=50,
+                                                     ignore_types=ignore_types,
+                                                     writers=problem_writers)
+        problem_reporter = ProblemReporter(accumulator)
+        feed = ColumnarFeed(feed_filename, problem_reporter)
+        run_columnar_checks(feed, problem_reporter)
+    finally:
+        problem_files = close_problem_writers(problem_writers)
+    
+    result = write_report(feed_filename, accumulator, feed)
+    result['problem_files'] = problem_files
+    return result
+
+
+def write_report(feed_filename, accumulator, schedule):
+    '''Write the html validation report and summarize the result.
+    
+    Args:
+        feed_filename (string): path to the GTFS zip file.
+        accumulator (HTMLCountingProblemAccumulator): the problems found.
+        schedule (transitfeed.Schedule or ColumnarFeed): the loaded feed.
+        
+    Returns:
+        dict: the validation result.
+    '''
+    
     # write GTFS report to file
     report_name = 'gtfs_validation_{0}.html'.format(datetime.now().strftime('%Y-%m-%d %H.%M'))
     report_filenmae = os.path.join(REPORTS_DIR, report_name)
     with open(report_filenmae, 'w') as f:
-        accumulator.WriteOutput(gtfs_file_name, f, schedule, transitfeed)
+        accumulator.WriteOutput(feed_filename, f, schedule, transitfeed)
+    
+    start_date, end_date = schedule.GetDateRange()
+    
+    return dict(num_errors=accumulator.ErrorCount(),
+                num_warnings=accumulator.WarningCount(),
+                expiration_warning='ExpirationDate' in accumulator.ProblemListMap(TYPE_WARNING).keys(),
+                start_date=start_date,
+                end_date=end_date,
+                report_file=report_filenmae,
+                validated_at=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+
+
+def write_bundle_manifest(artifact_filename, version, feed_sha256):
+    '''Write the manifest of a bundle artifact next to it.
+    
+    Args:
+        artifact_filename (string): the compressed bundle.
+        version (string): the bundle version.
+        feed_sha256 (string): the digest of the gtfs file the bundle was built from.
+        
+    Returns:
+        string: the manifest file.
+    '''
+    
+    manifest = dict(artifact=os.path.basename(artifact_filename),
+                    version=version,
+                    sha256=file_sha256(artifact_filename).hexdigest(),
+                    size=os.path.getsize(artifact_filename),
+                    gtfs_sha256=feed_sha256,
+                    packaged_at=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+    manifest_filename = os.path.join(BUNDLE_ARTIFACT_DIR, 'oba_bundle_{0}.json'.format(version))
+    with open(manifest_filename, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest_filename
+
+
+def read_bundle_manifests():
+    '''Read the manifests of the bundle artifacts.
+    
+    Returns:
+        list: (manifest file, manifest) tuples, newest first.
+    '''
+    
+    manifests = []
+    if not os.path.exists(BUNDLE_ARTIFACT_DIR):
+        return manifests
+    for filename in sorted(os.listdir(BUNDLE_ARTIFACT_DIR), reverse=True):
+        if filename.endswith('.json'):
+            manifest_filename = os.path.join(BUNDLE_ARTIFACT_DIR, filename)
+            with open(manifest_filename) as f:
+                try:
+                    manifests.append((manifest_filename, json.load(f)))
+                except ValueError:
+                    continue
+    return manifests
+
+
+def find_bundle_artifact(feed_sha256):
+    '''Find the newest bundle artifact built from a gtfs file.
+    
+    Returns:
+        string: the manifest file of the artifact, or None if there is none.
+    '''
+    
+    for manifest_filename, manifest in read_bundle_manifests():
+        if (manifest.get('gtfs_sha256') == feed_sha256 and
+                os.path.exists(os.path.join(BUNDLE_ARTIFACT_DIR, manifest['artifact']))):
+            return manifest_filename
+    return None
+
+
+def prune_bundle_artifacts():
+    '''Remove the oldest bundle artifacts, keeping `bundles_to_keep`.
+    '''
+    
+    for manifest_filename, manifest in read_bundle_manifests()[get_bundles_to_keep(get_gtfs_config()):]:
+        artifact_filename = os.path.join(BUNDLE_ARTIFACT_DIR, manifest['artifact'])
+        if os.path.exists(artifact_filename):
+            os.remove(artifact_filename)
+        os.remove(manifest_filename)
+
+
+def build_bundle_locally(feed_sha256):
+    '''Build a bundle from the downloaded gtfs zip file on this machine as a bundle artifact.
+    
+    This needs java and a built onebusaway-transit-data-federation-builder in the 
+    folder set as `local_federation_builder_folder` in gtfs.ini.  The build is 
+    measured like the builds on the servers, its record is written to 
+    `BUNDLE_STATS_DIR`/local.
+    
+    Args:
+        feed_sha256 (string): the digest of the gtfs file.
         
-    print('GTFS validation report written to {0}'.format(report_filenmae))
+    Returns:
+        string: the manifest file of the artifact.
+    '''
+    
+    gtfs_conf = get_gtfs_config()
+    if not gtfs_conf.has_option('DEFAULT', 'local_federation_builder_folder'):
+        raise Exception('Set local_federation_builder_folder in gtfs.ini to build bundles locally.')
+    builder_folder = os.path.expanduser(gtfs_conf.get('DEFAULT', 'local_federation_builder_folder'))
+    
+    if not os.path.exists(BUNDLE_ARTIFACT_DIR):
+        os.makedirs(BUNDLE_ARTIFACT_DIR)
+    version = datetime.now().strftime('%Y%m%d%H%M%S')
+    while os.path.exists(os.path.join(BUNDLE_ARTIFACT_DIR, BUNDLE_ARTIFACT_NAME.format(version))):
+        time.sleep(1)
+        version = datetime.now().strftime('%Y%m%d%H%M%S')
     
-    # post-validation
-    gtfs_validated = True
-    num_errors = accumulator.ErrorCount()
-    if num_errors > 0:
-        gtfs_validated = False
-        print('{0} errors in GTFS data'.format(num_errors))
+    records_dir = os.path.join(BUNDLE_STATS_DIR, 'local')
+    if not os.path.exists(records_dir):
+        os.makedirs(records_dir)
         
-    num_warnings = accumulator.WarningCount()
-    if num_warnings > 0:
-        print('{0} warnings about GTFS data'.format(num_warnings))
+    feed_filename = os.path.abspath(gtfs_file_name)
+    build_dir = tempfile.mkdtemp()
+    try:
+        exit_code = bundle_stats.run_build(os.path.join(records_dir, version + '.json'),
+                                           build_dir,
+                                           feed_filename,
+                                           ['java', '-classpath', '.:target/*', BUNDLE_MAIN, 
+                                            feed_filename, build_dir],
+                                           cwd=builder_folder)
+        missing = [name for name in BUNDLE_REQUIRED_FILES 
+                   if not os.path.exists(os.path.join(build_dir, name))]
+        if exit_code != 0 or missing:
+            raise Exception('Bundle build failed.')
+        with open(os.path.join(build_dir, BUNDLE_DIGEST_FILE_NAME), 'w') as f:
+            f.write(feed_sha256 + '\n')
+            
+        artifact_filename = os.path.join(BUNDLE_ARTIFACT_DIR, BUNDLE_ARTIFACT_NAME.format(version))
+        with tarfile.open(artifact_filename, 'w:gz') as tar:
+            tar.add(build_dir, arcname='.')
+    finally:
+        shutil.rmtree(build_dir)
+        
+    return write_bundle_manifest(artifact_filename, version, feed_sha256)
+
+
+def build_bundle_artifact(bundle_builder, feed_sha256):
+    '''Build a bundle from the downloaded gtfs zip file locally or on the bundle builder.
+    
+    Args:
+        bundle_builder (string): 'local' or the public dns name of the bundle builder.
+        feed_sha256 (string): the digest of the gtfs file.
         
-    if 'ExpirationDate' in accumulator.ProblemListMap(TYPE_WARNING).keys():
-        start_date, end_date = schedule.GetDateRange()
-        last_service_day = datetime(*(time.strptime(end_date, "%Y%m%d")[0:6]))
-        if last_service_day < datetime.now():
-            print('GTFS Feed has expired.')
-            gtfs_validated = False
+    Returns:
+        string: the manifest file of the artifact.
+    '''
+    
+    if bundle_builder == 'local':
+        manifest_filename = build_bundle_locally(feed_sha256)
+    else:
+        builder_fab = GtfsFab(bundle_builder)
+        version = builder_fab.build_bundle(feed_sha256)
+        manifest_filename = builder_fab.package_bundle(version)
+        builder_fab.prune_bundles()
+    prune_bundle_artifacts()
+    return manifest_filename
+
+
+def ship_bundle(instance_dns_names, bundle_builder, force=False):
+    '''Build a bundle locally or on the bundle builder and install it on the serving instances.
+    
+    The serving instances only get the compressed bundle and never build bundles
+    themselves, their nightly bundle refresh is removed.  A bundle is only built
+    if an instance's current bundle was built from a different gtfs file, and an
+    artifact already built from the same gtfs file is reused.
+    
+    Args:
+        instance_dns_names (list): The EC2 instances that serve OBA.
+        bundle_builder (string): 'local' or the public dns name of the bundle builder.
+        force (boolean, default=False): build and install the bundle even if the gtfs is unchanged.
+    '''
+    
+    feed_sha256 = file_sha256(gtfs_file_name).hexdigest()
+    outdated = []
+    for summary in HostGroup(instance_dns_names).run_and_check(GtfsFab, 'get_bundle_digest'):
+        if force or summary['result'] != feed_sha256:
+            outdated.append(summary['host'])
+        else:
+            print('GTFS unchanged since the current bundle of {0} was built'.format(summary['host']))
+    if not outdated:
+        return
+    
+    manifest_filename = None if force else find_bundle_artifact(feed_sha256)
+    if manifest_filename is None:
+        manifest_filename = build_bundle_artifact(bundle_builder, feed_sha256)
         
-    return gtfs_validated
+    HostGroup(outdated).run_steps_and_check(GtfsFab, 
+                                            [('install_bundle', (manifest_filename,), dict(force=True)),
+                                             ('remove_gtfs_update_crontab', (), dict())])
 
 
 def update(instance_dns_name=None, refresh_gtfs_file=False):
@@ -216,8 +903,12 @@ def update(instance_dns_name=None, refresh_gtfs_file=False):
     This assumes that onebusaway-transit-data-federation-builder has been installed on the server.
     It will also download the gtfs file if it does not find it in the local downloads folder.
     
+    Separate several EC2 instances with commas to update them in parallel.  If 
+    `bundle_builder` is set in gtfs.ini, the bundle is built there instead and 
+    installed on the EC2 instances, see `ship_bundle`.
+    
     Args:
-        instance_dns_name (string, default=None): The EC2 instance to upload the gtfs to.
+        instance_dns_name (string, default=None): The EC2 instance(s) to upload the gtfs to.
         refresh_gtfs_file (boolean, default=False): Whether or not to refetch and validate the gtfs file.
     '''
     
@@ -225,9 +916,52 @@ def update(instance_dns_name=None, refresh_gtfs_file=False):
         if not validate_gtfs():
             raise Exception('GTFS static file validation Failed.')
         
+    if not instance_dns_name:
+        instance_dns_name = input('Enter EC2 public dns name(s): ')
+        
+    instance_dns_names = split_host_names(instance_dns_name)
+    bundle_builder = get_bundle_builder(get_gtfs_config())
+    if bundle_builder:
+        ship_bundle(instance_dns_names, bundle_builder)
+        return
+        
+    HostGroup(instance_dns_names).run_steps_and_check(GtfsFab,
+                                                      [('update_gtfs', (), dict()),
+                                                       ('install_gtfs_update_crontab', (), dict())])
+
+
+def rollback(instance_dns_name=None):
+    '''Switch the EC2 instance back to the previous OBA bundle.
+    
+    Tomcat must be restarted for OBA to use it.
+    
+    Args:
+        instance_dns_name (string, default=None): The EC2 instance to roll back.
+    '''
+    
+    if not instance_dns_name:
+        instance_dns_name = input('Enter EC2 public dns name: ')
+        
+    gtfs_fab = GtfsFab(instance_dns_name)
+    gtfs_fab.rollback_bundle()
+
+
+def compare_bundle_builds(instance_dns_name=None):
+    '''Download the records of the bundle builds on the EC2 instance and compare them.
+    
+    Shows the wall time, peak memory, GC time and bundle size of the last builds,
+    marking values well above those of the earlier builds, and the time of each
+    task of the last build.
+    
+    Args:
+        instance_dns_name (string, default=None): The EC2 instance that builds the bundles.
+    '''
+    
     if not instance_dns_name:
         instance_dns_name = input('Enter EC2 public dns name: ')
         
     gtfs_fab = GtfsFab(instance_dns_name)
-    gtfs_fab.update_gtfs()
-    gtfs_fab.install_gtfs_update_crontab()
+    records_dir = gtfs_fab.fetch_bundle_stats()
+    
+    for line in bundle_stats.compare_records(bundle_stats.read_records(records_dir)):
+        print(line)
@@ -0,0 +1,198 @@
+import os
+import sys
+import time
+import traceback
+
+from fabric.api import env, execute, parallel
+
+from oba_rvtd_deployer import REPORTS_DIR
+from oba_rvtd_deployer.config import get_aws_config
+
+
+DEFAULT_POOL_SIZE = 4
+
+
+def split_host_names(instance_dns_names):
+    '''Split public dns names separated by commas or spaces.
+
+    Returns:
+        list: the dns names, without duplicates.
+    '''
+
+    host_names = []
+    for host_name in instance_dns_names.replace(',', ' ').split():
+        if host_name not in host_names:
+            host_names.append(host_name)
+    return host_names
+
+
+def get_pool_size(aws_conf):
+    '''Get the number of hosts to work on at the same time.
+
+    Args:
+        aws_conf (ConfigParser.ConfigParser): the aws config.
+
+    Returns:
+        int: the `host_pool_size` setting, or `DEFAULT_POOL_SIZE` if not set.
+    '''
+
+    if aws_conf.has_option('DEFAULT', 'host_pool_size'):
+        pool_size = aws_conf.get('DEFAULT', 'host_pool_size').strip()
+        if pool_size:
+            return max(1, int(pool_size))
+    return DEFAULT_POOL_SIZE
+
+
+def host_log_filename(fab_class, host_name):
+    '''Get the log file of a Fab class for one host, like data/reports/oba_fab_<host>.log.
+    '''
+
+    return os.path.join(REPORTS_DIR, '{0}_{1}.log'.format(fab_class.log_name, host_name))
+
+
+def run_on_host(host_name, fab_class, steps):
+    '''Connect to a host and call methods of a Fab class, catching any failure.
+
+    Args:
+        host_name (string): ec2 public dns name.
+        fab_class (class): ObaRvtdFab or GtfsFab.
+        steps (list): (method name, args, kwargs) of each method to call, in order.
+            They all use the same connection.
+
+    Returns:
+        dict: the host, whether it succeeded, the result of the last step or the 
+            error, the time taken and the log file.
+    '''
+
+    log_filename = host_log_filename(fab_class, host_name)
+    stdout = sys.stdout
+    start = time.time()
+    summary = dict(host=host_name, log_filename=log_filename)
+    method_name = None
+    try:
+        fab = fab_class(host_name, log_filename=log_filename)
+        for method_name, args, kwargs in steps:
+            summary['result'] = getattr(fab, method_name)(*args, **kwargs)
+        summary['succeeded'] = True
+    except (Exception, SystemExit) as e:
+        # fabric aborts with SystemExit
+        print(traceback.format_exc())
+        summary['error'] = str(e) or e.__class__.__name__
+        if len(steps) > 1 and method_name:
+            summary['error'] = '{0}: {1}'.format(method_name, summary['error'])
+        summary['succeeded'] = False
+    summary['seconds'] = round(time.time() - start, 1)
+    # parallel workers exit without flushing the log
+    sys.stdout.flush()
+    sys.stdout = stdout
+    return summary
+
+
+class HostGroup:
+    '''A group of EC2 instances to run the same Fab task on.
+
+    Each host is worked on in its own process (fabric's parallel mode), so it
+    has its own connection and fabric env.  At most `pool_size` hosts are worked
+    on at the same time.
+    '''
+
+    def __init__(self, host_names, pool_size=None):
+        '''Constructor for Class.
+
+        Args:
+            host_names (list): ec2 public dns names.
+            pool_size (int, default=None): the number of hosts to work on at the
+                same time, defaults to the `host_pool_size` setting in aws.ini.
+        '''
+
+        self.host_names = host_names
+        self.pool_size = pool_size or get_pool_size(get_aws_config())
+
+    def run(self, fab_class, method_name, *args, **kwargs):
+        '''Call a method of a Fab class on every host.
+
+        Args:
+            fab_class (class): ObaRvtdFab or GtfsFab.
+            method_name (string): the method to call, like 'deploy_all'.
+            args, kwargs: arguments for the method.
+
+        Returns:
+            list: the summary of each host (see `run_on_host`), in the order of the hosts.
+        '''
+
+        return self.run_steps(fab_class, [(method_name, args, kwargs)])
+
+    def run_steps(self, fab_class, steps):
+        '''Call several methods of a Fab class on every host, over one connection per host.
+
+        Args:
+            fab_class (class): ObaRvtdFab or GtfsFab.
+            steps (list): (method name, args, kwargs) of each method to call, in order.
+
+        Returns:
+            list: the summary of each host (see `run_on_host`), in the order of the hosts.
+        '''
+
+        if len(self.host_names) == 1:
+            return [run_on_host(self.host_names[0], fab_class, steps)]
+
+        @parallel(pool_size=self.pool_size)
+        def host_task():
+            return run_on_host(env.host, fab_class, steps)
+
+        user = fab_class.aws_conf.get('DEFAULT', 'user')
+        host_strings = ['{0}@{1}'.format(user, host_name) for host_name in self.host_names]
+        results = execute(host_task, hosts=host_strings)
+        summaries = []
+        for host_name, host_string in zip(self.host_names, host_strings):
+            summary = results.get(host_string)
+            if not isinstance(summary, dict):
+                # the worker process died
+                summary = dict(host=host_name,
+                               succeeded=False,
+                               error=str(summary),
+                               log_filename=host_log_filename(fab_class, host_name))
+            summaries.append(summary)
+        return summaries
+
+    def run_and_check(self, fab_class, method_name, *args, **kwargs):
+        '''Call a method of a Fab class on every host, print a summary and raise if any failed.
+
+        Returns:
+            list: the summary of each host (see `run_on_host`).
+        '''
+
+        return self.run_steps_and_check(fab_class, [(method_name, args, kwargs)])
+
+    def run_steps_and_check(self, fab_class, steps):
+        '''Call several methods of a Fab class on every host, print a summary and raise if any failed.
+
+        Returns:
+            list: the summary of each host (see `run_on_host`).
+        '''
+
+        summaries = self.run_steps(fab_class, steps)
+        task_name = ', '.join(method_name for method_name, args, kwargs in steps)
+        print_summary(task_name, summaries)
+        failed = [summary['host'] for summary in summaries if not summary['succeeded']]
+        if failed:
+            raise Exception('{0} failed on {1} of {2} hosts: {3}'.format(task_name,
+                                                                         len(failed),
+                                                                         len(summaries),
+                                                                         ', '.join(failed)))
+        return summaries
+
+
+def print_summary(method_name, summaries):
+    '''Print the result of a task on each host.'''
+
+    print('{0} on {1} hosts:'.format(method_name, len(summaries)))
+    for summary in summaries:
+        if summary['succeeded']:
+            status = 'ok'
+        else:
+            status = 'FAILED: {0}'.format(summary['error'])
+        print('  {0}  {1}s  {2}  (log: {3})'.format(summary['host'],
+                                                   summary.get('seconds', '-'),
+                                                   status,
+                                                   summary['log_filename']))
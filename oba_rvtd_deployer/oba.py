@@ -2,20 +2,128 @@ try:
     input = raw_input
 except NameError: 
     pass
+import json
 import os
+import shutil
 import sys
+import tempfile
 import time
 
-from fabric.api import env, run, put, cd, sudo
-from fabric.contrib.files import exists
-from fabric.exceptions import NetworkError
+from fabric.api import run, put, get, cd, settings, sudo
 
-from oba_rvtd_deployer import REPORTS_DIR, CONFIG_DIR, CONFIG_TEMPLATE_DIR
+from oba_rvtd_deployer import REPORTS_DIR, CONFIG_DIR, CONFIG_TEMPLATE_DIR, DATA_DIR, war_sync
+from oba_rvtd_deployer.batch import CommandBatch
 from oba_rvtd_deployer.config import (get_aws_config, 
                                       get_oba_config,
                                       get_gtfs_config, get_watchdog_config)
+from oba_rvtd_deployer.connections import connect
+from oba_rvtd_deployer.download import file_sha256
 from oba_rvtd_deployer.fab_crontab import crontab_update
+from oba_rvtd_deployer.hosts import HostGroup, print_summary, split_host_names
+from oba_rvtd_deployer.provision import Step, provision
 from oba_rvtd_deployer.util import unix_path_join, FabLogger, write_template
+from oba_rvtd_deployer.war_store import WarStore, get_war_store_dir
+
+
+# the api call check_oba.py starts with
+READINESS_URL = 'http://localhost:8080/onebusaway-api-webapp/api/where/agencies-with-coverage.json?key={0}'
+
+# the webapps, with the template of their data-sources.xml and the method giving its settings
+WEBAPPS = [('onebusaway-transit-data-federation-webapp', 
+            'transit-data-federation-webapp-data-sources.xml',
+            'federation_webapp_config'),
+           ('onebusaway-api-webapp', 'api-webapp-data-sources.xml', 'api_webapp_config'),
+           ('onebusaway-sms-webapp', 'sms-webapp-data-sources.xml', 'sms_webapp_config'),
+           ('onebusaway-webapp', 'webapp-data-sources.xml', 'webapp_config')]
+
+# the steps of `ObaRvtdFab.install_all`, see the provision module
+PROVISION_STEPS = [Step('clone_repo', 
+                        configure='update_repo', 
+                        params='repo_params', 
+                        probe='remote_commit_command'),
+                   Step('webapps',
+                        requires=['clone_repo'],
+                        configure='build_webapps',
+                        probe='local_commit_command',
+                        version=2),
+                   Step('data_sources', configure='install_data_sources', params='webapps_config')]
+
+# fingerprint of the sources a webapp was built from
+BUILD_FINGERPRINT_FILE_NAME = '.build_fingerprint'
+
+# copies of the ~/.m2 repository of the servers, named after the poms they were made for
+MAVEN_CACHE_DIR = os.path.join(DATA_DIR, 'maven_cache')
+MAVEN_CACHE_NAME = 'm2_repository_{0}.tar.gz'
+MAVEN_CACHES_TO_KEEP = 2
+
+
+def find_maven_cache(pom_hash):
+    '''Find the maven repository cache to seed a server with.
+    
+    Args:
+        pom_hash (string): the hash of the poms of the OneBusAway repo.
+    
+    Returns:
+        tuple: (the cache tarball or None if there is none, True if it was made 
+            for the same poms).  The newest cache is used if none was made for the
+            same poms, as most of the dependencies are the same.
+    '''
+    
+    exact_filename = os.path.join(MAVEN_CACHE_DIR, MAVEN_CACHE_NAME.format(pom_hash))
+    if os.path.exists(exact_filename) and os.path.exists(exact_filename + '.sha256'):
+        return exact_filename, True
+    caches = read_maven_caches()
+    if caches:
+        return caches[0], False
+    return None, False
+
+
+def read_maven_caches():
+    '''Get the maven repository caches that have a checksum file.
+    
+    Returns:
+        list: the tarballs, newest first.
+    '''
+    
+    if not os.path.exists(MAVEN_CACHE_DIR):
+        return []
+    caches = [os.path.join(MAVEN_CACHE_DIR, filename) 
+              for filename in os.listdir(MAVEN_CACHE_DIR)
+              if filename.endswith('.tar.gz') and 
+              os.path.exists(os.path.join(MAVEN_CACHE_DIR, filename + '.sha256'))]
+    return sorted(caches, key=os.path.getmtime, reverse=True)
+
+
+def read_maven_cache_checksum(cache_filename):
+    '''Get the sha256 of a maven repository cache recorded when it was made.'''
+    
+    with open(cache_filename + '.sha256') as f:
+        return f.read().strip()
+
+
+def prune_maven_caches():
+    '''Remove the oldest maven repository caches, keeping `MAVEN_CACHES_TO_KEEP`.
+    '''
+    
+    for cache_filename in read_maven_caches()[MAVEN_CACHES_TO_KEEP:]:
+        os.remove(cache_filename)
+        os.remove(cache_filename + '.sha256')
+
+
+def get_oba_setting(oba_conf, name, default):
+    '''Get an optional setting from oba.ini.
+    
+    Args:
+        oba_conf (ConfigParser.ConfigParser): the oba config.
+        name (string): the setting.
+        default: the value if the setting is not set.
+    '''
+    
+    if oba_conf.has_option('DEFAULT', name):
+        value = oba_conf.get('DEFAULT', name).strip()
+        if value:
+            return value
+    return default
 
 
 class ObaRvtdFab:
@@ -25,36 +133,27 @@ class ObaRvtdFab:
     oba_conf = get_oba_config()
     oba_base_folder = oba_conf.get('DEFAULT', 'oba_base_folder')
     user = aws_conf.get('DEFAULT', 'user')
+    log_name = 'oba_fab'
     config_dir = unix_path_join('/home', user, 'conf')
     script_dir = unix_path_join('/home', user, 'scripts')
+    state_dir = unix_path_join('/home', user, '.provisioned')
+    tomcat_context_dir = unix_path_join('/home', user, 'tomcat', 'conf', 'Catalina', 'localhost')
+    tomcat_webapps_dir = unix_path_join('/home', user, 'tomcat', 'webapps')
+    stored_wars_dir = unix_path_join('/home', user, 'wars')
+    tomcat_manager_password_file = unix_path_join('/home', user, 'tomcat', 'conf', 'manager_password')
+    war_store = WarStore(get_war_store_dir(oba_conf))
         
-    def __init__(self, host_name):
+    def __init__(self, host_name, log_filename=None):
         '''Constructor for Class.  Sets up fabric environment.
         
         Args:
             host_name (string): ec2 public dns name
+            log_filename (string, default=None): where to log the output, defaults to 
+                `oba_fab.log` in the reports folder.
         '''
         
-        env.host_string = '{0}@{1}'.format(self.user, host_name)
-        env.key_filename = [self.aws_conf.get('DEFAULT', 'key_filename')]
-        sys.stdout = FabLogger(os.path.join(REPORTS_DIR, 'oba_fab.log'))
-        
-        max_retries = 6
-        num_retries = 0
-    
-        retry = True
-        while retry:
-            try:
-                # SSH into the box here.
-                self.test_cmd()
-                retry = False
-            except NetworkError as e:
-                print(e)
-                if num_retries > max_retries:
-                    raise Exception('Maximum Number of SSH Retries Hit.  Did EC2 instance get configured with ssh correctly?')
-                num_retries += 1 
-                print('SSH failed (the system may still be starting up), waiting 10 seconds...')
-                time.sleep(10)
+        sys.stdout = FabLogger(log_filename or os.path.join(REPORTS_DIR, self.log_name + '.log'))
+        connect(self.user, host_name, self.aws_conf, self.test_cmd)
         
     def test_cmd(self):
         '''Simple command to test if connection works.
@@ -63,126 +162,610 @@ class ObaRvtdFab:
         
     def install_all(self):
         '''Installs all OneBusAway stuff.
+        
+        If the WAR store has all the webapps built from the branch's commit, 
+        they are installed without cloning and building.  They go to 
+        `stored_wars_dir`, so that the clone is only ever made by git.  Otherwise
+        steps already done with the same settings and commit are skipped, see 
+        `PROVISION_STEPS`.
         '''
-        self.clone_repo()
-        self.install_federation_webapp()
-        self.install_api_webapp()
-        self.install_sms_webapp()
-        self.install_webapp()
+        
+        commit = self.get_remote_commit()
+        if commit:
+            stored = self.find_stored_wars(commit)
+            if len(stored) == len(WEBAPPS):
+                self.install_stored_wars(stored, in_clone=False)
+                print('Installed the webapps of commit {0} from the WAR store'.format(commit))
+                self.provision(['data_sources'])
+                return
+        
+        self.provision([step.name for step in PROVISION_STEPS])
+        
+    def provision(self, step_names, force=False):
+        '''Runs some of the provisioning steps, skipping the ones already done.
+        
+        Args:
+            step_names (list): names of steps in `PROVISION_STEPS`.
+            force (bool, default=False): run the steps even if they are done.
+        '''
+        
+        provision(self, PROVISION_STEPS, step_names, force)
         
     def clone_repo(self):
         '''Clone the repo and upload some files.
         '''
         
-        # clone the repo
-        run('git clone {0}'.format(self.oba_conf.get('DEFAULT', 'oba_git_repo')))
+        self.provision(['clone_repo'])
         
-        with cd(self.oba_base_folder):
-            run('git checkout {0}'.format(self.oba_conf.get('DEFAULT', 'oba_git_branch')))
-            run('/usr/local/maven/bin/mvn clean install')
+    def repo_params(self):
+        '''Gets the repo and branch to build.
+        '''
+        
+        return dict(oba_git_repo=self.oba_conf.get('DEFAULT', 'oba_git_repo'),
+                    oba_git_branch=self.oba_conf.get('DEFAULT', 'oba_git_branch'))
+        
+    def remote_commit_command(self):
+        '''Gets a command printing the commit the branch points to in the repo.
+        '''
+        
+        return 'git ls-remote {0} {1}'.format(self.oba_conf.get('DEFAULT', 'oba_git_repo'),
+                                              self.oba_conf.get('DEFAULT', 'oba_git_branch'))
+        
+    def get_remote_commit(self):
+        '''Gets the commit the branch points to in the repo.
+        
+        Returns:
+            string: the commit, or None if the repo can't be reached.
+        '''
+        
+        with settings(warn_only=True):
+            result = run(self.remote_commit_command())
+        if result.failed:
+            return None
+        commit = None
+        for line in result.splitlines():
+            parts = line.split()
+            # the commit an annotated tag points to is listed as <tag>^{}
+            if len(parts) == 2 and (commit is None or parts[1].endswith('^{}')):
+                commit = parts[0]
+        return commit
+        
+    def local_commit_command(self):
+        '''Gets a command printing the commit checked out in the clone.
+        '''
+        
+        return 'cd {0} && git rev-parse HEAD'.format(self.oba_base_folder)
+        
+    def update_repo(self):
+        '''Clones the repo (unless it was already) and checks out the branch.
+        
+        The modules are built with the webapps, see `build_webapps`.
+        '''
+        
+        branch = self.oba_conf.get('DEFAULT', 'oba_git_branch')
+        batch = CommandBatch()
+        # older versions of `install_all` put the WARs from the WAR store in a 
+        # folder of the clone's name, without cloning
+        batch.run('test -d {0}/.git || rm -rf {0}'.format(self.oba_base_folder))
+        batch.run('git clone {0}'.format(self.oba_conf.get('DEFAULT', 'oba_git_repo')),
+                  unless_exists=self.oba_base_folder)
+        batch.run('git fetch origin {0}'.format(branch), cwd=self.oba_base_folder)
+        batch.run('git checkout {0}'.format(branch), cwd=self.oba_base_folder)
+        batch.run('git merge --ff-only FETCH_HEAD', cwd=self.oba_base_folder)
+        batch.execute()
         
-    def build_webapp(self, data_dict, config_template_file, webapp):
-        '''Build a webapp using maven.
+    def render_data_sources(self, webapp):
+        '''Render the data-sources.xml of a webapp.
         
         Args:
-            data_dict (dict): A dict to set the stuff in the config template.
-            config_tempalte_file (string): filename of the config template file.
-            webapp (string): The name of the webapp to build.
-        '''
-                   
-        # upload the data sources file to the project
-        put(write_template(data_dict, 
-                           config_template_file, 
-                           'data-sources.xml'), 
-            unix_path_join(self.oba_base_folder,
-                           webapp,
-                           'src',
-                           'main',
-                           'resources'))
-        
-        # build the project using maven
+            webapp (string): The name of the webapp.
+            
+        Returns:
+            string: the rendered file, in the config folder.
+        '''
+        
+        for name, config_template_file, config_method in WEBAPPS:
+            if name == webapp:
+                return write_template(getattr(self, config_method)(), 
+                                      config_template_file, 
+                                      '{0}-data-sources.xml'.format(webapp))
+        raise Exception('Unknown webapp {0}'.format(webapp))
+        
+    def data_sources_dir(self, webapp):
+        '''Get the folder on the server with the data-sources.xml of a webapp.
+        '''
+        
+        return unix_path_join(self.config_dir, webapp)
+        
+    def install_data_sources(self, webapps=None):
+        '''Upload the data-sources.xml of the webapps and the Tomcat contexts that load them.
+        
+        The data sources are not part of the wars: each webapp's context file in 
+        Tomcat's conf/Catalina/localhost puts its folder in `config_dir` first on
+        the webapp's classpath and makes Tomcat reload the webapp when its 
+        data-sources.xml changes.  Only changed files are uploaded, so only the 
+        webapps whose settings changed are reloaded.
+        
+        Args:
+            webapps (list, default=None): names of the webapps, defaults to all of them.
+            
+        Returns:
+            list: the webapps whose data sources were changed.
+        '''
+        
+        webapps = webapps or [webapp for webapp, config_template_file, config_method in WEBAPPS]
+        
+        # compare with the files on the server in one batch
+        batch = CommandBatch()
+        batch.run('mkdir -p {0}'.format(self.tomcat_context_dir))
+        for webapp in webapps:
+            data_sources_dir = self.data_sources_dir(webapp)
+            batch.run('mkdir -p {0} && cat {0}/data-sources.xml {1}.xml 2>/dev/null | sha256sum'.format(
+                data_sources_dir, 
+                unix_path_join(self.tomcat_context_dir, webapp)))
+        batch.execute()
+        
+        changed = []
+        move_batch = CommandBatch()
+        for webapp, output in zip(webapps, batch.outputs[1:]):
+            data_sources_dir = self.data_sources_dir(webapp)
+            data_sources_filename = self.render_data_sources(webapp)
+            context_filename = write_template(dict(data_sources_dir=data_sources_dir),
+                                              'tomcat_webapp_context.xml',
+                                              '{0}-context.xml'.format(webapp))
+            sha = file_sha256(data_sources_filename)
+            if output.split()[:1] == [file_sha256(context_filename, sha).hexdigest()]:
+                continue
+            
+            # upload next to the files and move them into place, so tomcat never 
+            # reloads a partial file
+            remote_data_sources = unix_path_join(data_sources_dir, 'data-sources.xml')
+            remote_context = unix_path_join(self.tomcat_context_dir, webapp + '.xml')
+            put(data_sources_filename, remote_data_sources + '.part')
+            put(context_filename, remote_context + '.part')
+            move_batch.run('chmod 600 {0}.part && mv {0}.part {0}'.format(remote_data_sources))
+            move_batch.run('mv {0}.part {0}'.format(remote_context))
+            changed.append(webapp)
+        move_batch.execute()
+        
+        if changed:
+            print('Updated the data sources of {0}'.format(', '.join(changed)))
+        else:
+            print('Data sources up to date')
+        return changed
+        
+    def webapps_config(self):
+        '''Gets the settings of the data sources of all the webapps.
+        '''
+        
+        return dict((webapp, getattr(self, config_method)()) 
+                    for webapp, config_template_file, config_method in WEBAPPS)
+        
+    def build_fingerprint_command(self, webapp):
+        '''Gets a command printing the fingerprint of what a webapp is built from.
+        
+        That is the committed sources of every module but the other webapps.  It
+        is run in the repo folder.
+        '''
+        
+        other_webapps = ' && '.join('$4 != "{0}"'.format(other) 
+                                    for other, config_template_file, config_method in WEBAPPS
+                                    if other != webapp)
+        return "git ls-tree HEAD | awk '{0}' | sha256sum | cut -d ' ' -f 1".format(other_webapps)
+        
+    def build_webapps(self, webapps=None):
+        '''Build webapps in one parallel maven reactor build.
+        
+        Webapps whose sources (including the modules they depend on) did not 
+        change since they were last built are skipped.  Webapps found in the WAR
+        store are installed from it instead of built, and the built webapps are
+        added to the store.  The maven repository is seeded from the newest local 
+        cache if the server has none, and cached locally after the build.
+        
+        The wars are built with the data-sources.xml of the repo, the settings 
+        are loaded from outside the wars (see `install_data_sources`).
+        
+        Args:
+            webapps (list, default=None): names of the webapps to build, defaults 
+                to all of them.
+        '''
+        
+        webapps = webapps or [webapp for webapp, config_template_file, config_method in WEBAPPS]
+        
+        # check the repository and what was built in one batch, removing the data 
+        # sources that older versions of this script wrote into the sources
+        batch = CommandBatch()
+        for webapp in webapps:
+            data_sources_filename = unix_path_join(webapp, 'src', 'main', 'resources', 'data-sources.xml')
+            batch.run('git checkout -- {0} 2>/dev/null || rm -f {0}'.format(data_sources_filename), 
+                      cwd=self.oba_base_folder)
+        batch.run('git rev-parse HEAD', cwd=self.oba_base_folder)
+        batch.run("git ls-files -s '*pom.xml' | sha256sum | cut -c 1-16", cwd=self.oba_base_folder)
+        batch.run('test -d ~/.m2/repository && echo yes || echo no')
+        for webapp in webapps:
+            target_dir = unix_path_join(webapp, 'target')
+            batch.run('echo "$(cat {0} 2>/dev/null) $({1}) $(test -f {2} && echo war)"'.format(
+                unix_path_join(target_dir, BUILD_FINGERPRINT_FILE_NAME),
+                self.build_fingerprint_command(webapp),
+                unix_path_join(target_dir, webapp + '.war')), cwd=self.oba_base_folder)
+        batch.execute()
+        outputs = batch.outputs[len(webapps):]
+        commit = outputs[0].strip()
+        pom_hash = outputs[1].strip()
+        has_repository = outputs[2].strip() == 'yes'
+        stale = []
+        for webapp, output in zip(webapps, outputs[3:]):
+            fingerprints = output.split()
+            if not (len(fingerprints) == 3 and fingerprints[0] == fingerprints[1]):
+                stale.append(webapp)
+        if not stale:
+            print('Webapps up to date: {0}'.format(', '.join(webapps)))
+            self.discard_stored_wars(webapps)
+            return
+        
+        stored = self.find_stored_wars(commit, stale)
+        if stored:
+            self.install_stored_wars(stored)
+            print('Installed from the WAR store: {0}'.format(', '.join(sorted(stored))))
+            self.write_build_fingerprints(list(stored))
+            self.discard_stored_wars(list(stored))
+            stale = [webapp for webapp in stale if webapp not in stored]
+            if not stale:
+                return
+        
+        if not has_repository:
+            self.seed_maven_cache(pom_hash)
+        
         with cd(self.oba_base_folder):
-            run('/usr/local/maven/bin/mvn -am -pl {0} package'.format(webapp))
+            run('/usr/local/maven/bin/mvn -T {0} -am -pl {1} package'.format(
+                get_oba_setting(self.oba_conf, 'maven_threads', '1C'),
+                ','.join(stale)))
+        
+        self.write_build_fingerprints(stale)
+        self.discard_stored_wars(stale)
+        self.store_built_wars(commit, stale)
+        
+        cache_filename, same_poms = find_maven_cache(pom_hash)
+        if not same_poms:
+            self.save_maven_cache(pom_hash)
+        
+    def write_build_fingerprints(self, webapps):
+        '''Record what the WARs of some webapps were built from, see `build_fingerprint_command`.
+        '''
+        
+        batch = CommandBatch()
+        for webapp in webapps:
+            batch.run('({0}) > {1}'.format(self.build_fingerprint_command(webapp),
+                                           unix_path_join(webapp, 'target', BUILD_FINGERPRINT_FILE_NAME)), 
+                      cwd=self.oba_base_folder)
+        batch.execute()
+        
+    def built_war_filename(self, webapp):
+        '''Get the WAR of a webapp on the server, where maven builds it.
+        '''
+        
+        return unix_path_join(self.oba_base_folder, webapp, 'target', webapp + '.war')
+        
+    def stored_war_filename(self, webapp):
+        '''Get the WAR of a webapp on the server, where `install_all` installs it from the WAR store.
+        '''
+        
+        return unix_path_join(self.stored_wars_dir, webapp + '.war')
+        
+    def war_filename(self, webapp):
+        '''Get a shell expression of the WAR of a webapp to deploy, for `CommandBatch` commands.
+        
+        It is the WAR installed from the WAR store, if there is one, or else the 
+        WAR maven built.  Building the webapp in the clone discards the WAR from 
+        the store, see `discard_stored_wars`.
+        '''
+        
+        return '$(test -f {0} && echo {0} || echo {1})'.format(self.stored_war_filename(webapp),
+                                                               self.built_war_filename(webapp))
+        
+    def discard_stored_wars(self, webapps):
+        '''Remove the WARs `install_all` installed from the WAR store, once the clone has newer ones.
+        '''
+        
+        batch = CommandBatch()
+        for webapp in webapps:
+            batch.run('rm -f {0}'.format(self.stored_war_filename(webapp)))
+        batch.execute()
+        
+    def find_stored_wars(self, commit, webapps=None):
+        '''Find webapps in the WAR store.
+        
+        Args:
+            commit (string): the git commit to build.
+            webapps (list, default=None): names of the webapps to look for, defaults
+                to all of them.
+                
+        Returns:
+            dict: (WAR file, manifest) of the webapps in the store, by webapp.
+        '''
+        
+        stored = dict()
+        for webapp in webapps or [webapp for webapp, config_template_file, config_method in WEBAPPS]:
+            found = self.war_store.find(webapp, commit)
+            if found:
+                stored[webapp] = found
+        return stored
+        
+    def install_stored_wars(self, stored, in_clone=True):
+        '''Upload WARs from the store.
+        
+        Args:
+            stored (dict): (WAR file, manifest) by webapp, see `find_stored_wars`.
+            in_clone (bool, default=True): upload them to where maven builds them 
+                in the clone, or else to `stored_wars_dir`.
+        '''
+        
+        if in_clone:
+            remote_filename = self.built_war_filename
+        else:
+            remote_filename = self.stored_war_filename
+        
+        batch = CommandBatch()
+        for webapp, (war_filename, manifest) in stored.items():
+            if file_sha256(war_filename).hexdigest() != manifest['sha256']:
+                raise Exception('Stored WAR {0} is corrupted.'.format(war_filename))
+            if in_clone:
+                batch.run('mkdir -p {0}'.format(unix_path_join(self.oba_base_folder, webapp, 'target')))
+        if not in_clone:
+            batch.run('mkdir -p {0}'.format(self.stored_wars_dir))
+        batch.execute()
+        
+        batch = CommandBatch()
+        for webapp, (war_filename, manifest) in stored.items():
+            put(war_filename, remote_filename(webapp))
+            batch.run('echo "{0}  {1}" | sha256sum -c -'.format(manifest['sha256'], 
+                                                                remote_filename(webapp)))
+        batch.execute()
+        
+    def store_built_wars(self, commit, webapps):
+        '''Download the WARs built on the server into the WAR store.
+        
+        Args:
+            commit (string): the git commit they were built from.
+            webapps (list): names of the webapps.
+        '''
+        
+        batch = CommandBatch()
+        for webapp in webapps:
+            batch.run('sha256sum {0}'.format(self.built_war_filename(webapp)))
+        batch.execute()
+        
+        temp_dir = tempfile.mkdtemp()
+        try:
+            for webapp, output in zip(webapps, batch.outputs):
+                war_filename = os.path.join(temp_dir, webapp + '.war')
+                get(self.built_war_filename(webapp), war_filename)
+                self.war_store.add(war_filename, webapp, commit, output.split()[0])
+        finally:
+            shutil.rmtree(temp_dir)
+        
+    def seed_maven_cache(self, pom_hash):
+        '''Upload and extract the local maven repository cache, if there is one.
+        
+        Args:
+            pom_hash (string): the hash of the poms of the repo.
+        '''
+        
+        cache_filename, same_poms = find_maven_cache(pom_hash)
+        if not cache_filename:
+            return
+        sha256 = read_maven_cache_checksum(cache_filename)
+        if file_sha256(cache_filename).hexdigest() != sha256:
+            print('Maven repository cache {0} is corrupted, not using it.'.format(cache_filename))
+            return
+        
+        print('Seeding maven repository from {0}'.format(cache_filename))
+        remote_cache = os.path.basename(cache_filename)
+        put(cache_filename, remote_cache)
+        batch = CommandBatch()
+        batch.run('echo "{0}  {1}" | sha256sum -c -'.format(sha256, remote_cache))
+        batch.run('mkdir -p ~/.m2 && tar xzf {0} -C ~/.m2'.format(remote_cache))
+        batch.run('rm {0}'.format(remote_cache))
+        batch.execute()
+        
+    def save_maven_cache(self, pom_hash):
+        '''Download the maven repository of the server as the local cache for its poms.
+        
+        Args:
+            pom_hash (string): the hash of the poms of the repo.
+        '''
+        
+        cache_name = MAVEN_CACHE_NAME.format(pom_hash)
+        batch = CommandBatch()
+        batch.run('tar czf {0} -C ~/.m2 repository'.format(cache_name))
+        batch.run('sha256sum {0}'.format(cache_name))
+        batch.execute()
+        remote_sha256 = batch.outputs[1].split()[0]
+        
+        if not os.path.exists(MAVEN_CACHE_DIR):
+            os.makedirs(MAVEN_CACHE_DIR)
+        cache_filename = os.path.join(MAVEN_CACHE_DIR, cache_name)
+        get(cache_name, cache_filename)
+        run('rm {0}'.format(cache_name))
+        if file_sha256(cache_filename).hexdigest() != remote_sha256:
+            os.remove(cache_filename)
+            raise Exception('Maven repository cache {0} was corrupted in the download.'.format(cache_name))
+        with open(cache_filename + '.sha256', 'w') as f:
+            f.write(remote_sha256)
+        prune_maven_caches()
         
     def install_api_webapp(self):
         '''Installs the api-webapp.
         '''
         
+        self.build_webapps(['onebusaway-api-webapp'])
+        
+    def api_webapp_config(self):
+        '''Gets the settings of the api-webapp data sources.
+        '''
+        
         if self.oba_conf.get('DEFAULT', 'allow_api_test_key').lower() == 'true':
             api_test_xml = '<bean class="org.onebusaway.users.impl.CreateApiKeyAction"><property name="key" value="TEST"/></bean>'
         else:
             api_test_xml = ''
         
-        api_config = dict(api_testing=api_test_xml,
-                          elastic_ip=self.aws_conf.get('DEFAULT', 'elastic_ip'),
-                          pg_password=self.oba_conf.get('DEFAULT', 'pg_password'),
-                          pg_username=self.oba_conf.get('DEFAULT', 'pg_username'))
-        
-        self.build_webapp(api_config, 
-                          'api-webapp-data-sources.xml',
-                          'onebusaway-api-webapp')
+        return dict(api_testing=api_test_xml,
+                    elastic_ip=self.aws_conf.get('DEFAULT', 'elastic_ip'),
+                    pg_password=self.oba_conf.get('DEFAULT', 'pg_password'),
+                    pg_username=self.oba_conf.get('DEFAULT', 'pg_username'))
         
     def install_federation_webapp(self):
         '''Installs the transit-data-federation-webapp.
         '''
         
-        transit_fed_config = dict(pg_username=self.oba_conf.get('DEFAULT', 'pg_username'),
-                                  pg_password=self.oba_conf.get('DEFAULT', 'pg_password'),
-                                  data_bundle_path=unix_path_join('/home',
-                                                                  self.user,
-                                                                  'data',
-                                                                  'bundle'),
-                                  gtfs_rt_trip_updates_url=self.gtfs_conf.get('DEFAULT', 'gtfs_rt_trip_updates_url'),
-                                  gtfs_rt_vehicle_positions_url=self.gtfs_conf.get('DEFAULT', 'gtfs_rt_vehicle_positions_url'),
-                                  gtfs_rt_service_alerts_url=self.gtfs_conf.get('DEFAULT', 'gtfs_rt_service_alerts_url'))
+        self.build_webapps(['onebusaway-transit-data-federation-webapp'])
+        
+    def federation_webapp_config(self):
+        '''Gets the settings of the transit-data-federation-webapp data sources.
+        '''
         
-        self.build_webapp(transit_fed_config, 
-                          'transit-data-federation-webapp-data-sources.xml',
-                          'onebusaway-transit-data-federation-webapp')
+        return dict(pg_username=self.oba_conf.get('DEFAULT', 'pg_username'),
+                    pg_password=self.oba_conf.get('DEFAULT', 'pg_password'),
+                    data_bundle_path=unix_path_join('/home',
+                                                    self.user,
+                                                    'data',
+                                                    'bundle',
+                                                    'current'),
+                    gtfs_rt_trip_updates_url=self.gtfs_conf.get('DEFAULT', 'gtfs_rt_trip_updates_url'),
+                    gtfs_rt_vehicle_positions_url=self.gtfs_conf.get('DEFAULT', 'gtfs_rt_vehicle_positions_url'),
+                    gtfs_rt_service_alerts_url=self.gtfs_conf.get('DEFAULT', 'gtfs_rt_service_alerts_url'))
         
     def install_sms_webapp(self):
         '''Installs the sms-webapp.
         '''
         
-        sms_config = dict(pg_username=self.oba_conf.get('DEFAULT', 'pg_username'),
-                          pg_password=self.oba_conf.get('DEFAULT', 'pg_password'))
+        self.build_webapps(['onebusaway-sms-webapp'])
         
-        self.build_webapp(sms_config, 
-                          'sms-webapp-data-sources.xml',
-                          'onebusaway-sms-webapp')
+    def sms_webapp_config(self):
+        '''Gets the settings of the sms-webapp data sources.
+        '''
+        
+        return dict(pg_username=self.oba_conf.get('DEFAULT', 'pg_username'),
+                    pg_password=self.oba_conf.get('DEFAULT', 'pg_password'))
         
     def install_webapp(self):
         '''Installs the webapp.
         '''
         
-        webapp_config = dict(pg_username=self.oba_conf.get('DEFAULT', 'pg_username'),
-                             pg_password=self.oba_conf.get('DEFAULT', 'pg_password'),
-                             elastic_ip=self.aws_conf.get('DEFAULT', 'elastic_ip'))
+        self.build_webapps(['onebusaway-webapp'])
+        
+    def webapp_config(self):
+        '''Gets the settings of the webapp data sources.
+        '''
         
-        self.build_webapp(webapp_config, 
-                          'webapp-data-sources.xml',
-                          'onebusaway-webapp')
+        return dict(pg_username=self.oba_conf.get('DEFAULT', 'pg_username'),
+                    pg_password=self.oba_conf.get('DEFAULT', 'pg_password'),
+                    elastic_ip=self.aws_conf.get('DEFAULT', 'elastic_ip'))
         
     def deploy_all(self):
         '''Deploys each webapp (copies to tomcat webapps).
         '''
         
+        # the wars need their data sources, which are not in them
+        self.install_data_sources()
+        
         # copy the war files to tomcat for each webapp
-        tomcat_webapp_dir = unix_path_join('/home',
-                                           self.user,
-                                           'tomcat',
-                                           'webapps')
-        for webapp in ['onebusaway-transit-data-federation-webapp',
-                       'onebusaway-api-webapp',
-                       'onebusaway-sms-webapp',
-                       'onebusaway-webapp']:
-            run('cp {0} {1}'.format(unix_path_join('/home',
-                                                   self.user,
-                                                   self.oba_base_folder,
-                                                   webapp,
-                                                   'target',
-                                                   webapp + '.war'),
-                                    tomcat_webapp_dir))
+        batch = CommandBatch()
+        for webapp, config_template_file, config_method in WEBAPPS:
+            batch.run('cp {0} {1}'.format(self.war_filename(webapp), self.tomcat_webapps_dir))
+        batch.execute()
+            
+    def deploy_changed(self):
+        '''Deploys only the files that changed in each webapp and reloads the webapps that need it.
+        
+        Copying a war makes Tomcat undeploy the webapp, delete its exploded folder
+        and unpack the whole war again.  Instead, `war_sync.py` compares the CRC 
+        of each entry of the new war with the exploded webapp on the server and 
+        writes only the changed files.  The war in Tomcat's webapps folder is 
+        replaced keeping its modification time, so Tomcat doesn't redeploy it but 
+        unpacks the new war if it ever unpacks it again.  Webapps with changed 
+        classes, jars or descriptors are then reloaded through the manager (or by
+        touching their web.xml on an instance without a manager user), JSPs and 
+        static files are picked up without a reload.  Webapps that are not 
+        unpacked yet get their war copied like `deploy_all` does.
+        
+        Returns:
+            dict: the `war_sync.py` summary of each synced webapp.
+        '''
+        
+        self.install_data_sources()
+        remote_script = self.put_script(war_sync, 'war_sync.py')
+        webapps = [webapp for webapp, config_template_file, config_method in WEBAPPS]
+        
+        # check what is on the server in one batch
+        batch = CommandBatch()
+        for webapp in webapps:
+            deployed = unix_path_join(self.tomcat_webapps_dir, webapp)
+            batch.run('test -f {0}.war -a -d {0}/WEB-INF && echo unpacked || echo missing'.format(deployed))
+        batch.run('test -f {0} && echo manager || echo none'.format(self.tomcat_manager_password_file))
+        batch.run('netstat -tln | grep -q ":8080 " && echo running || echo stopped')
+        batch.execute()
+        unpacked = [webapp for webapp, output in zip(webapps, batch.outputs) if output.strip() == 'unpacked']
+        has_manager = batch.outputs[-2].strip() == 'manager'
+        tomcat_running = batch.outputs[-1].strip() == 'running'
+        
+        batch = CommandBatch()
+        for webapp in webapps:
+            deployed = unix_path_join(self.tomcat_webapps_dir, webapp)
+            if webapp in unpacked:
+                batch.run('python {0} {1} {2}'.format(remote_script, self.war_filename(webapp), deployed))
+                batch.run('cp {0} {1}.war.part && touch -r {1}.war {1}.war.part && mv {1}.war.part {1}.war'.format(
+                    self.war_filename(webapp), deployed))
+            else:
+                batch.run('cp {0} {1}'.format(self.war_filename(webapp), self.tomcat_webapps_dir))
+        batch.execute()
+        
+        summaries = dict()
+        outputs = iter(batch.outputs)
+        for webapp in webapps:
+            output = next(outputs)
+            if webapp in unpacked:
+                summaries[webapp] = json.loads(output.strip().splitlines()[-1])
+                next(outputs)
+                
+        reload_batch = CommandBatch()
+        for webapp in webapps:
+            if webapp not in unpacked:
+                print('{0}: copied the war'.format(webapp))
+                continue
+            summary = summaries[webapp]
+            print('{0}: {1} added, {2} changed, {3} removed, {4} unchanged'.format(webapp,
+                                                                                 len(summary['added']),
+                                                                                 len(summary['changed']),
+                                                                                 len(summary['removed']),
+                                                                                 summary['unchanged']))
+            if not (summary['reload'] and tomcat_running):
+                continue
+            if has_manager:
+                reload_batch.run('''response=$(curl -s -m 300 -u "deployer:$(cat {0})" 'http://localhost:8080/manager/text/reload?path=/{1}'); echo "$response"; case "$response" in OK*) ;; *) exit 1;; esac'''.format(
+                    self.tomcat_manager_password_file, webapp))
+            else:
+                # web.xml is a watched resource of every webapp
+                reload_batch.run('touch {0}'.format(unix_path_join(self.tomcat_webapps_dir, webapp, 'WEB-INF', 'web.xml')))
+            print('{0}: reloading'.format(webapp))
+        reload_batch.execute()
+        return summaries
+        
+    def put_script(self, module, script_name):
+        '''Upload a module of this package to the scripts folder on the server.
+        
+        Args:
+            module (module): a module that only uses the standard library.
+            script_name (string): the file name to give it on the server.
+            
+        Returns:
+            string: the path of the script on the server.
+        '''
+        
+        run('mkdir -p {0}'.format(self.script_dir))
+        remote_script = unix_path_join(self.script_dir, script_name)
+        put(os.path.splitext(module.__file__)[0] + '.py', remote_script)
+        return remote_script
             
     def start_servers(self):
         '''Starts tomcat and xwiki servers.
@@ -201,6 +784,63 @@ class ObaRvtdFab:
         run('set -m; /home/{0}/tomcat/bin/shutdown.sh'.format(self.user))
         sudo('set -m; /usr/local/xwiki/stop_xwiki.sh -p 8081')
         
+    def check_ready(self):
+        '''Check if the OBA api answers the agencies-with-coverage call with some agencies.
+        
+        Returns:
+            tuple: (True if ready, a message about the check).
+        '''
+        
+        url = READINESS_URL.format(get_oba_setting(self.oba_conf, 'readiness_api_key', 'TEST'))
+        with settings(warn_only=True):
+            response = run("curl -s -m 30 '{0}'".format(url))
+        if response.failed:
+            return False, 'No response from the api (curl exit code {0})'.format(response.return_code)
+        try:
+            agencies = json.loads(response)['data']['list']
+        except (ValueError, KeyError, TypeError):
+            return False, 'Api response is not an agency list'
+        if not agencies:
+            return False, 'No agencies with coverage'
+        return True, '{0} agencies with coverage'.format(len(agencies))
+        
+    def wait_until_ready(self):
+        '''Wait for the OBA api to become ready, up to `readiness_timeout` seconds.
+        '''
+        
+        timeout = int(get_oba_setting(self.oba_conf, 'readiness_timeout', 900))
+        start = time.time()
+        while True:
+            ready, message = self.check_ready()
+            if ready:
+                print('OBA ready after {0:.0f} seconds: {1}'.format(time.time() - start, message))
+                return
+            if time.time() - start > timeout:
+                raise Exception('OBA not ready after {0} seconds: {1}'.format(timeout, message))
+            time.sleep(10)
+        
+    def wait_for_tomcat_stop(self):
+        '''Wait up to a minute for tomcat to stop listening.
+        '''
+        
+        for i in range(12):
+            with settings(warn_only=True):
+                if run('netstat -tln | grep -q ":8080 "').failed:
+                    return
+            time.sleep(5)
+        raise Exception('Tomcat did not shut down.')
+        
+    def rolling_update(self):
+        '''Stops the servers, deploys the webapps, starts the servers and waits until OBA is ready.
+        '''
+        
+        with settings(warn_only=True):
+            self.stop_servers()
+        self.wait_for_tomcat_stop()
+        self.deploy_all()
+        self.start_servers()
+        self.wait_until_ready()
+        
     def install_watchdog(self):
         '''Configures and uploads watchdog script.  Adds cron task to run it.
         '''
@@ -215,25 +855,17 @@ class ObaRvtdFab:
             print('Please create it and set the appropriate location of the watchdog.ini file.')
             return
         
-        # ensure script and config folder exists
-        if not exists(self.config_dir):
-            run('mkdir {0}'.format(self.config_dir))
-            
-        if not exists(self.script_dir):
-            run('mkdir {0}'.format(self.script_dir))
-            
-        # upload watchdog script (remove it if needed)
         remote_script_file = unix_path_join(self.script_dir, 'check_oba.py')
-        if exists(remote_script_file):
-            sudo('rm -rf {0}'.format(remote_script_file))
-            
-        put(oba_script_file, self.script_dir)
-        
-        # upload watchdog config (remove it if needed)
         remote_config_file = unix_path_join(self.config_dir, 'watchdog.ini')
-        if exists(remote_config_file):
-            sudo('rm -rf {0}'.format(remote_config_file))
+        
+        # ensure script and config folder exists and remove the old script and config
+        batch = CommandBatch()
+        batch.run('mkdir -p {0} {1}'.format(self.config_dir, self.script_dir))
+        batch.sudo('rm -rf {0} {1}'.format(remote_script_file, remote_config_file))
+        batch.execute()
             
+        # upload watchdog script and config
+        put(oba_script_file, self.script_dir)
         put(os.path.join(CONFIG_DIR, 'watchdog.ini'), self.config_dir)
         
         # update/insert cron to run script
@@ -261,46 +893,118 @@ def install(instance_dns_name=None):
     oba_fab.install_all()
     
     
+def update_config(instance_dns_name=None):
+    '''Uploads changed data sources settings, Tomcat reloads the webapps using them.
+    
+    Args:
+        instance_dns_name (string, default=None): The EC2 instance to update.  Separate
+            several instances with commas to work on them in parallel.
+    '''
+    
+    if not instance_dns_name:
+        instance_dns_name = input('Enter EC2 public dns name(s): ')
+        
+    HostGroup(split_host_names(instance_dns_name)).run_and_check(ObaRvtdFab, 'install_data_sources')
+    
+    
 def deploy(instance_dns_name=None):
     '''Deploys the webapps to Tomcat.
     
     Args:
-        instance_dns_name (string, default=None): The EC2 instance to deploy to.
+        instance_dns_name (string, default=None): The EC2 instance to deploy to.  Separate
+            several instances with commas to work on them in parallel.
     '''
     
     if not instance_dns_name:
-        instance_dns_name = input('Enter EC2 public dns name: ')
+        instance_dns_name = input('Enter EC2 public dns name(s): ')
         
-    oba_fab = ObaRvtdFab(instance_dns_name)
-    oba_fab.deploy_all()
+    HostGroup(split_host_names(instance_dns_name)).run_and_check(ObaRvtdFab, 'deploy_all')
+            
+    
+def deploy_changed(instance_dns_name=None):
+    '''Deploys only the changed files of the webapps to Tomcat and reloads the webapps that need it.
+    
+    Args:
+        instance_dns_name (string, default=None): The EC2 instance to deploy to.  Separate
+            several instances with commas to work on them in parallel.
+    '''
+    
+    if not instance_dns_name:
+        instance_dns_name = input('Enter EC2 public dns name(s): ')
+        
+    HostGroup(split_host_names(instance_dns_name)).run_and_check(ObaRvtdFab, 'deploy_changed')
             
     
 def start(instance_dns_name=None):
     '''Start the OBA server on the EC2 instance.
     
     Args:
-        instance_dns_name (string, default=None): The EC2 instance to deploy to.
+        instance_dns_name (string, default=None): The EC2 instance to deploy to.  Separate
+            several instances with commas to work on them in parallel.
     '''
     
     if not instance_dns_name:
-        instance_dns_name = input('Enter EC2 public dns name: ')
+        instance_dns_name = input('Enter EC2 public dns name(s): ')
         
-    oba_fab = ObaRvtdFab(instance_dns_name)
-    oba_fab.start_servers()
+    HostGroup(split_host_names(instance_dns_name)).run_and_check(ObaRvtdFab, 'start_servers')
 
 
 def stop(instance_dns_name=None):
     '''Stop the OBA server on the EC2 instance.
     
     Args:
-        instance_dns_name (string, default=None): The EC2 instance to deploy to.
+        instance_dns_name (string, default=None): The EC2 instance to deploy to.  Separate
+            several instances with commas to work on them in parallel.
     '''
     
     if not instance_dns_name:
-        instance_dns_name = input('Enter EC2 public dns name: ')
+        instance_dns_name = input('Enter EC2 public dns name(s): ')
         
-    oba_fab = ObaRvtdFab(instance_dns_name)
-    oba_fab.stop_servers()
+    HostGroup(split_host_names(instance_dns_name)).run_and_check(ObaRvtdFab, 'stop_servers')
+
+
+def rolling_deploy(instance_dns_name=None, batch_size=None):
+    '''Deploys the webapps to several EC2 instances, a batch at a time.
+    
+    Each batch is stopped, deployed and started in parallel and has to pass the 
+    readiness check (the agencies-with-coverage api call) before the next batch 
+    starts.  The deploy halts if a batch fails.  Instances that aren't ready before
+    the deploy go first, and a batch never has all the ready instances, so the
+    rest of the fleet keeps serving.
+    
+    Args:
+        instance_dns_name (string, default=None): The EC2 instances to deploy to, 
+            separated by commas.
+        batch_size (int, default=None): The number of instances to deploy to at a time,
+            defaults to the `rolling_batch_size` setting in oba.ini (or 1).
+    '''
+    
+    if not instance_dns_name:
+        instance_dns_name = input('Enter EC2 public dns names: ')
+    host_names = split_host_names(instance_dns_name)
+    
+    if batch_size is None:
+        batch_size = int(get_oba_setting(get_oba_config(), 'rolling_batch_size', 1))
+        
+    # deploying to instances that are down doesn't reduce capacity
+    checks = HostGroup(host_names).run_and_check(ObaRvtdFab, 'check_ready')
+    ready = [summary['host'] for summary in checks if summary['result'][0]]
+    not_ready = [summary['host'] for summary in checks if not summary['result'][0]]
+    for host_name in not_ready:
+        print('{0} is not ready before the deploy'.format(host_name))
+    batch_size = max(1, min(batch_size, len(ready) - 1)) if len(ready) > 1 else max(1, batch_size)
+    batches = [not_ready] if not_ready else []
+    batches += [ready[i:i + batch_size] for i in range(0, len(ready), batch_size)]
+    
+    for i, batch in enumerate(batches):
+        print('Deploying batch {0} of {1}: {2}'.format(i + 1, len(batches), ', '.join(batch)))
+        summaries = HostGroup(batch).run(ObaRvtdFab, 'rolling_update')
+        print_summary('rolling_update', summaries)
+        failed = [summary['host'] for summary in summaries if not summary['succeeded']]
+        if failed:
+            remaining = [host_name for later_batch in batches[i + 1:] for host_name in later_batch]
+            raise Exception('Rolling deploy halted, not ready: {0}.  Not deployed: {1}'.format(
+                ', '.join(failed), ', '.join(remaining) or 'none'))
 
 
 def copy_gwt(instance_dns_name=None):
@@ -316,11 +1020,11 @@ def install_watchdog(instance_dns_name=None):
     '''Installs OBA on the EC2 instance.
     
     Args:
-        instance_dns_name (string, default=None): The EC2 instance to deploy to.
+        instance_dns_name (string, default=None): The EC2 instance to deploy to.  Separate
+            several instances with commas to work on them in parallel.
     '''
     
     if not instance_dns_name:
-        instance_dns_name = input('Enter EC2 public dns name: ')
+        instance_dns_name = input('Enter EC2 public dns name(s): ')
         
-    oba_fab = ObaRvtdFab(instance_dns_name)
-    oba_fab.install_watchdog()
+    HostGroup(split_host_names(instance_dns_name)).run_and_check(ObaRvtdFab, 'install_watchdog')
@@ -0,0 +1,225 @@
+'''Provisioning of an instance as a graph of steps.
+
+Each step declares the yum packages and files it needs and the steps it must
+come after.  Packages and downloads don't depend on anything on the instance, so
+the downloads of all the steps run at the same time as one `yum` transaction
+with all the packages.  Then each step's configure method runs, in dependency
+order.  A fresh instance then takes about as long as its slowest download, not
+the sum of all the installs.
+
+A finished step leaves a fingerprint on the instance, made from its version,
+its parameters and the checksum of what it builds from (the output of its
+probe command, like the commit of a git branch).  A rerun checks all the
+fingerprints in one batch and skips the steps whose fingerprint matches, along
+with their packages and downloads.  Steps that require a step that is rerun are
+rerun too.
+'''
+
+import hashlib
+import json
+import posixpath
+import time
+
+from oba_rvtd_deployer.batch import CommandBatch
+
+
+class Step:
+    '''A provisioning step.'''
+
+    def __init__(self, name, requires=(), packages=(), downloads=(), configure=None,
+                 version=1, params=None, probe=None):
+        '''Constructor for Class.
+
+        Args:
+            name (string): the name of the step, like 'tomcat'.
+            requires (list, default=()): names of the steps to configure before this one.
+            packages (list, default=()): yum packages the step needs.
+            downloads (list, default=()): urls of files the step needs, they are
+                downloaded to the home folder under their own name.
+            configure (string, default=None): the name of the Fab method that
+                configures the step, once its packages and downloads are in place.
+            version (int, default=1): change it when the step changes, so that 
+                instances provisioned with the old step redo it.
+            params (string, default=None): the name of a Fab method that returns a
+                dict of the settings the step uses.
+            probe (string, default=None): the name of a Fab method that returns a shell
+                command printing the checksum of what the step builds from.
+        '''
+
+        self.name = name
+        self.requires = list(requires)
+        self.packages = list(packages)
+        self.downloads = list(downloads)
+        self.configure = configure
+        self.version = version
+        self.params = params
+        self.probe = probe
+
+
+def download_filename(url):
+    '''Get the name a download is saved as.'''
+
+    return posixpath.basename(url)
+
+
+def plan_steps(steps, step_names):
+    '''Order steps so that each one comes after the steps it requires.
+
+    Required steps that are not in `step_names` are assumed to be done already.
+
+    Args:
+        steps (list): all the Steps.
+        step_names (list): names of the steps to run.
+
+    Returns:
+        list: the Steps to run, in order.  Steps that don't depend on each other
+            keep the order of `steps`.
+    '''
+
+    by_name = dict((step.name, step) for step in steps)
+    unknown = [name for name in step_names if name not in by_name]
+    if unknown:
+        raise Exception('Unknown provisioning steps: {0}'.format(', '.join(unknown)))
+
+    selected = [step for step in steps if step.name in step_names]
+    planned = []
+    done = set()
+    while len(planned) < len(selected):
+        ready = [step for step in selected
+                 if step.name not in done and
+                 all(name in done or name not in step_names for name in step.requires)]
+        if not ready:
+            raise Exception('Provisioning steps depend on each other: {0}'.format(
+                ', '.join(step.name for step in selected if step.name not in done)))
+        planned.append(ready[0])
+        done.add(ready[0].name)
+    return planned
+
+
+def fetch_batch(planned_steps):
+    '''Get a batch that installs the packages and downloads the files of some steps.
+
+    Args:
+        planned_steps (list): the Steps.
+
+    Returns:
+        CommandBatch: the downloads run in the background during a single
+            `yum install` of all the packages.
+    '''
+
+    batch = CommandBatch()
+    packages = []
+    for step in planned_steps:
+        for url in step.downloads:
+            batch.run('wget -nv -O {0} {1}'.format(download_filename(url), url),
+                      background=True)
+        packages += [package for package in step.packages if package not in packages]
+    if packages:
+        batch.sudo('yum -y install {0}'.format(' '.join(packages)))
+    return batch
+
+
+def fingerprint_command(fab, step):
+    '''Get a shell command that prints the fingerprint of a step.
+
+    The version and parameters are hashed here, so the parameters (which may
+    include passwords) never reach the instance.
+
+    Args:
+        fab (AwsFab or ObaRvtdFab): it has the params and probe methods of the step.
+        step (Step): the step.
+
+    Returns:
+        string: the command.
+    '''
+
+    params = getattr(fab, step.params)() if step.params else dict()
+    settings_hash = hashlib.sha256(json.dumps([step.name,
+                                               step.version,
+                                               step.packages,
+                                               step.downloads,
+                                               params],
+                                              sort_keys=True).encode('utf-8')).hexdigest()
+    probe = getattr(fab, step.probe)() if step.probe else 'true'
+    return '{{ echo {0}; {1}; }} 2>/dev/null | sha256sum | cut -d " " -f 1'.format(settings_hash,
+                                                                                    probe)
+
+
+def fingerprint_filename(fab, step):
+    '''Get the file a step's fingerprint is kept in on the instance.'''
+
+    return posixpath.join(fab.state_dir, step.name)
+
+
+def completed_steps(fab, planned_steps):
+    '''Check which steps are already done on the instance, in one batch.
+
+    Args:
+        fab (AwsFab or ObaRvtdFab): connected to the host.
+        planned_steps (list): the Steps.
+
+    Returns:
+        set: the names of the steps whose recorded fingerprint matches.
+    '''
+
+    batch = CommandBatch()
+    for step in planned_steps:
+        batch.run('echo "$(cat {0} 2>/dev/null) $({1})"'.format(fingerprint_filename(fab, step),
+                                                               fingerprint_command(fab, step)))
+    batch.execute()
+
+    completed = set()
+    for step, output in zip(planned_steps, batch.outputs):
+        fingerprints = output.split()
+        if len(fingerprints) == 2 and fingerprints[0] == fingerprints[1]:
+            completed.add(step.name)
+    return completed
+
+
+def record_step(fab, step):
+    '''Write the fingerprint of a finished step on the instance.'''
+
+    batch = CommandBatch()
+    batch.run('mkdir -p {0} && ({1}) > {2}'.format(fab.state_dir,
+                                                    fingerprint_command(fab, step),
+                                                    fingerprint_filename(fab, step)))
+    batch.execute()
+
+
+def provision(fab, steps, step_names, force=False):
+    '''Run provisioning steps on a host, skipping the ones already done.
+
+    Args:
+        fab (AwsFab or ObaRvtdFab): connected to the host, it has the methods of 
+            the steps and the `state_dir` to keep fingerprints in.
+        steps (list): all the Steps.
+        step_names (list): names of the steps to run.
+        force (bool, default=False): run the steps even if they are done.
+    '''
+
+    planned_steps = plan_steps(steps, step_names)
+    start = time.time()
+    completed = set() if force else completed_steps(fab, planned_steps)
+    rerun = set()
+    for step in planned_steps:
+        if step.name not in completed or any(name in rerun for name in step.requires):
+            rerun.add(step.name)
+    skipped = [step.name for step in planned_steps if step.name not in rerun]
+    if skipped:
+        print('Skipping steps already done: {0}'.format(', '.join(skipped)))
+    planned_steps = [step for step in planned_steps if step.name in rerun]
+
+    fetch_batch(planned_steps).execute()
+    timings = [('packages and downloads', time.time() - start)]
+
+    for step in planned_steps:
+        step_start = time.time()
+        if step.configure:
+            getattr(fab, step.configure)()
+        record_step(fab, step)
+        timings.append((step.name, time.time() - step_start))
+
+    print('Provisioned {0} in {1:.1f}s'.format(', '.join(step.name for step in planned_steps) or 'nothing',
+                                               time.time() - start))
+    for name, seconds in timings:
+        print('  {0}: {1:.1f}s'.format(name, seconds))
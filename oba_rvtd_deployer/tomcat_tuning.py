@@ -0,0 +1,160 @@
+'''Sizing of Tomcat and its JVM for an instance.
+
+`size_tomcat` turns what an instance has (memory and vCPUs) and what it serves
+(the size of the transit data bundle and the expected api requests per second)
+into the heap, garbage collector and connector settings that
+`AwsFab.configure_tomcat_tuning` renders into Tomcat's `bin/setenv.sh` and
+`conf/server.xml`.  It only does arithmetic, so profiles can be compared for
+instance types before launching them.
+'''
+
+import math
+
+
+# memory (MiB) and vCPUs of EC2 instance types
+INSTANCE_TYPES = {
+    't2.micro': (1024, 1),
+    't2.small': (2048, 1),
+    't2.medium': (4096, 2),
+    't2.large': (8192, 2),
+    'm3.medium': (3840, 1),
+    'm3.large': (7680, 2),
+    'm3.xlarge': (15360, 4),
+    'm3.2xlarge': (30720, 8),
+    'm4.large': (8192, 2),
+    'm4.xlarge': (16384, 4),
+    'm4.2xlarge': (32768, 8),
+    'c3.large': (3840, 2),
+    'c3.xlarge': (7680, 4),
+    'c3.2xlarge': (15360, 8),
+    'c4.large': (3840, 2),
+    'c4.xlarge': (7680, 4),
+    'c4.2xlarge': (15360, 8),
+    'r3.large': (15616, 2),
+    'r3.xlarge': (31232, 4),
+}
+
+DEFAULT_API_REQUESTS_PER_SECOND = 10
+
+# assumed until a bundle is built on the instance
+DEFAULT_BUNDLE_SIZE_MB = 250
+
+# left to the system, postgresql, xwiki and the page cache
+RESERVED_MB = 1280
+RESERVED_FRACTION = 0.1
+
+PERM_GEN_MB = 256
+THREAD_STACK_MB = 1
+
+# the federation webapp keeps the bundle in memory, next to the other webapps
+BASE_HEAP_MB = 768
+HEAP_PER_BUNDLE_MB = 3
+MIN_HEAP_MB = 512
+# above this the JVM can't use compressed pointers
+MAX_HEAP_MB = 30720
+# G1 keeps pauses short on big heaps, but costs more than it saves on small ones
+G1_MIN_HEAP_MB = 4096
+
+# the time an api request holds a thread, and how much to provision above it
+REQUEST_SECONDS = 0.25
+THREAD_HEADROOM = 2
+MIN_THREADS_PER_VCPU = 25
+MAX_THREADS = 400
+
+# connections queued while all threads are busy, as seconds of requests
+QUEUE_SECONDS = 2
+MIN_ACCEPT_COUNT = 100
+MAX_ACCEPT_COUNT = 1000
+
+
+def get_instance_resources(instance_type):
+    '''Get the memory and vCPUs of an instance type.
+
+    Returns:
+        tuple: (memory in MiB, vCPUs), or None if the instance type is not in `INSTANCE_TYPES`.
+    '''
+
+    return INSTANCE_TYPES.get(instance_type)
+
+
+def get_api_requests_per_second(oba_conf):
+    '''Get the api request rate Tomcat is sized for.
+
+    Args:
+        oba_conf (ConfigParser.ConfigParser): the oba config.
+
+    Returns:
+        float: the `api_requests_per_second` setting, or
+            `DEFAULT_API_REQUESTS_PER_SECOND` if not set.
+    '''
+
+    if oba_conf.has_option('DEFAULT', 'api_requests_per_second'):
+        rate = oba_conf.get('DEFAULT', 'api_requests_per_second').strip()
+        if rate:
+            return float(rate)
+    return DEFAULT_API_REQUESTS_PER_SECOND
+
+
+def size_tomcat(memory_mb, vcpus, bundle_size_mb, requests_per_second):
+    '''Size the JVM and the connector of Tomcat.
+
+    The threads follow from the request rate (requests in flight, with headroom),
+    and the heap gets the memory left after the system, the permanent generation
+    and the thread stacks.
+
+    Args:
+        memory_mb (int): memory of the instance in MiB.
+        vcpus (int): vCPUs of the instance.
+        bundle_size_mb (int): size of the transit data bundle on disk in MiB.
+        requests_per_second (float): expected api requests per second.
+
+    Returns:
+        dict: the heap and permanent generation sizes in MiB, the garbage collector,
+            the JVM options, the connector's thread pool and accept count and
+            warnings about the instance being too small.
+    '''
+
+    in_flight = requests_per_second * REQUEST_SECONDS * THREAD_HEADROOM
+    max_threads = min(MAX_THREADS, max(MIN_THREADS_PER_VCPU * vcpus, int(math.ceil(in_flight))))
+    min_spare_threads = min(max_threads, max(10, 4 * vcpus))
+    accept_count = min(MAX_ACCEPT_COUNT,
+                       max(MIN_ACCEPT_COUNT, int(math.ceil(requests_per_second * QUEUE_SECONDS))))
+
+    reserved_mb = RESERVED_MB + int(memory_mb * RESERVED_FRACTION)
+    available_mb = memory_mb - reserved_mb - PERM_GEN_MB - max_threads * THREAD_STACK_MB
+    heap_mb = min(MAX_HEAP_MB, max(MIN_HEAP_MB, available_mb // 64 * 64))
+    needed_heap_mb = BASE_HEAP_MB + HEAP_PER_BUNDLE_MB * bundle_size_mb
+
+    warnings = []
+    if heap_mb < needed_heap_mb:
+        warnings.append('The bundle needs about {0} MiB of heap, only {1} MiB are available.'.format(
+            needed_heap_mb, heap_mb))
+    if available_mb < MIN_HEAP_MB:
+        warnings.append('Only {0} MiB of memory are left for the heap, it is set to {1} MiB.'.format(
+            available_mb, MIN_HEAP_MB))
+
+    if vcpus == 1:
+        gc = 'serial'
+        gc_options = ['-XX:+UseSerialGC']
+    elif heap_mb >= G1_MIN_HEAP_MB:
+        gc = 'g1'
+        gc_options = ['-XX:+UseG1GC', '-XX:MaxGCPauseMillis=200']
+    else:
+        gc = 'parallel'
+        gc_options = ['-XX:+UseParallelGC', '-XX:ParallelGCThreads={0}'.format(vcpus)]
+
+    java_options = (['-Xms{0}m'.format(heap_mb),
+                     '-Xmx{0}m'.format(heap_mb),
+                     '-XX:MaxPermSize={0}m'.format(PERM_GEN_MB)] +
+                    gc_options +
+                    ['-Djava.awt.headless=true'])
+
+    return dict(heap_mb=heap_mb,
+                needed_heap_mb=needed_heap_mb,
+                perm_gen_mb=PERM_GEN_MB,
+                gc=gc,
+                java_options=java_options,
+                max_threads=max_threads,
+                min_spare_threads=min_spare_threads,
+                accept_count=accept_count,
+                warnings=warnings)
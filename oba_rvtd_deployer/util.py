@@ -19,6 +19,10 @@ class FabLogger():
         self.terminal.write(message)
         self.log.write(message)
         
+    def flush(self):
+        self.terminal.flush()
+        self.log.flush()
+        
 
 def unix_path_join(*args):
     return '/'.join(args)
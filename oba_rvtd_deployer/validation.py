@@ -0,0 +1,687 @@
+from collections import OrderedDict
+from datetime import datetime
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import time
+import zipfile
+
+from transitfeed.problems import ProblemReporter, TYPE_WARNING
+import transitfeed
+
+from oba_rvtd_deployer import REPORTS_DIR
+from oba_rvtd_deployer.feedvalidator import (JsonLinesProblemWriter,
+                                             LimitPerTypeProblemAccumulator,
+                                             SqliteProblemWriter)
+
+
+VALIDATION_CACHE_FILE = os.path.join(REPORTS_DIR, 'validation_cache.json')
+MAX_CACHE_ENTRIES = 50
+VALIDATION_LOADERS = ['transitfeed', 'columnar']
+PROBLEM_OUTPUTS = ['jsonl', 'sqlite']
+PROBLEM_DB_FILE = os.path.join(REPORTS_DIR, 'gtfs_problems.sqlite')
+
+
+def get_ignore_types(gtfs_conf):
+    '''Get the list of problem types to ignore during validation.
+
+    Args:
+        gtfs_conf (ConfigParser): the GTFS config.
+
+    Returns:
+        list: sorted problem class names, such as ['ExpirationDate', 'UnusedStop'].
+    '''
+
+    if not gtfs_conf.has_option('DEFAULT', 'validation_ignore_types'):
+        return []
+
+    ignore_types = gtfs_conf.get('DEFAULT', 'validation_ignore_types')
+    return sorted(set([t.strip() for t in ignore_types.split(',') if t.strip()]))
+
+
+def get_validation_loader(gtfs_conf):
+    '''Get the loader to validate the GTFS with.
+
+    Args:
+        gtfs_conf (ConfigParser): the GTFS config.
+
+    Returns:
+        string: `transitfeed` (the default) or `columnar`.
+    '''
+
+    if gtfs_conf.has_option('DEFAULT', 'validation_loader'):
+        loader = gtfs_conf.get('DEFAULT', 'validation_loader').strip().lower()
+        if loader:
+            if loader not in VALIDATION_LOADERS:
+                raise Exception('Unknown validation_loader: {0}'.format(loader))
+            return loader
+
+    return 'transitfeed'
+
+
+def get_problem_outputs(gtfs_conf):
+    '''Get the machine-readable formats to write every validation problem to.
+
+    Args:
+        gtfs_conf (ConfigParser): the GTFS config.
+
+    Returns:
+        list: `jsonl` and/or `sqlite`, empty if only the html report is wanted.
+    '''
+
+    if not gtfs_conf.has_option('DEFAULT', 'validation_problem_output'):
+        return []
+
+    outputs = gtfs_conf.get('DEFAULT', 'validation_problem_output')
+    outputs = [o.strip().lower() for o in outputs.split(',') if o.strip()]
+    for output in outputs:
+        if output not in PROBLEM_OUTPUTS:
+            raise Exception('Unknown validation_problem_output: {0}'.format(output))
+    return outputs
+
+
+def open_problem_writers(outputs, run):
+    '''Open the writers that stream problems to machine-readable files.
+
+    The JSON Lines file is written per run.  The SQLite database keeps every
+    run, so problems of different runs can be compared with a query like::
+
+        SELECT type, file, row, field FROM problems WHERE run = '<new run>'
+        EXCEPT
+        SELECT type, file, row, field FROM problems WHERE run = '<old run>'
+
+    Args:
+        outputs (list): formats from `get_problem_outputs`.
+        run (string): identifies the validation run, like '2016-01-31 12:00:00 transitfeed'.
+
+    Returns:
+        list: the writers.
+    '''
+
+    writers = []
+    if 'jsonl' in outputs:
+        jsonl_filename = os.path.join(REPORTS_DIR, 
+                                      'gtfs_problems_{0}.jsonl'.format(run.replace(':', '.').replace(' ', '_')))
+        writers.append(JsonLinesProblemWriter(jsonl_filename, run))
+    if 'sqlite' in outputs:
+        writers.append(SqliteProblemWriter(PROBLEM_DB_FILE, run))
+    return writers
+
+
+def close_problem_writers(writers):
+    '''Close problem writers.
+
+    Returns:
+        list: the files written to.
+    '''
+
+    for writer in writers:
+        writer.Close()
+    return [writer.filename for writer in writers]
+
+
+def validation_cache_key(feed_sha256, ignore_types, loader='transitfeed'):
+    '''Build the key of a validation result.
+
+    The result of a validation depends on the feed contents, the version of
+    transitfeed that validated it, the loader and the problem types that were ignored.
+
+    Args:
+        feed_sha256 (string): hex digest of the feed file.
+        ignore_types (list): problem class names ignored during validation.
+        loader (string, default='transitfeed'): the loader used.
+
+    Returns:
+        string: the cache key.
+    '''
+
+    key_parts = [feed_sha256, transitfeed.__version__, ','.join(sorted(ignore_types))]
+    if loader != 'transitfeed':
+        key_parts.append(loader)
+    return hashlib.sha256('|'.join(key_parts).encode('utf-8')).hexdigest()
+
+
+def read_validation_cache():
+    '''Read the validation cache.
+
+    Returns:
+        dict: map from cache key to validation result.
+    '''
+
+    if not os.path.exists(VALIDATION_CACHE_FILE):
+        return dict()
+
+    with open(VALIDATION_CACHE_FILE) as f:
+        try:
+            return json.load(f)
+        except ValueError:
+            return dict()
+
+
+def get_cached_result(cache_key):
+    '''Get a previous validation result.
+
+    Args:
+        cache_key (string): key from `validation_cache_key`.
+
+    Returns:
+        dict: the validation result or None if the feed hasn't been validated
+            (or its report has since been deleted).
+    '''
+
+    result = read_validation_cache().get(cache_key)
+    if result is None:
+        return None
+
+    if not os.path.exists(result.get('report_file', '')):
+        return None
+
+    return result
+
+
+def store_result(cache_key, result):
+    '''Save a validation result, dropping the oldest ones if the cache is full.
+
+    Args:
+        cache_key (string): key from `validation_cache_key`.
+        result (dict): the validation result.
+    '''
+
+    cache = read_validation_cache()
+    cache[cache_key] = result
+    if len(cache) > MAX_CACHE_ENTRIES:
+        oldest_first = sorted(cache.keys(), key=lambda k: cache[k].get('validated_at', ''))
+        for k in oldest_first[:len(cache) - MAX_CACHE_ENTRIES]:
+            del cache[k]
+
+    tmp_file = VALIDATION_CACHE_FILE + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+    if os.path.exists(VALIDATION_CACHE_FILE):
+        os.remove(VALIDATION_CACHE_FILE)
+    os.rename(tmp_file, VALIDATION_CACHE_FILE)
+
+
+def check_validation_result(result, ignore_types=()):
+    '''Print a summary of a validation result and decide whether the feed can be used.
+
+    The expiration is checked against the current date, so a cached result
+    of a feed that has since expired will fail.
+
+    Args:
+        result (dict): the validation result.
+        ignore_types (list, default=()): ignored problem class names, the expiration
+            isn't checked if `ExpirationDate` is one of them.
+
+    Returns:
+        boolean: True if no errors in GTFS and it has not expired.
+    '''
+
+    print('GTFS validation report written to {0}'.format(result['report_file']))
+
+    gtfs_validated = True
+    if result['num_errors'] > 0:
+        gtfs_validated = False
+        print('{0} errors in GTFS data'.format(result['num_errors']))
+
+    if result['num_warnings'] > 0:
+        print('{0} warnings about GTFS data'.format(result['num_warnings']))
+
+    # transitfeed only warns when the feed expires within 60 days, a result
+    # cached before then has no warning
+    if result['end_date'] and 'ExpirationDate' not in ignore_types:
+        try:
+            last_service_day = datetime(*(time.strptime(result['end_date'], "%Y%m%d")[0:6]))
+        except ValueError:
+            # the columnar loader keeps the feed_end_date of feed_info.txt as written
+            print('GTFS end date {0} is not a valid date.'.format(result['end_date']))
+            gtfs_validated = False
+        else:
+            if last_service_day < datetime.now():
+                print('GTFS Feed has expired.')
+                gtfs_validated = False
+
+    return gtfs_validated
+
+
+INCREMENTAL_STATE_FILE = os.path.join(REPORTS_DIR, 'incremental_validation.json')
+CHECK_PROBLEMS_DIR = os.path.join(REPORTS_DIR, 'check_problems')
+
+# the tables each table refers to, a change in a table affects every table
+# that (directly or indirectly) refers to it
+TABLE_REFERENCES = {
+    'agency.txt': [],
+    'stops.txt': [],
+    'routes.txt': ['agency.txt'],
+    'calendar.txt': [],
+    'calendar_dates.txt': [],
+    'shapes.txt': [],
+    'trips.txt': ['routes.txt', 'calendar.txt', 'calendar_dates.txt', 'shapes.txt'],
+    'stop_times.txt': ['trips.txt', 'stops.txt'],
+    'frequencies.txt': ['trips.txt'],
+    'transfers.txt': ['stops.txt'],
+    'fare_attributes.txt': [],
+    'fare_rules.txt': ['fare_attributes.txt', 'routes.txt'],
+    'feed_info.txt': []
+}
+
+
+def _check_null_headsigns(schedule, problems):
+    # check for trips with a null value for trip_headsign
+    for trip in schedule.GetTripList():
+        if trip.trip_headsign == 'null':
+            problems.InvalidValue('trip_headsign', 'null', type=TYPE_WARNING)
+
+
+# the checks done by Schedule.Validate() plus our own, in the same order, with
+# the tables each one reads.  None means the check always needs to run (the
+# expiration check depends on today's date).
+SCHEDULE_CHECKS = [
+    ('agency_timezone',
+     lambda s, p: s.ValidateAgenciesHaveSameAgencyTimezone(p),
+     ['agency.txt']),
+    ('feed_info_lang',
+     lambda s, p: s.ValidateFeedInfoLangMatchesAgencyLang(p),
+     ['agency.txt', 'feed_info.txt']),
+    ('service_range',
+     lambda s, p: s.ValidateServiceRangeAndExceptions(p, None, None),
+     None),
+    ('stops',
+     lambda s, p: s.ValidateStops(p, True),
+     ['stops.txt', 'stop_times.txt']),
+    ('nearby_stops',
+     lambda s, p: s.ValidateNearbyStops(p),
+     ['stops.txt']),
+    ('route_names',
+     lambda s, p: s.ValidateRouteNames(p, True),
+     ['routes.txt']),
+    ('trips',
+     lambda s, p: s.ValidateTrips(p),
+     ['trips.txt', 'stop_times.txt', 'stops.txt', 'routes.txt',
+      'calendar.txt', 'calendar_dates.txt']),
+    ('route_agency',
+     lambda s, p: s.ValidateRouteAgencyId(p),
+     ['routes.txt', 'agency.txt']),
+    ('trip_stop_times',
+     lambda s, p: s.ValidateTripStopTimes(p),
+     ['trips.txt', 'stop_times.txt', 'stops.txt', 'routes.txt',
+      'shapes.txt', 'frequencies.txt']),
+    ('unused_shapes',
+     lambda s, p: s.ValidateUnusedShapes(p),
+     ['shapes.txt', 'trips.txt']),
+    ('null_headsigns',
+     _check_null_headsigns,
+     ['trips.txt'])
+]
+
+
+def zip_member_digests(feed_filename):
+    '''Calculate the SHA-256 digest of each file in a GTFS zip.
+
+    Args:
+        feed_filename (string): path to the GTFS zip file.
+
+    Returns:
+        dict: map from member name to hex digest.
+    '''
+
+    digests = dict()
+    with zipfile.ZipFile(feed_filename) as zf:
+        for name in zf.namelist():
+            sha = hashlib.sha256()
+            member = zf.open(name)
+            for block in iter(lambda: member.read(1024 * 1024), b''):
+                sha.update(block)
+            member.close()
+            digests[os.path.basename(name)] = sha.hexdigest()
+    return digests
+
+
+def affected_tables(old_digests, new_digests):
+    '''Find the tables whose validation could change between two feeds.
+
+    Args:
+        old_digests (dict): member digests of the previously validated feed.
+        new_digests (dict): member digests of the new feed.
+
+    Returns:
+        set: the changed, added or removed tables and every table that refers to them.
+    '''
+
+    names = set(old_digests.keys()) | set(new_digests.keys())
+    affected = set([n for n in names if old_digests.get(n) != new_digests.get(n)])
+
+    # add tables that refer to an affected table until nothing changes
+    grew = True
+    while grew:
+        grew = False
+        for table, references in TABLE_REFERENCES.items():
+            if table not in affected and affected.intersection(references):
+                affected.add(table)
+                grew = True
+
+    return affected
+
+
+def incremental_settings_key(limit_per_type, ignore_types):
+    '''Build the key of the validation settings the incremental state was saved with.
+
+    Problems saved with other settings can't be reused.
+
+    Args:
+        limit_per_type (int): maximum number of problems kept of each type.
+        ignore_types (list): problem class names ignored during validation.
+
+    Returns:
+        string: the settings key.
+    '''
+
+    key_parts = [str(limit_per_type), transitfeed.__version__, ','.join(sorted(ignore_types))]
+    return hashlib.sha256('|'.join(key_parts).encode('utf-8')).hexdigest()
+
+
+def read_incremental_state(settings_key):
+    '''Read the per-table digests and per-check problems of the last validated feed.
+
+    Args:
+        settings_key (string): identifies the validation settings, state saved with
+            other settings is not used.
+
+    Returns:
+        dict: the state, or None if there is no usable state.
+    '''
+
+    if not os.path.exists(INCREMENTAL_STATE_FILE):
+        return None
+
+    with open(INCREMENTAL_STATE_FILE) as f:
+        try:
+            state = json.load(f)
+        except ValueError:
+            return None
+
+    if state.get('settings_key') != settings_key:
+        return None
+
+    return state
+
+
+def write_incremental_state(state):
+    '''Save the per-table digests and per-check problems of the validated feed.
+
+    Args:
+        state (dict): the state to save.
+    '''
+
+    tmp_file = INCREMENTAL_STATE_FILE + '.tmp'
+    with open(tmp_file, 'w') as f:
+        # some problems keep date objects, which only need to be formatted later
+        json.dump(state, f, default=str)
+    if os.path.exists(INCREMENTAL_STATE_FILE):
+        os.remove(INCREMENTAL_STATE_FILE)
+    os.rename(tmp_file, INCREMENTAL_STATE_FILE)
+
+
+def get_validation_processes(gtfs_conf):
+    '''Get the number of processes to run the schedule checks with.
+
+    Args:
+        gtfs_conf (ConfigParser): the GTFS config.
+
+    Returns:
+        int: the `validation_processes` setting, or the number of cpus if not set.
+    '''
+
+    if gtfs_conf.has_option('DEFAULT', 'validation_processes'):
+        processes = gtfs_conf.get('DEFAULT', 'validation_processes').strip()
+        if processes:
+            return max(1, int(processes))
+
+    return multiprocessing.cpu_count()
+
+
+# checks that only look at one trip at a time, these can be split into shards of trips
+TRIP_SHARDED_CHECKS = ['trip_stop_times', 'null_headsigns']
+
+# state shared with the check worker processes (inherited when they are forked)
+_WORKER_STATE = dict()
+
+
+def check_problems_filename(name, start=None):
+    '''Get the file that all problems of a check (or shard of one) are streamed to.'''
+
+    if start is None:
+        return os.path.join(CHECK_PROBLEMS_DIR, '{0}.jsonl'.format(name))
+    return os.path.join(CHECK_PROBLEMS_DIR, '{0}.{1}.jsonl'.format(name, start))
+
+
+def _run_check(schedule, name, trip_ids, limit_per_type, ignore_types, problems_filename=None):
+    '''Run one check (on a shard of trips if trip_ids is given).
+
+    Returns:
+        list: snapshot of the problems found.
+    '''
+
+    check = dict((n, c) for n, c, _ in SCHEDULE_CHECKS)[name]
+    writers = []
+    if problems_filename:
+        writers.append(JsonLinesProblemWriter(problems_filename))
+    check_accumulator = LimitPerTypeProblemAccumulator(limit_per_type, ignore_types, writers)
+
+    try:
+        if trip_ids is None:
+            check(schedule, ProblemReporter(check_accumulator))
+        else:
+            # let the check see only the trips of this shard, in their original order
+            all_trips = schedule.trips
+            schedule.trips = OrderedDict((trip_id, all_trips[trip_id]) for trip_id in trip_ids)
+            try:
+                check(schedule, ProblemReporter(check_accumulator))
+            finally:
+                schedule.trips = all_trips
+    finally:
+        close_problem_writers(writers)
+
+    return check_accumulator.Snapshot()
+
+
+def _init_check_worker():
+    '''Give a forked worker its own connection to the schedule's sqlite db.'''
+
+    schedule = _WORKER_STATE['schedule']
+    # keep the inherited connection referenced, closing it could affect the parent
+    _WORKER_STATE['inherited_connection'] = schedule._connection
+    schedule._connection = sqlite3.connect(_WORKER_STATE['db_filename'])
+
+
+def _run_check_task(task):
+    name, start, end = task
+    if start is None:
+        trip_ids = None
+    else:
+        trip_ids = _WORKER_STATE['trip_ids'][start:end]
+    problems_filename = None
+    if _WORKER_STATE['stream_problems']:
+        problems_filename = check_problems_filename(name, start)
+    return _run_check(_WORKER_STATE['schedule'],
+                      name,
+                      trip_ids,
+                      _WORKER_STATE['limit_per_type'],
+                      _WORKER_STATE['ignore_types'],
+                      problems_filename)
+
+
+def _schedule_db_filename(schedule):
+    '''Get the file of the schedule's sqlite db (None if it is kept in memory).'''
+
+    temp_db_file = getattr(schedule, '_temp_db_file', None)
+    if temp_db_file is not None:
+        return temp_db_file.name
+    return getattr(schedule, '_temp_db_filename', None)
+
+
+def run_checks(schedule, names, limit_per_type, ignore_types, processes=1, stream_problems=False):
+    '''Run schedule checks, spread over a pool of processes.
+
+    Each check (or shard of trips for the per-trip checks) runs in a worker and
+    reports its problems back as an accumulator snapshot.  The snapshots are
+    merged in the same order as a serial run, so the report doesn't depend on
+    which worker finished first.
+
+    With stream_problems, every problem of a check is also written to the file
+    given by `check_problems_filename`, shards are joined in order.
+
+    Args:
+        schedule (transitfeed.Schedule): the loaded schedule.
+        names (list): names of the checks in SCHEDULE_CHECKS to run.
+        limit_per_type (int): maximum number of problems to keep of each type.
+        ignore_types (list): problem class names to ignore.
+        processes (int, default=1): number of worker processes.
+        stream_problems (boolean, default=False): whether to write all problems of each check.
+
+    Returns:
+        dict: map from check name to snapshot of the problems found.
+    '''
+
+    for name in names:
+        # don't leave problems of an older run of the check behind
+        if os.path.exists(check_problems_filename(name)):
+            os.remove(check_problems_filename(name))
+
+    db_filename = _schedule_db_filename(schedule)
+    if processes > 1 and not hasattr(os, 'fork'):
+        print('Running the schedule checks serially, processes can\'t be forked here')
+    elif processes > 1 and db_filename is None:
+        print('Running the schedule checks serially, the schedule is kept in an in-memory db')
+    if processes <= 1 or not hasattr(os, 'fork') or db_filename is None:
+        snapshots = dict()
+        for name in names:
+            problems_filename = check_problems_filename(name) if stream_problems else None
+            snapshots[name] = _run_check(schedule,
+                                         name,
+                                         None,
+                                         limit_per_type,
+                                         ignore_types,
+                                         problems_filename)
+        return snapshots
+
+    # split the per-trip checks into a few shards per process
+    trip_ids = list(schedule.trips.keys())
+    shard_size = max(1, int(math.ceil(len(trip_ids) / float(processes * 4))))
+    tasks = []
+    for name in names:
+        if name in TRIP_SHARDED_CHECKS:
+            for start in range(0, len(trip_ids), shard_size):
+                tasks.append((name, start, start + shard_size))
+        else:
+            tasks.append((name, None, None))
+
+    # workers open their own connection to the db, so it must have everything
+    schedule._connection.commit()
+    _WORKER_STATE.update(schedule=schedule,
+                         db_filename=db_filename,
+                         trip_ids=trip_ids,
+                         limit_per_type=limit_per_type,
+                         ignore_types=ignore_types,
+                         stream_problems=stream_problems)
+    pool = multiprocessing.Pool(processes, _init_check_worker)
+    try:
+        results = pool.map(_run_check_task, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+        _WORKER_STATE.clear()
+
+    # combine the shards of each check in order
+    snapshots = dict()
+    for name in names:
+        check_accumulator = LimitPerTypeProblemAccumulator(limit_per_type, ignore_types)
+        for task, snapshot in zip(tasks, results):
+            if task[0] == name:
+                check_accumulator.MergeSnapshot(snapshot)
+        snapshots[name] = check_accumulator.Snapshot()
+
+    if stream_problems:
+        for name in names:
+            if name not in TRIP_SHARDED_CHECKS:
+                continue
+            with open(check_problems_filename(name), 'wb') as out:
+                for task in tasks:
+                    if task[0] == name:
+                        shard_filename = check_problems_filename(name, task[1])
+                        with open(shard_filename, 'rb') as shard:
+                            shutil.copyfileobj(shard, out)
+                        os.remove(shard_filename)
+    return snapshots
+
+
+def run_schedule_checks(schedule, accumulator, feed_filename, limit_per_type, ignore_types,
+                        incremental=True, processes=1, problem_writers=None):
+    '''Run the schedule-wide checks, skipping those not affected by changes since the last feed.
+
+    The problems of each check are collected separately.  When none of the tables
+    a check reads changed since the last validated feed, the problems saved from
+    that run are merged into the accumulator instead of running the check again.
+
+    If problem_writers are given, all problems of every check (not only those kept
+    for the report) are passed to them, in check order.
+
+    Args:
+        schedule (transitfeed.Schedule): the loaded schedule.
+        accumulator (LimitPerTypeProblemAccumulator): accumulator of the report.
+        feed_filename (string): path to the GTFS zip file.
+        limit_per_type (int): maximum number of problems to keep of each type.
+        ignore_types (list): problem class names to ignore.
+        incremental (boolean, default=True): whether to reuse problems of unchanged checks.
+        processes (int, default=1): number of processes to run the checks with.
+        problem_writers (list, default=None): writers from `open_problem_writers`.
+    '''
+
+    stream_problems = bool(problem_writers)
+    if stream_problems and not os.path.exists(CHECK_PROBLEMS_DIR):
+        os.makedirs(CHECK_PROBLEMS_DIR)
+
+    settings_key = incremental_settings_key(limit_per_type, ignore_types)
+    digests = zip_member_digests(feed_filename)
+    state = read_incremental_state(settings_key) if incremental else None
+    if state:
+        affected = affected_tables(state['member_digests'], digests)
+        print('Changed GTFS tables: {0}'.format(', '.join(sorted(affected)) or 'none'))
+    else:
+        affected = None
+
+    to_run = []
+    snapshots = dict()
+    for name, check, tables in SCHEDULE_CHECKS:
+        if (affected is None or
+                tables is None or
+                affected.intersection(tables) or
+                name not in state['checks'] or
+                (stream_problems and not os.path.exists(check_problems_filename(name)))):
+            to_run.append(name)
+        else:
+            snapshots[name] = state['checks'][name]
+
+    snapshots.update(run_checks(schedule,
+                                to_run,
+                                limit_per_type,
+                                ignore_types,
+                                processes,
+                                stream_problems))
+
+    for name, check, tables in SCHEDULE_CHECKS:
+        accumulator.MergeSnapshot(snapshots[name], write=not stream_problems)
+        if stream_problems:
+            with open(check_problems_filename(name)) as f:
+                for line in f:
+                    record = json.loads(line)
+                    for writer in problem_writers:
+                        writer.WriteRecord(record)
+
+    write_incremental_state(dict(settings_key=settings_key,
+                                 member_digests=digests,
+                                 checks=snapshots))
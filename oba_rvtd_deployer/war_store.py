@@ -0,0 +1,120 @@
+'''A content-addressed store of built webapps.
+
+A webapp's WAR only depends on the git commit it was built from (the data
+sources are loaded from outside the WAR), so WARs are stored under their
+commit.  An instance whose commit matches a stored WAR gets that WAR instead
+of building it.  The store is a folder laid out like an object store bucket
+(`<webapp>/<commit>.war` with a `.json` manifest next to it), so it can be
+local or a mounted or synced bucket shared by several deployers.
+'''
+
+from datetime import datetime
+import json
+import os
+import shutil
+
+from oba_rvtd_deployer import DATA_DIR
+from oba_rvtd_deployer.download import file_sha256
+
+
+DEFAULT_WAR_STORE_DIR = os.path.join(DATA_DIR, 'war_store')
+
+
+def get_war_store_dir(oba_conf):
+    '''Get the folder of the WAR store.
+
+    Args:
+        oba_conf (ConfigParser.ConfigParser): the oba config.
+
+    Returns:
+        string: the `war_store_dir` setting, or `DEFAULT_WAR_STORE_DIR` if not set.
+    '''
+
+    if oba_conf.has_option('DEFAULT', 'war_store_dir'):
+        war_store_dir = oba_conf.get('DEFAULT', 'war_store_dir').strip()
+        if war_store_dir:
+            return war_store_dir
+    return DEFAULT_WAR_STORE_DIR
+
+
+class WarStore:
+    '''The WARs in a store folder.'''
+
+    def __init__(self, root):
+        self.root = root
+
+    def key(self, webapp, commit):
+        '''Get the key of a WAR, like onebusaway-webapp/<commit>.
+
+        Args:
+            webapp (string): the name of the webapp.
+            commit (string): the git commit it is built from.
+        '''
+
+        return '{0}/{1}'.format(webapp, commit)
+
+    def filename(self, key, extension):
+        '''Get the file of a key in the store, with an extension like '.war'.'''
+
+        return os.path.join(self.root, *(key + extension).split('/'))
+
+    def find(self, webapp, commit):
+        '''Find a stored WAR.
+
+        Returns:
+            tuple: (WAR file, manifest), or None if the WAR is not in the store.
+        '''
+
+        key = self.key(webapp, commit)
+        war_filename = self.filename(key, '.war')
+        manifest_filename = self.filename(key, '.json')
+        if not (os.path.exists(war_filename) and os.path.exists(manifest_filename)):
+            return None
+        with open(manifest_filename) as f:
+            try:
+                manifest = json.load(f)
+            except ValueError:
+                return None
+        return war_filename, manifest
+
+    def add(self, war_filename, webapp, commit, sha256=None):
+        '''Add a WAR to the store.
+
+        The WAR is copied to a temporary file first and renamed, so a reader never
+        sees a partial WAR.
+
+        Args:
+            war_filename (string): the WAR.
+            webapp (string): the name of the webapp.
+            commit (string): the git commit it was built from.
+            sha256 (string, default=None): the expected digest of the WAR.
+
+        Raises:
+            Exception: if the WAR does not match `sha256`.
+
+        Returns:
+            dict: the manifest of the stored WAR.
+        '''
+
+        key = self.key(webapp, commit)
+        stored_filename = self.filename(key, '.war')
+        if not os.path.exists(os.path.dirname(stored_filename)):
+            os.makedirs(os.path.dirname(stored_filename))
+
+        temp_filename = stored_filename + '.part'
+        shutil.copyfile(war_filename, temp_filename)
+        stored_sha256 = file_sha256(temp_filename).hexdigest()
+        if sha256 and stored_sha256 != sha256:
+            os.remove(temp_filename)
+            raise Exception('WAR of {0} was corrupted before it was stored.'.format(webapp))
+        os.rename(temp_filename, stored_filename)
+
+        manifest = dict(key=key,
+                        webapp=webapp,
+                        commit=commit,
+                        sha256=stored_sha256,
+                        size=os.path.getsize(stored_filename),
+                        stored_at=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        with open(self.filename(key, '.json'), 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        return manifest
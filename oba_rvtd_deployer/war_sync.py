@@ -0,0 +1,149 @@
+'''Sync an exploded webapp with a new WAR.
+
+Compares the CRC of each entry of the WAR with the file in the folder Tomcat
+exploded the webapp to, writes only the entries that differ and removes the
+files that are not in the WAR anymore.  Prints a json summary of the changes,
+including whether the webapp needs a reload: changed classes, jars or
+descriptors under WEB-INF and META-INF do, while JSPs and static resources are
+picked up by a running webapp.
+
+This module only uses the standard library because it is also uploaded to the
+server and run there:
+
+    python war_sync.py <war file> <exploded webapp dir>
+'''
+
+import json
+import os
+import sys
+import zipfile
+import zlib
+
+
+# files Tomcat adds to an exploded webapp
+TOMCAT_FILES = ['META-INF/war-tracker']
+
+# changes to entries in these folders take effect only after a reload
+RELOAD_PREFIXES = ('WEB-INF/', 'META-INF/')
+
+
+def file_crc32(filename):
+    '''Compute the CRC-32 of a file, like a zip entry's.'''
+
+    crc = 0
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            crc = zlib.crc32(chunk, crc)
+    return crc & 0xffffffff
+
+
+def entry_filename(webapp_dir, name):
+    '''Get the file of a WAR entry in the exploded webapp.'''
+
+    return os.path.join(webapp_dir, *name.split('/'))
+
+
+def compare(war, webapp_dir):
+    '''Compare a WAR with an exploded webapp.
+
+    Args:
+        war (zipfile.ZipFile): the WAR.
+        webapp_dir (string): the exploded webapp.
+
+    Returns:
+        tuple: lists of the entries added to and changed in the WAR and of the
+            files of the webapp that are not in the WAR.
+    '''
+
+    added = []
+    changed = []
+    names = set()
+    for info in war.infolist():
+        if info.filename.endswith('/'):
+            continue
+        names.add(info.filename)
+        filename = entry_filename(webapp_dir, info.filename)
+        if not os.path.isfile(filename):
+            added.append(info.filename)
+        elif (os.path.getsize(filename) != info.file_size or
+              file_crc32(filename) != info.CRC):
+            changed.append(info.filename)
+
+    removed = []
+    for dir_path, dir_names, file_names in os.walk(webapp_dir):
+        for file_name in file_names:
+            name = os.path.relpath(os.path.join(dir_path, file_name), webapp_dir).replace(os.sep, '/')
+            if name not in names and name not in TOMCAT_FILES:
+                removed.append(name)
+    return added, changed, sorted(removed)
+
+
+def extract(war, name, webapp_dir):
+    '''Write an entry of the WAR to the exploded webapp.
+
+    The entry is written next to the file and renamed, so Tomcat never serves
+    or loads a partial file.
+    '''
+
+    filename = entry_filename(webapp_dir, name)
+    if not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    temp_filename = filename + '.war_sync'
+    with open(temp_filename, 'wb') as f:
+        f.write(war.read(name))
+    os.rename(temp_filename, filename)
+
+
+def remove(name, webapp_dir):
+    '''Remove a file from the exploded webapp, with the folders it leaves empty.'''
+
+    filename = entry_filename(webapp_dir, name)
+    os.remove(filename)
+    dir_name = os.path.dirname(filename)
+    while os.path.abspath(dir_name) != os.path.abspath(webapp_dir) and not os.listdir(dir_name):
+        os.rmdir(dir_name)
+        dir_name = os.path.dirname(dir_name)
+
+
+def sync(war_filename, webapp_dir):
+    '''Make an exploded webapp match a WAR.
+
+    Args:
+        war_filename (string): the WAR.
+        webapp_dir (string): the exploded webapp.
+
+    Returns:
+        dict: the added, changed and removed files, the number of unchanged files
+            and whether the webapp needs a reload.
+    '''
+
+    war = zipfile.ZipFile(war_filename)
+    try:
+        added, changed, removed = compare(war, webapp_dir)
+        for name in added + changed:
+            extract(war, name, webapp_dir)
+        unchanged = len([info for info in war.infolist() if not info.filename.endswith('/')])
+        unchanged -= len(added) + len(changed)
+    finally:
+        war.close()
+
+    for name in removed:
+        remove(name, webapp_dir)
+
+    return dict(added=added,
+                changed=changed,
+                removed=removed,
+                unchanged=unchanged,
+                reload=any(name.startswith(RELOAD_PREFIXES) for name in added + changed + removed))
+
+
+def main(args):
+    if len(args) == 2:
+        print(json.dumps(sync(args[0], args[1]), sort_keys=True))
+        return 0
+    print(__doc__)
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -18,13 +18,20 @@ setup(
             # aws/oba installation
             'launch_new_ec2=oba_rvtd_deployer.aws:launch_new',
             'tear_down_ec2=oba_rvtd_deployer.aws:tear_down',
+            'tune_tomcat=oba_rvtd_deployer.aws:tune_tomcat',
             'install_oba=oba_rvtd_deployer.oba:install',
             'install_watchdog=oba_rvtd_deployer.oba:install_watchdog',
             
             # oba/gtfs activation
             'validate_gtfs=oba_rvtd_deployer.gtfs:validate_gtfs',
+            'diff_gtfs=oba_rvtd_deployer.feed_diff:diff_gtfs',
             'update_gtfs=oba_rvtd_deployer.gtfs:update',
+            'rollback_gtfs=oba_rvtd_deployer.gtfs:rollback',
+            'bundle_build_stats=oba_rvtd_deployer.gtfs:compare_bundle_builds',
             'deploy_oba=oba_rvtd_deployer.oba:deploy',
+            'deploy_changed_oba=oba_rvtd_deployer.oba:deploy_changed',
+            'update_oba_config=oba_rvtd_deployer.oba:update_config',
+            'rolling_deploy_oba=oba_rvtd_deployer.oba:rolling_deploy',
             'start_oba=oba_rvtd_deployer.oba:start',
             'stop_oba=oba_rvtd_deployer.oba:stop',
             